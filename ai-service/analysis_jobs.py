@@ -0,0 +1,367 @@
+# --- Whole-thesis analysis jobs ---
+# Analyzing a full thesis takes seconds, too long for a request. POST
+# /analysis-jobs queues "analyze these theses" (or every thesis still pending
+# analysis) in a SQLite queue and returns a job id to poll. A small pool of
+# worker processes, each with its own spaCy pipeline loaded once, takes tasks
+# off the queue and writes aiSummary, aiKeywords, aiSentiment and
+# analysisStatus straight into MongoDB.
+#
+# The queue survives restarts: tasks left running by a worker that died are
+# put back in the queue. One process (gunicorn worker or the command below)
+# runs the pool at a time, elected through a lock file like the index sync.
+#
+#   python analysis_jobs.py --workers 2          # run the pool in the foreground
+#   python analysis_jobs.py --enqueue-pending    # queue every pending thesis and exit
+import argparse
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from thesis_text import source_text
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines run a single process, so no leader election is needed
+    fcntl = None
+
+ANALYSIS_QUEUE_PATH = os.environ.get("ANALYSIS_QUEUE_PATH", "analysis_jobs.sqlite3")
+# Worker processes started by the web app (0 leaves the pool to `python analysis_jobs.py`)
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", 1))
+ANALYSIS_MAX_ATTEMPTS = int(os.environ.get("ANALYSIS_MAX_ATTEMPTS", 3))
+ANALYSIS_POLL_SECONDS = float(os.environ.get("ANALYSIS_POLL_SECONDS", 2))
+# A worker that dies this soon after starting is restarted only after a pause
+CRASH_LOOP_SECONDS = 10
+CRASH_RESTART_DELAY = 30
+
+PENDING_QUERY = {'$or': [{'analysisStatus': 'pending'}, {'analysisStatus': {'$exists': False}}]}
+
+
+def worker_name(pid=None):
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+
+class JobQueue:
+    def __init__(self, path=ANALYSIS_QUEUE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        # Autocommit, so claim() can take the write lock up front with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " description TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " job_id TEXT NOT NULL,"
+            " thesis_id TEXT NOT NULL,"
+            " state TEXT NOT NULL,"           # queued -> running -> done | failed (back to queued on retry)
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT,"
+            " error TEXT,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " PRIMARY KEY (job_id, thesis_id))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self._connect()
+
+    # --- Producers ---
+    def submit(self, thesis_ids, description):
+        # Returns (job_id, queued ids, ids skipped because an earlier job already has them queued)
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            # The check runs under the write lock, so another process can't queue the same
+            # thesis between it and the insert
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                active = {row[0] for row in self.conn.execute(
+                    "SELECT thesis_id FROM tasks WHERE state IN ('queued', 'running')")}
+                queued = list(dict.fromkeys(t for t in thesis_ids if t not in active))
+                skipped = [t for t in dict.fromkeys(thesis_ids) if t in active]
+                self.conn.execute("INSERT INTO jobs VALUES (?, ?, ?)", (job_id, description, time.time()))
+                self.conn.executemany("INSERT INTO tasks (job_id, thesis_id, state) VALUES (?, ?, 'queued')",
+                                      [(job_id, thesis_id) for thesis_id in queued])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return job_id, queued, skipped
+
+    # --- Workers ---
+    def claim(self, worker):
+        # Marks the oldest queued task as running by this worker; returns (job_id, thesis_id, attempts) or None
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT rowid, job_id, thesis_id, attempts FROM tasks WHERE state = 'queued' ORDER BY rowid LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE tasks SET state = 'running', worker = ?, started_at = ?, attempts = attempts + 1"
+                        " WHERE rowid = ?", (worker, time.time(), row[0]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return (row[1], row[2], row[3] + 1) if row is not None else None
+
+    def finish(self, job_id, thesis_id, error=None, retry=False):
+        state = 'queued' if retry else ('failed' if error else 'done')
+        with self.lock:
+            self.conn.execute(
+                "UPDATE tasks SET state = ?, error = ?, finished_at = ? WHERE job_id = ? AND thesis_id = ?",
+                (state, error, None if retry else time.time(), job_id, thesis_id))
+
+    def requeue_running(self, worker=None):
+        # Tasks a dead worker (or, without a worker, any previous pool) left running
+        with self.lock:
+            if worker is None:
+                cursor = self.conn.execute("UPDATE tasks SET state = 'queued' WHERE state = 'running'")
+            else:
+                cursor = self.conn.execute(
+                    "UPDATE tasks SET state = 'queued' WHERE state = 'running' AND worker = ?", (worker,))
+            return cursor.rowcount
+
+    # --- Status ---
+    def status(self, job_id):
+        with self.lock:
+            job = self.conn.execute("SELECT id, description, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = self.conn.execute(
+                "SELECT state, COUNT(*), MIN(started_at), MAX(finished_at) FROM tasks WHERE job_id = ? GROUP BY state",
+                (job_id,)).fetchall()
+            errors = self.conn.execute(
+                "SELECT thesis_id, error FROM tasks WHERE job_id = ? AND state = 'failed' ORDER BY rowid LIMIT 20",
+                (job_id,)).fetchall()
+        by_state = {state: count for state, count, _, _ in counts}
+        total = sum(by_state.values())
+        finished = by_state.get('done', 0) + by_state.get('failed', 0)
+        started = [s for _, _, s, _ in counts if s is not None]
+        finished_at = [f for _, _, _, f in counts if f is not None]
+        if finished == total:
+            state = 'completed' if not by_state.get('failed') else 'completed_with_errors'
+        else:
+            state = 'running' if by_state.get('running') or finished else 'queued'
+        return {
+            'job_id': job[0],
+            'description': job[1],
+            'state': state,
+            'total': total,
+            'queued': by_state.get('queued', 0),
+            'running': by_state.get('running', 0),
+            'done': by_state.get('done', 0),
+            'failed': by_state.get('failed', 0),
+            'progress': round(finished / total, 4) if total else 1.0,
+            'created_at': job[2],
+            'started_at': min(started) if started else None,
+            'finished_at': max(finished_at) if finished == total and finished_at else None,
+            'errors': [{'thesis_id': thesis_id, 'error': error} for thesis_id, error in errors]
+        }
+
+    def recent(self, limit=20):
+        with self.lock:
+            job_ids = [row[0] for row in self.conn.execute(
+                "SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))]
+        return [self.status(job_id) for job_id in job_ids]
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ('queued', 'running', 'done', 'failed')}
+
+
+# --- Worker processes ---
+def _collection():
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+    return client[os.environ.get("DB_NAME", "digi-thesis_DB")][os.environ.get("COLLECTION_NAME", "theses")]
+
+
+def analyze_thesis(collection, documents, thesis_id):
+    # Analyzes one thesis and stores the results; raises LookupError if there is nothing to analyze
+    from bson.objectid import ObjectId
+    from doc_analysis import analyze_doc
+
+    doc = collection.find_one({'_id': ObjectId(thesis_id)}, {'full_text': 1, 'abstract': 1})
+    if doc is None:
+        raise LookupError(f"Thesis {thesis_id} not found.")
+    text = source_text(doc)
+    if not text.strip():
+        raise LookupError(f"Thesis {thesis_id} has no text to analyze.")
+    result = analyze_doc(text, documents.parse(text))
+    collection.update_one({'_id': doc['_id']}, {'$set': {
+        'aiSummary': result['summary'],
+        'aiKeywords': result['keywords'],
+        'aiSentiment': result['sentiment'],
+        'analysisStatus': 'complete'
+    }})
+
+
+def work(queue_path=ANALYSIS_QUEUE_PATH, parent=None, poll_seconds=ANALYSIS_POLL_SECONDS):
+    # Entry point of a worker process: loads the pipeline once, then analyzes tasks until
+    # killed or until the process that started it (parent) has gone away
+    from bson.objectid import ObjectId
+    from doc_analysis import DocumentAnalyzer, load_pipeline
+
+    nlp = load_pipeline()
+    # Every text is parsed once, so the parse cache only needs to hold the current one
+    documents = DocumentAnalyzer(lambda: nlp, cache_mb=8)
+    collection = _collection()
+    queue = JobQueue(queue_path)
+    name = worker_name()
+    print(f"Analysis worker {name} ready.")
+    while parent is None or os.getppid() == parent:
+        task = queue.claim(name)
+        if task is None:
+            time.sleep(poll_seconds)
+            continue
+        job_id, thesis_id, attempts = task
+        try:
+            analyze_thesis(collection, documents, thesis_id)
+        except Exception as e:
+            # Missing theses and empty texts won't get better on a retry
+            retry = not isinstance(e, LookupError) and attempts < ANALYSIS_MAX_ATTEMPTS
+            print(f"Analysis of thesis {thesis_id} failed (attempt {attempts}): {e}")
+            queue.finish(job_id, thesis_id, str(e), retry=retry)
+            if not retry:
+                try:
+                    collection.update_one({'_id': ObjectId(thesis_id)}, {'$set': {'analysisStatus': 'failed'}})
+                except Exception:
+                    pass
+        else:
+            queue.finish(job_id, thesis_id)
+
+
+class AnalysisWorkers:
+    # Keeps `processes` worker processes running in whichever process holds the queue's lock file
+    def __init__(self, queue, processes=ANALYSIS_WORKERS, mongo_uri=None, db_name=None, collection_name=None):
+        self.queue = queue
+        self.processes = processes
+        # The web app passes its own connection settings, so workers write to the database it reads;
+        # unset ones fall back to the environment (see _collection)
+        self.mongo_settings = {name: value for name, value in (('MONGO_URI', mongo_uri), ('DB_NAME', db_name),
+                                                               ('COLLECTION_NAME', collection_name)) if value}
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.children = []
+        self.is_leader = False
+        self.restarts = 0
+
+    def start(self):
+        # Called once per process (from the first request); a no-op with ANALYSIS_WORKERS=0
+        if self.processes <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self.children = []
+            self.is_leader = False
+            threading.Thread(target=self.run, daemon=True, name="analysis-workers").start()
+
+    def run(self):
+        lock_file = open(f"{self.queue.path}.lock", "a")
+        while not self._stop.is_set():
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                # Another process runs the pool; take over if it goes away
+                self._stop.wait(CRASH_RESTART_DELAY)
+        if self._stop.is_set():
+            return
+        self.is_leader = True
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"Re-queued {requeued} analysis tasks left running by a previous worker pool.")
+        self._supervise()
+
+    def _supervise(self):
+        slots = [{'process': None, 'started': 0, 'not_before': 0} for _ in range(self.processes)]
+        while not self._stop.is_set():
+            now = time.time()
+            for slot in slots:
+                process = slot['process']
+                if process is not None and process.poll() is None:
+                    continue
+                if process is not None:
+                    requeued = self.queue.requeue_running(worker_name(process.pid))
+                    print(f"Analysis worker {process.pid} exited ({process.returncode}); {requeued} tasks re-queued.")
+                    self.restarts += 1
+                    if now - slot['started'] < CRASH_LOOP_SECONDS:
+                        slot['not_before'] = now + CRASH_RESTART_DELAY
+                    slot['process'] = None
+                if now < slot['not_before']:
+                    continue
+                # A fresh interpreter rather than a fork: nothing of the web app (threads, sockets,
+                # locks) is inherited, and the worker only imports what analysis needs
+                # Settings go through the environment: a URI on the command line would show its password in ps
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--work',
+                                            '--queue', self.queue.path, '--parent', str(os.getpid())],
+                                           env=dict(os.environ, **self.mongo_settings))
+                slot.update(process=process, started=now)
+            self.children = [slot['process'] for slot in slots if slot['process'] is not None]
+            self._stop.wait(1)
+        for process in self.children:
+            process.terminate()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'configured_processes': self.processes,
+            'runs_pool': self.is_leader,
+            'alive_processes': sum(1 for p in self.children if p.poll() is None),
+            'restarts': self.restarts
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the thesis analysis worker pool.")
+    parser.add_argument('--workers', type=int, default=max(ANALYSIS_WORKERS, 1))
+    parser.add_argument('--enqueue-pending', action='store_true', help="Queue every thesis pending analysis and exit")
+    parser.add_argument('--queue', default=ANALYSIS_QUEUE_PATH)
+    # Used by the pool to start its worker processes
+    parser.add_argument('--work', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--parent', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.work:
+        work(args.queue, args.parent)
+        return
+    queue = JobQueue(args.queue)
+    if args.enqueue_pending:
+        thesis_ids = [str(doc['_id']) for doc in _collection().find(PENDING_QUERY, {'_id': 1})]
+        job_id, queued, skipped = queue.submit(thesis_ids, 'all pending theses')
+        print(f"Queued job {job_id}: {len(queued)} theses ({len(skipped)} already queued).")
+        return
+    pool = AnalysisWorkers(queue, args.workers)
+    try:
+        pool.run()
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
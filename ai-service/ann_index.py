@@ -0,0 +1,187 @@
+# --- Approximate nearest-neighbour index factory ---
+# Builds the FAISS index behind /semantic-search and /recommend-theses.
+# Vectors are L2-normalized and searched by inner product, so every index
+# type returns cosine similarity (higher = more similar). Parameters are
+# picked from the corpus size unless overridden through the environment.
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+INDEX_TYPE = os.environ.get("INDEX_TYPE", "auto")
+
+# Optional overrides for the automatic choices below
+IVF_NLIST = int(os.environ.get("IVF_NLIST", 0))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 0))
+HNSW_M = int(os.environ.get("HNSW_M", 32))
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 0))
+
+# FAISS warns below ~39 training points per centroid; PQ codebooks need 256 centroids each
+MIN_POINTS_PER_CENTROID = 39
+PQ_NBITS = 8
+
+
+def normalize(vectors):
+    vectors = np.ascontiguousarray(np.asarray(vectors, dtype='float32'))
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    vectors = vectors.copy()
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def choose_index_type(n, requested=INDEX_TYPE):
+    if requested in INDEX_TYPES:
+        # PQ codebooks can't be trained on a tiny corpus; fall back to exact IVF lists
+        if requested == 'ivf_pq' and n < (1 << PQ_NBITS) * MIN_POINTS_PER_CENTROID:
+            return 'ivf_flat' if n >= 1000 else 'flat'
+        if requested == 'ivf_flat' and n < 1000:
+            return 'flat'
+        return requested
+    # auto: exact search is fast enough for a departmental repository,
+    # HNSW for mid-sized corpora, compressed IVF-PQ once memory matters
+    if n < 20000:
+        return 'flat'
+    if n < 1000000:
+        return 'hnsw'
+    return 'ivf_pq'
+
+
+def choose_nlist(n):
+    if IVF_NLIST:
+        return IVF_NLIST
+    nlist = int(4 * math.sqrt(n))
+    nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+    return max(1, min(nlist, 65536))
+
+
+def choose_nprobe(nlist):
+    if IVF_NPROBE:
+        return IVF_NPROBE
+    # ~6% of the lists keeps recall@10 above 0.95 on sentence embeddings
+    return max(1, min(nlist, max(8, nlist // 16)))
+
+
+def choose_pq_m(d):
+    # Largest sub-quantizer count with >= 4 dims per sub-vector (96 bytes/vector for MiniLM's 384 dims).
+    # 8-dim sub-vectors halve the memory again but cost a lot of recall; see benchmark_index.py.
+    for m in range(d // 4, 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def choose_ef_search(n):
+    if HNSW_EF_SEARCH:
+        return HNSW_EF_SEARCH
+    return 64 if n < 100000 else 128
+
+
+def training_size(index_type, n):
+    # How many vectors the first build needs before the index can be trained
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        nlist = choose_nlist(n)
+        points = nlist * MIN_POINTS_PER_CENTROID
+        if index_type == 'ivf_pq':
+            points = max(points, (1 << PQ_NBITS) * MIN_POINTS_PER_CENTROID)
+        return min(n, max(points, 10000))
+    return 0
+
+
+def create_index(d, n, training_vectors=None, index_type=INDEX_TYPE):
+    # n is the expected corpus size; training_vectors must already be normalized
+    index_type = choose_index_type(n, index_type)
+    if index_type == 'flat':
+        base = faiss.IndexFlatIP(d)
+    elif index_type == 'hnsw':
+        base = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        base.hnsw.efConstruction = 80
+    else:
+        nlist = choose_nlist(n)
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == 'ivf_flat':
+            base = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            base = faiss.IndexIVFPQ(quantizer, d, nlist, choose_pq_m(d), PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        base.train(training_vectors)
+        # IVF lists store external ids natively (an IDMap wrapper would break remove_ids);
+        # the hashtable direct map keeps remove_ids and reconstruct working together
+        base.set_direct_map_type(faiss.DirectMap.Hashtable)
+        tune(base, n)
+        print(f"Created {index_type} FAISS index for ~{n} vectors (nlist={nlist}).")
+        return base
+
+    index = faiss.IndexIDMap2(base)
+    tune(index, n)
+    print(f"Created {index_type} FAISS index for ~{n} vectors.")
+    return index
+
+
+def _base(index):
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def has_stable_ids(index):
+    # Indexes written before stable ids existed are plain positional flat indexes
+    return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexIVF))
+
+
+def index_type_of(index):
+    base = _base(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(base, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(base, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def tune(index, n):
+    # Search-time parameters are not all persisted by write_index, so they are set on every load
+    base = _base(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = choose_ef_search(n)
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = choose_nprobe(base.nlist)
+
+
+def supports_remove(index):
+    # HNSW graphs can't drop nodes; removed vectors are tombstoned instead
+    return index_type_of(index) != 'hnsw'
+
+
+def is_cosine(index):
+    return index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def reconstruct_all(index, ids):
+    # Exact for flat/HNSW/IVF-Flat, approximate for IVF-PQ
+    return np.vstack([index.reconstruct(int(i)) for i in ids]).astype('float32') if len(ids) else None
+
+
+def memory_bytes(index):
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def mmap_flags(index_type):
+    # read_index flags that map the vectors from the file instead of copying them, so every
+    # process reading the same file shares one copy in the page cache. Mapped indexes are read-only.
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def search_parameters(index, selector, widen=1):
+    # Search parameters of the type the index expects, restricted to the ids selector accepts.
+    # widen > 1 searches more of an approximate index, for filters that leave few candidates.
+    base = _base(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch * widen)
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=min(base.nlist, base.nprobe * widen))
+    return faiss.SearchParameters(sel=selector)
@@ -1,33 +1,55 @@
-import spacy
-from textblob import TextBlob
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import language_tool_python
-from difflib import SequenceMatcher
-# New imports for semantic search
-import faiss
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
 import json
+import time
+from collections import deque
 # New imports for MongoDB
 from pymongo import MongoClient
 from bson.objectid import ObjectId # Import ObjectId for MongoDB ID handling
 from bson.errors import InvalidId # Import InvalidId for handling bad MongoDB IDs
-
-# NEW IMPORTS FOR AI FEATURES
-import textstat # For Readability Score
-# Load the spaCy and TextBlob models
-nlp = spacy.load("en_core_web_sm")
-# Initialize LanguageTool for grammar checking
-try:
-    grammar_tool = language_tool_python.LanguageTool('en-US')
-except Exception as e:
-    print(f"Error initializing LanguageTool: {e}")
-    grammar_tool = None # Handle case where tool might not initialize
+from index_sync import IndexSync, embedding_text
+from embedding_store import EmbeddingStore
+from knn_graph import KnnGraph, DUPLICATE_THRESHOLD
+from encode_batcher import EncodeBatcher
+from search_cache import LRUCache, normalize_query, result_key, QUERY_EMBEDDING_CACHE_MB, SEARCH_RESULT_CACHE_MB
+from plagiarism import PlagiarismIndex
+from passage_index import PassageIndex, POOLING
+from hybrid_search import HybridSearch, FilterError
+from pdf_extract import TextCache, extract_thesis
+from doc_analysis import DocumentAnalyzer, load_pipeline, analyze_doc
+from tag_engine import TagEngine
+from grammar_pool import GrammarPool, GrammarUnavailable
+from analysis_jobs import JobQueue, AnalysisWorkers, PENDING_QUERY
+from encoder_backends import load_model, embedding_model_name, ENCODER_BACKEND
+from readability import ReadabilityEngine
+from thesis_text import content_hash, source_text
+import metrics
+from metrics import stage
+import resources
+from resources import LazyResource
+
+# Heavy models (spaCy, sentence-transformers, LanguageTool) are imported and loaded on first
+# use or by the warm-up, never at import, so the service starts serving immediately (see resources.py).
+
+# Load the spaCy model without the components nothing uses (NER, lemmatizer). Texts are parsed
+# once and the parse is shared by every endpoint through a content-hash cache (see doc_analysis.py).
+nlp = LazyResource('spacy', load_pipeline)
+documents = DocumentAnalyzer(nlp.get)
+
+def _start_language_tool():
+    import language_tool_python
+    return language_tool_python.LanguageTool('en-US')
+
+# LanguageTool backends for grammar checking: a pool of Java servers, started in each worker
+# (on its first request) and restarted automatically if one crashes (see grammar_pool.py)
+grammar_pool = GrammarPool(_start_language_tool)
 
 app = Flask(__name__)
 CORS(app) # Enable CORS for your frontend
+# Per-endpoint and per-stage latency histograms, exported on /metrics (see metrics.py)
+metrics.instrument(app)
 
 # NEW: Add a root endpoint for a basic health check or welcome message
 @app.route('/')
@@ -43,138 +65,374 @@ db = None
 
 try:
     # ADDED: A 5-second timeout for server selection
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    # The ismaster command is cheap and does not require auth.
-    client.admin.command('ismaster')
+    # connect=False: no connection (or monitor threads) until the first query, so startup
+    # doesn't wait on the network and forked workers don't inherit the parent's sockets
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, connect=False)
     db = client[DB_NAME]
-    print("Connected to MongoDB successfully.")
 except Exception as e:
     print(f"Could not connect to MongoDB. Error: {e}")
     db = None # Ensure db is None if connection fails
 
 
 # --- AI Search Setup ---
-# The model that will convert text to vectors.
-search_model = SentenceTransformer('all-MiniLM-L6-v2')
-faiss_index = None
-thesis_data = [] # Stores metadata like titles, authors, etc.
-
-# Helper function to create and save the FAISS index
-def create_and_save_index(documents, metadata_list):
-    print("Creating and saving FAISS index...")
-    # Generate embeddings for all documents
-    embeddings = search_model.encode(documents)
-    
-    # Ensure embeddings are in float32 format for FAISS
-    embeddings = np.array(embeddings).astype('float32')
-    
-    # The dimensionality of the vectors
-    d = embeddings.shape[1]
-    
-    # Create a FAISS index (IndexFlatL2 is a simple, brute-force index)
-    index = faiss.IndexFlatL2(d)
-    
-    # Add the embeddings to the index
-    index.add(embeddings)
-    
-    # Save the index to a file
-    faiss.write_index(index, "thesis_index.faiss")
-    
-    # Save the corresponding metadata (titles, etc.) to a file
-    with open("thesis_metadata.json", "w") as f:
-        json.dump(metadata_list, f)
-        
-    print("FAISS index created and saved successfully.")
-    return index
-
-# Helper function to load the FAISS index from a file
-def load_index():
-    global faiss_index, thesis_data
-    if os.path.exists("thesis_index.faiss") and os.path.exists("thesis_metadata.json"):
-        print("Loading FAISS index from file...")
-        faiss_index = faiss.read_index("thesis_index.faiss")
-        with open("thesis_metadata.json", "r") as f:
-            thesis_data = json.load(f)
-        print("FAISS index loaded.")
-        return True
-    else:
-        print("No existing FAISS index found. Running initial data ingestion.")
-        return False
-
-# This is the new function to fetch data from MongoDB
-def fetch_data_from_db(include_full_text=False): # Added include_full_text parameter
+# The model that will convert text to vectors: all-MiniLM-L6-v2 in fp32 PyTorch, or its
+# int8-quantized ONNX export with ENCODER_BACKEND=onnx-int8 (see encoder_backends.py)
+search_model = LazyResource('search_model', load_model)
+
+def encode(texts):
+    return search_model.get().encode(texts)
+
+# Request handlers encode through a micro-batcher: concurrent single-text calls are
+# merged into one batched encode (see encode_batcher.py). Bulk index work calls the model directly.
+query_encoder = EncodeBatcher(encode)
+# Repeated queries skip the model (embedding cache) and the index (result cache).
+# Cached results are tagged with the index generation, so any index change invalidates them.
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_MB)
+search_result_cache = LRUCache(SEARCH_RESULT_CACHE_MB)
+# How often (seconds) the index is reconciled with MongoDB when change streams are unavailable
+INDEX_SYNC_INTERVAL = int(os.environ.get("INDEX_SYNC_INTERVAL", 60))
+
+# The FAISS index and its metadata are kept up to date incrementally: each thesis has a
+# stable FAISS id, and only new or edited abstracts are re-encoded (see index_sync.py).
+# The index type (flat, HNSW, IVF-Flat, IVF-PQ) comes from INDEX_TYPE (see ann_index.py);
+# all of them score by cosine similarity.
+# Encoded vectors are also kept in a persistent store keyed by thesis id + text hash
+# (see embedding_store.py), so recommendations and rebuilds don't re-run the model.
+embedding_store = EmbeddingStore(embedding_model_name())
+index_sync = IndexSync(db[COLLECTION_NAME] if db is not None else None, encode, embedding_store)
+
+# Each thesis's nearest neighbours are precomputed into a k-NN table (see knn_graph.py)
+# that the sync leader refreshes, row by row, whenever the index changes.
+knn_graph = KnnGraph()
+index_sync.add_listener(knn_graph.refresh_async)
+
+# Plagiarism checks run against every thesis in the collection through a MinHash/LSH
+# passage index (see plagiarism.py), which follows the same index changes.
+plagiarism_index = PlagiarismIndex(db[COLLECTION_NAME] if db is not None else None)
+index_sync.add_listener(plagiarism_index.refresh_async)
+
+# Full-text search: every thesis's text is embedded as overlapping passages (fp16 or PQ codes)
+# that are pooled back to theses at query time (see passage_index.py); it follows the same changes.
+passage_index = PassageIndex(db[COLLECTION_NAME] if db is not None else None, encode, embedding_model_name())
+index_sync.add_listener(passage_index.refresh_async)
+
+# /semantic-search fuses BM25 keyword hits with the FAISS hits and applies status,
+# department and year filters inside both searches (see hybrid_search.py). Each
+# worker keeps its own inverted index, rebuilt incrementally as the index changes.
+hybrid_search = HybridSearch()
+
+def _load_search_indexes():
+    # Saved index, k-NN table and plagiarism index first, then catch up with MongoDB
+    index_sync.load()
+    knn_graph.load()
+    plagiarism_index.load()
+    passage_index.load()
+    index_sync.sync()
+    hybrid_search.refresh(index_sync)
+    index_sync.start_background(INDEX_SYNC_INTERVAL)
+    return index_sync
+
+search_indexes = LazyResource('search_indexes', _load_search_indexes)
+
+# full_text is extracted from the uploaded PDFs (see pdf_extract.py); results are cached by file hash
+text_cache = TextCache()
+
+# Whole-thesis analysis runs as queued jobs in separate worker processes (see analysis_jobs.py)
+analysis_queue = JobQueue()
+analysis_workers = AnalysisWorkers(analysis_queue, mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_NAME)
+
+if hasattr(os, 'register_at_fork'):
+    # gunicorn --preload forks workers after import; threads don't survive the fork
+    def _restart_index_sync():
+        resources.after_fork()
+        metrics.after_fork()
+        index_sync.after_fork()
+        knn_graph.after_fork()
+        plagiarism_index.after_fork()
+        passage_index.after_fork()
+        text_cache.after_fork()
+        analysis_queue.after_fork()
+        if search_indexes.ready:
+            index_sync.start_background(INDEX_SYNC_INTERVAL)
+        resources.warm_up()
+    os.register_at_fork(after_in_child=_restart_index_sync)
+    resources.share_with_forked_workers()
+
+resources.warm_up()
+
+_grammar_warm_up_pid = None
+
+@app.before_request
+def _warm_up_grammar_pool():
+    # JVMs start per process, on its first request: starting them in the gunicorn master
+    # would only leave unused servers behind once the workers fork
+    global _grammar_warm_up_pid
+    if _grammar_warm_up_pid != os.getpid() and resources.MODEL_WARM_UP != 'off':
+        _grammar_warm_up_pid = os.getpid()
+        grammar_pool.start()
+
+@app.before_request
+def _start_analysis_workers():
+    # Per process, like the grammar backends; only the process holding the queue's lock runs the pool
+    analysis_workers.start()
+
+
+# --- Readiness ---
+_mongo_state = {'checked': 0, 'state': 'unknown', 'error': None}
+
+def _mongo_status():
+    # Pinged at most every 10 seconds; a down server would otherwise stall /ready each time
     if db is None:
-        print("MongoDB connection not available. Cannot fetch data.")
-        return [], []
-
-    print("Fetching documents from MongoDB...")
-    documents = []
-    metadata_list = []
-    
+        return {'state': 'failed', 'error': 'MongoDB client could not be created.'}
+    if time.time() - _mongo_state['checked'] > 10:
+        try:
+            client.admin.command('ping')
+            _mongo_state.update(state='ready', error=None)
+        except Exception as e:
+            _mongo_state.update(state='failed', error=str(e))
+        _mongo_state['checked'] = time.time()
+    return {'state': _mongo_state['state'], 'error': _mongo_state['error']}
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    components = resources.statuses()
+    components['mongodb'] = _mongo_status()
+    # A probe must not start the LanguageTool JVMs of a worker that hasn't needed them yet
+    grammar_stats = grammar_pool.stats(start=False)
+    grammar = grammar_stats['backends']
+    components['grammar'] = {
+        'state': 'not_started' if not grammar_stats['started'] else
+                 'ready' if any(b['state'] in ('ready', 'busy') for b in grammar) else
+                 'loading' if any(b['state'] in ('starting', 'restarting') for b in grammar) else 'failed',
+        'backends': [b['state'] for b in grammar]
+    }
+    is_ready = all(component['state'] == 'ready' for component in components.values())
+    return jsonify({'ready': is_ready, 'components': components}), (200 if is_ready else 503)
+
+
+# --- Index maintenance endpoint ---
+@app.route('/index/sync', methods=['POST'])
+def sync_index():
     try:
-        theses_collection = db[COLLECTION_NAME]
-        
-        print(f"DEBUG: Checking collection: {theses_collection.full_name}")
-        total_docs = theses_collection.count_documents({})
-        print(f"DEBUG: Found {total_docs} documents in the collection.")
-        if total_docs == 0:
-            print("DEBUG: No documents found, returning empty lists.")
-            return [], []
-
-        # Project only necessary fields. If include_full_text is true, also get 'full_text'
-        # For recommendations, getting the abstract is usually sufficient to generate an embedding.
-        # However, if 'full_text' offers richer context, you might include it.
-        # For now, let's ensure 'abstract' and '_id' are always retrieved for recommendation.
-        projection = {'abstract': 1, 'title': 1, 'authorName': 1, '_id': 1}
-        if include_full_text:
-            projection['full_text'] = 1
-            
-        db_documents = theses_collection.find({}, projection)
-        
-        for doc in db_documents:
-            text_for_embedding = doc.get('abstract', '')
-            if include_full_text and doc.get('full_text'):
-                text_for_embedding = doc['full_text']
-
-            if text_for_embedding:
-                documents.append(text_for_embedding)
-                metadata_list.append({
-                    'id': str(doc['_id']),
-                    'title': doc.get('title', 'No Title'),
-                    'author': doc.get('authorName', 'Unknown Author'),
-                    'abstract': doc.get('abstract', '') # Include abstract for display in recommendations
-                })
-        print(f"Fetched {len(documents)} documents from MongoDB.")
-        return documents, metadata_list
+        search_indexes.get()  # loads the indexes on first use
+        data = request.get_json(silent=True) or {}
+        if db is None:
+            return jsonify({'error': 'MongoDB connection not available. Cannot sync index.'}), 500
+
+        # 'full' rebuilds the index from scratch (stored embeddings are reused)
+        stats = index_sync.rebuild() if data.get('full') else index_sync.sync()
+        if not index_sync.is_leader:
+            # Another process is the sync leader: it applies the changes (and runs a requested
+            # rebuild); this worker has loaded the generation it published last
+            return jsonify({
+                'changes': None,
+                'leader': False,
+                'rebuild_requested': bool(data.get('full')),
+                'total_vectors': index_sync.ntotal,
+                'generation': index_sync.generation
+            }), 202
+        if stats is None:
+            return jsonify({'error': 'Index sync failed. Please check server logs.'}), 500
+
+        return jsonify({
+            'changes': stats,
+            'total_vectors': index_sync.ntotal,
+            'generation': index_sync.generation
+        })
+
     except Exception as e:
-        print(f"Error fetching data from MongoDB: {e}")
-        return [], []
+        app.logger.error(f"Error in /index/sync endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error during index sync.'}), 500
 
 
-# This is the updated function to build the initial index using data from the DB
-def initial_data_ingestion():
-    global faiss_index, thesis_data
-    
-    # Fetch data from MongoDB instead of using dummy data
-    # We use only abstracts for semantic search index to keep it lightweight.
-    # For recommendations, abstracts are generally good enough.
-    documents, metadata_list = fetch_data_from_db(include_full_text=False)
+# --- PDF text extraction hook for new uploads ---
+@app.route('/extract-text', methods=['POST'])
+def extract_text():
+    try:
+        search_indexes.get()
+        data = request.get_json()
+        thesis_id = data.get('thesis_id')
 
-    if not documents:
-        print("No documents found in the database. Cannot build index.")
-        return
-        
-    faiss_index = create_and_save_index(documents, metadata_list)
-    thesis_data = metadata_list
+        if not thesis_id:
+            return jsonify({'error': 'No thesis_id provided.'}), 400
+        if not ObjectId.is_valid(thesis_id):
+            return jsonify({'error': 'Invalid thesis ID format.'}), 400
+        if db is None:
+            return jsonify({'error': 'MongoDB connection not available. Cannot extract text.'}), 500
 
-# Call this function to build the index on server startup if it doesn't exist
-if not load_index():
-    initial_data_ingestion()
+        with stage('extract'):
+            result = extract_thesis(db[COLLECTION_NAME], text_cache, thesis_id)
+        if result is None:
+            return jsonify({'error': 'Thesis not found.'}), 404
+
+        # The new text is what plagiarism checks and full-text search compare against from now on.
+        # Only the sync leader writes those indexes, so the thesis is handed to it; they are
+        # refreshed in the background and every worker reloads them once saved.
+        index_sync.request_refresh([thesis_id])
+        return jsonify(dict(result, thesis_id=thesis_id))
+
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        app.logger.error(f"Error in /extract-text endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error during text extraction.'}), 500
+
+
+# --- Encoder batching stats ---
+@app.route('/encoder/stats', methods=['GET'])
+def encoder_stats():
+    return jsonify(dict(query_encoder.stats(), backend=ENCODER_BACKEND, model=embedding_model_name()))
+
+
+# --- Search cache stats ---
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'index_generation': index_sync.generation,
+        'query_embeddings': query_embedding_cache.stats(),
+        'search_results': search_result_cache.stats(),
+        'passages': passage_index.stats(),
+        'readability': readability_engine.stats()
+    })
+
+
+# --- Prometheus metrics ---
+# Latency histograms per endpoint and stage (see metrics.py) plus the service's
+# counters and gauges. Index and job-queue numbers are shared by all workers and
+# read at scrape time; cache, encoder and grammar numbers are per worker (pid label).
+def _shared_gauges():
+    passages = passage_index.stats()
+    plagiarism = plagiarism_index.stats()
+    samples = [
+        ('thesis_index_vectors', 'gauge', 'Vectors in the search index.', {}, index_sync.ntotal),
+        ('thesis_index_generation', 'gauge', 'Search index generation (changes on every index update).', {}, index_sync.generation),
+        ('thesis_passages', 'gauge', 'Passages in the full-text passage index.', {}, passages['passages']),
+        ('thesis_passage_index_bytes', 'gauge', 'Bytes of passage vector codes.', {}, passages['vector_bytes']),
+        ('thesis_plagiarism_passages', 'gauge', 'Passages in the plagiarism index.', {}, plagiarism['passages']),
+    ]
+    samples += [('thesis_analysis_jobs', 'gauge', 'Analysis jobs by state.', {'state': state}, count)
+                for state, count in analysis_queue.stats().items()]
+    samples += [('thesis_resource_ready', 'gauge', 'Whether a lazily loaded resource is ready.', {'resource': name}, int(status['state'] == 'ready'))
+                for name, status in resources.statuses().items()]
+    return samples
+
+def _worker_gauges():
+    caches = {
+        'query_embeddings': query_embedding_cache.stats(),
+        'search_results': search_result_cache.stats(),
+        'readability': readability_engine.stats()
+    }
+    encoder = query_encoder.stats()
+    grammar = grammar_pool.stats(start=False)
+    samples = []
+    for name, stats in caches.items():
+        samples += [
+            ('thesis_cache_hits_total', 'counter', 'Cache hits.', {'cache': name}, stats['hits']),
+            ('thesis_cache_misses_total', 'counter', 'Cache misses.', {'cache': name}, stats['misses']),
+            ('thesis_cache_entries', 'gauge', 'Entries held by a cache.', {'cache': name}, stats['entries']),
+            ('thesis_cache_bytes', 'gauge', 'Bytes held by a cache.', {'cache': name}, stats['bytes']),
+        ]
+    samples += [
+        ('thesis_encoder_queue_depth', 'gauge', 'Texts waiting for the query encoder.', {}, encoder['queue_depth']),
+        ('thesis_encoder_batches_total', 'counter', 'Batches run by the query encoder.', {}, encoder['batches']),
+        ('thesis_encoder_texts_total', 'counter', 'Texts encoded by the query encoder.', {}, encoder['texts']),
+        # Not started in this worker yet: nothing waiting, nothing in flight
+        ('thesis_grammar_waiting_checks', 'gauge', 'Grammar checks waiting for a free backend.', {}, grammar.get('waiting_checks', 0)),
+        ('thesis_grammar_chunks_in_flight', 'gauge', 'Grammar chunks being checked.', {}, grammar.get('chunks_in_flight', 0)),
+    ]
+    return samples
+
+metrics.add_gauges(_shared_gauges)
+metrics.add_gauges(_worker_gauges, per_worker=True)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# --- Near-duplicate report for the admin dashboard ---
+@app.route('/near-duplicates', methods=['GET'])
+def near_duplicates():
+    try:
+        search_indexes.get()
+        threshold = request.args.get('threshold', DUPLICATE_THRESHOLD, type=float)
+
+        clusters = []
+        for cluster in knn_graph.duplicate_clusters(threshold):
+            theses = [
+                {'id': index_sync.metadata[f]['id'], 'title': index_sync.metadata[f]['title'], 'author': index_sync.metadata[f]['author']}
+                for f in cluster['members'] if f in index_sync.metadata
+            ]
+            if len(theses) > 1:
+                clusters.append({'theses': theses, 'max_similarity': cluster['max_score']})
+
+        return jsonify({'threshold': threshold, 'clusters': clusters})
+
+    except Exception as e:
+        app.logger.error(f"Error in /near-duplicates endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error while finding near-duplicates.'}), 500
 
 
 # Removed: --- Text Preprocessing for Topic Modeling ---
 
 
+# --- Whole-thesis analysis jobs ---
+@app.route('/analysis-jobs', methods=['POST'])
+def submit_analysis_job():
+    # {"thesis_id": ...}, {"thesis_ids": [...]} or {"all_pending": true}; poll the returned status_url
+    try:
+        data = request.get_json() or {}
+        if data.get('all_pending'):
+            if db is None:
+                return jsonify({'error': 'MongoDB connection not available. Cannot list pending theses.'}), 500
+            thesis_ids = [str(doc['_id']) for doc in db[COLLECTION_NAME].find(PENDING_QUERY, {'_id': 1})]
+            description = 'all pending theses'
+        else:
+            thesis_ids = data.get('thesis_ids') or ([data['thesis_id']] if data.get('thesis_id') else [])
+            if not thesis_ids:
+                return jsonify({'error': 'Provide thesis_id, thesis_ids or all_pending.'}), 400
+            if not isinstance(thesis_ids, list) or not all(isinstance(t, str) and ObjectId.is_valid(t) for t in thesis_ids):
+                return jsonify({'error': 'Invalid thesis ID format.'}), 400
+            description = f'{len(thesis_ids)} theses' if len(thesis_ids) > 1 else f'thesis {thesis_ids[0]}'
+
+        job_id, queued, skipped = analysis_queue.submit(thesis_ids, description)
+        return jsonify({
+            'job_id': job_id,
+            'queued': len(queued),
+            'already_queued': skipped,
+            'status_url': f'/analysis-jobs/{job_id}'
+        }), 202
+
+    except Exception as e:
+        app.logger.error(f"Error in /analysis-jobs endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error while queueing analysis.'}), 500
+
+@app.route('/analysis-jobs/<string:job_id>', methods=['GET'])
+def analysis_job_status(job_id):
+    try:
+        status = analysis_queue.status(job_id)
+        if status is None:
+            return jsonify({'error': 'Analysis job not found.'}), 404
+        return jsonify(status)
+
+    except Exception as e:
+        app.logger.error(f"Error in /analysis-jobs/{job_id} endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error while reading the analysis job.'}), 500
+
+@app.route('/analysis-jobs', methods=['GET'])
+def analysis_jobs_overview():
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({
+            'jobs': analysis_queue.recent(limit),
+            'tasks': analysis_queue.stats(),
+            'workers': analysis_workers.stats()
+        })
+
+    except Exception as e:
+        app.logger.error(f"Error in /analysis-jobs endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error while listing analysis jobs.'}), 500
+
 # Define the analysis endpoint (existing)
 @app.route('/analyze', methods=['POST'])
 def analyze_text():
@@ -185,27 +443,12 @@ def analyze_text():
         if not text:
             return jsonify({'error': 'No text provided for analysis.'}), 400
 
-        # --- Keyword Extraction with spaCy ---
-        doc = nlp(text)
-        keywords = list(set([chunk.text.lower() for chunk in doc.noun_chunks]))
-
-        # --- Summarization and Sentiment Analysis with TextBlob ---
-        blob = TextBlob(text)
-        summary_sentences = blob.sentences[:3] # Get first 3 sentences for summary
-        summary = ' '.join([str(s) for s in summary_sentences])
-
-        sentiment_score = blob.sentiment.polarity
-        sentiment = 'Neutral'
-        if sentiment_score > 0.1:
-            sentiment = 'Positive'
-        elif sentiment_score < -0.1:
-            sentiment = 'Negative'
-
-        return jsonify({
-            'summary': summary,
-            'keywords': keywords[:10],
-            'sentiment': sentiment
-        })
+        with stage('parse'):
+            parsed = documents.parse(text)
+        with stage('analyze'):
+            result = analyze_doc(text, parsed)
+        with stage('serialize'):
+            return jsonify(result)
 
     except Exception as e:
         app.logger.error(f"Error in /analyze endpoint: {e}", exc_info=True)
@@ -221,123 +464,207 @@ def check_grammar():
         if not text:
             return jsonify({'error': 'No text provided for grammar check.'}), 400
 
-        if not grammar_tool:
+        if not grammar_pool.available():
             return jsonify({'error': 'Grammar checker not initialized. Please check server logs.'}), 500
 
-        matches = grammar_tool.check(text)
-        
-        # Format grammar issues for easier consumption by frontend
-        grammar_issues = []
-        for match in matches:
-            grammar_issues.append({
-                'message': match.message,
-                'replacements': match.replacements,
-                'offset': match.offset,
-                'length': match.errorLength,
-                'ruleId': match.ruleId,
-                'context': text[max(0, match.offset - 20):match.offset + match.errorLength + 20] # Show context around the error
-            })
+        # Long texts are checked paragraph-chunk by chunk across the pool; offsets refer to text
+        with stage('grammar_check'):
+            grammar_issues = grammar_pool.check(text)
+
+        # Show context around each error for easier consumption by frontend
+        for issue in grammar_issues:
+            issue['context'] = text[max(0, issue['offset'] - 20):issue['offset'] + issue['length'] + 20]
 
         return jsonify({'issues': grammar_issues})
 
+    except GrammarUnavailable as e:
+        app.logger.error(f"Grammar checker unavailable: {e}")
+        return jsonify({'error': 'Grammar checker is busy or restarting. Please try again shortly.'}), 503
     except Exception as e:
         app.logger.error(f"Error in /check-grammar endpoint: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error during grammar check.'}), 500
 
-# --- Plagiarism Scan (Conceptual) Endpoint ---
+# --- Grammar checker health and queue metrics ---
+@app.route('/check-grammar/health', methods=['GET'])
+def grammar_health():
+    stats = grammar_pool.stats(start=False)
+    healthy = any(backend['state'] in ('ready', 'busy') for backend in stats['backends'])
+    return jsonify(dict(stats, healthy=healthy)), (200 if healthy else 503)
+
+# --- Plagiarism Scan Endpoint ---
 @app.route('/check-plagiarism', methods=['POST'])
 def check_plagiarism():
     try:
+        search_indexes.get()
         data = request.get_json()
         text_to_check = data.get('text', '')
 
         if not text_to_check:
             return jsonify({'error': 'No text provided for plagiarism check.'}), 400
 
-        # --- CONCEPTUAL PLAGIARISM CHECK ---
-        known_texts = [
-            "The quick brown fox jumps over the lazy dog.",
-            "Machine learning is a field of study that gives computers the ability to learn without being explicitly programmed. It is a subset of artificial intelligence.",
-            "This thesis explores the application of various machine learning algorithms, including Support Vector Machines and neural networks, to analyze and predict climate patterns. By leveraging historical meteorological data, the study evaluates the performance and accuracy of these models in forecasting temperature fluctuations, precipitation, and extreme weather events. The findings provide insights into the efficacy of AI-driven approaches for environmental science and highlight the potential for improving long-term climate models.",
-            "Another unrelated piece of text."
-        ]
-
-        highest_similarity = 0
-        matched_source = "No significant match found in internal conceptual database."
-
-        for i, known_text in enumerate(known_texts):
-            similarity = SequenceMatcher(None, text_to_check.lower(), known_text.lower()).ratio()
-            
-            if similarity > highest_similarity:
-                highest_similarity = similarity
-                if similarity > 0.8:
-                    matched_source = f"Conceptual internal source #{i+1} (Similarity: {highest_similarity:.2f})"
-                
-        plagiarism_status = "No Plagiarism Detected (Conceptual)"
-        if highest_similarity > 0.7:
-            plagiarism_status = "Potential Plagiarism Detected (Conceptual)"
-        if highest_similarity > 0.9:
-            plagiarism_status = "High Plagiarism Risk (Conceptual)"
-
-        return jsonify({
-            'plagiarism_score': round(highest_similarity * 100, 2), # Percentage
-            'status': plagiarism_status,
-            'matched_source': matched_source,
-            'note': 'This is a conceptual plagiarism check for demonstration purposes only. A real plagiarism checker requires a vast database and advanced algorithms.'
-        })
+        if db is None:
+            return jsonify({'error': 'MongoDB connection not available. Cannot check plagiarism.'}), 500
+
+        # LSH finds candidate theses; each candidate is confirmed by exact word 5-gram overlap.
+        # similarity = share of the submitted words inside passages found in that thesis.
+        with stage('plagiarism_check'):
+            matches = plagiarism_index.check(text_to_check)
+        highest_similarity = matches[0]['similarity'] if matches else 0
+
+        matched_source = "No significant match found in the thesis repository."
+        if matches:
+            matched_source = f"{matches[0]['title']} by {matches[0]['author']} (Overlap: {highest_similarity:.2f})"
+
+        plagiarism_status = "No Plagiarism Detected"
+        if highest_similarity > 0.15:
+            plagiarism_status = "Potential Plagiarism Detected"
+        if highest_similarity > 0.5:
+            plagiarism_status = "High Plagiarism Risk"
+
+        with stage('serialize'):
+            return jsonify({
+                'plagiarism_score': round(highest_similarity * 100, 2), # Percentage
+                'status': plagiarism_status,
+                'matched_source': matched_source,
+                'matches': matches,
+                'note': 'Compared against the theses in this repository only.'
+            })
 
     except Exception as e:
         app.logger.error(f"Error in /check-plagiarism endpoint: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error during plagiarism check.'}), 500
 
+def full_text_results(query_embedding, top_k, filters, pooling):
+    # Theses ranked by their passages (relevance_score is the pooled cosine similarity),
+    # each with its best passage cut out of the text
+    with stage('filter'):
+        allowed = hybrid_search.matching_theses(index_sync, filters)
+    with stage('passage_search'):
+        hits = passage_index.search(query_embedding, top_k, pooling, allowed)
+    with stage('mongo_passages'):
+        texts = passage_index.passage_texts(hits)
+    results = []
+    with index_sync.lock:
+        for score, thesis_id, passage in hits:
+            faiss_id = index_sync.ids.get(thesis_id)
+            document_metadata = index_sync.metadata.get(faiss_id) if faiss_id is not None else None
+            if document_metadata is None:
+                continue
+            results.append({
+                'id': thesis_id,
+                'title': document_metadata['title'],
+                'author': document_metadata['author'],
+                'relevance_score': score,
+                'passage': dict(passage, text=texts.get(thesis_id, ''))
+            })
+    return results
+
 # --- New: AI-Powered Semantic Search Endpoint ---
 @app.route('/semantic-search', methods=['POST'])
 def semantic_search():
     try:
+        with stage('load_indexes'):
+            search_indexes.get()
         data = request.get_json()
         query = data.get('query', '')
         top_k = data.get('top_k', 5) # Number of results to return
+        # filters: {"status": [...], "department": ..., "submissionYear": 2024 or {"min": .., "max": ..}}.
+        # Only approved theses are returned unless status is given (null = any status).
+        filters = data.get('filters') or {}
+        mode = data.get('mode', 'hybrid') # hybrid, vector or keyword
+        # scope "full_text" searches passages of the whole text instead of abstracts; each result
+        # then carries its best passage, and pooling picks how passages add up to a thesis score
+        scope = data.get('scope', 'abstract')
+        pooling = data.get('pooling', 'max') # max (best passage) or sum (all retrieved passages)
 
         if not query:
             return jsonify({'error': 'No query provided.'}), 400
+        if scope not in ('abstract', 'full_text'):
+            return jsonify({'error': "scope must be 'abstract' or 'full_text'."}), 400
+        if pooling not in POOLING:
+            return jsonify({'error': f"pooling must be one of: {', '.join(POOLING)}."}), 400
         
-        if faiss_index is None:
+        if index_sync.ntotal == 0:
               return jsonify({'error': 'Search index not initialized. Please check server logs.'}), 500
 
-        # Encode the user's query using the same model
-        query_embedding = search_model.encode([query])
-        
-        # Ensure the query embedding is in float32 format
-        query_embedding = np.array(query_embedding).astype('float32')
+        # Read the generation before searching: if the index changes mid-request,
+        # these results are tagged with the older generation and never served again
+        generation = index_sync.generation
+        if scope == 'full_text':
+            generation = (generation, passage_index.generation)
+        cache_key = result_key(query, top_k, {'filters': filters, 'mode': mode, 'scope': scope, 'pooling': pooling})
+        with stage('result_cache'):
+            cached_results = search_result_cache.get(cache_key, generation)
+        if cached_results is not None:
+            with stage('serialize'):
+                return jsonify({'results': cached_results})
 
-        # Perform the search on the FAISS index
-        # For IndexFlatL2, lower distance means higher similarity
-        distances, indices = faiss_index.search(query_embedding, top_k)
+        # Encode the user's query using the same model
+        # (all-MiniLM-L6-v2 is uncased, so the normalized text encodes the same)
+        normalized_query = normalize_query(query)
+        query_embedding = query_embedding_cache.get(normalized_query)
+        if query_embedding is None:
+            with stage('encode'):
+                query_embedding = query_encoder.encode([normalized_query])
+            
+            # Ensure the query embedding is in float32 format
+            query_embedding = np.array(query_embedding).astype('float32')
+            query_embedding_cache.put(normalized_query, query_embedding)
+
+        if scope == 'full_text':
+            try:
+                search_results = full_text_results(query_embedding, int(top_k), filters, pooling)
+            except FilterError as e:
+                return jsonify({'error': str(e)}), 400
+            search_result_cache.put(cache_key, search_results, generation)
+            with stage('serialize'):
+                return jsonify({'results': search_results})
+
+        # relevance_score is the fused rank score in hybrid mode, the cosine similarity
+        # in vector mode and the BM25 score in keyword mode: higher is better in all three
+        try:
+            with stage('search'):
+                hits = hybrid_search.search(index_sync, query, query_embedding, int(top_k), filters, mode)
+        except FilterError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Format the results
         search_results = []
-        for i, idx in enumerate(indices[0]):
-            document_metadata = thesis_data[idx]
-            search_results.append({
+        for score, document_metadata, details in hits:
+            search_results.append(dict({
                 'id': str(document_metadata['id']),
                 'title': document_metadata['title'],
                 'author': document_metadata['author'],
-                'relevance_score': float(distances[0][i])
-            })
+                'relevance_score': score
+            }, **details))
             
-        # Sort by relevance score (lowest distance first)
-        search_results.sort(key=lambda x: x['relevance_score'])
+        # Sort by relevance score (highest first)
+        search_results.sort(key=lambda x: x['relevance_score'], reverse=True)
+        search_result_cache.put(cache_key, search_results, generation)
 
-        return jsonify({'results': search_results})
+        with stage('serialize'):
+            return jsonify({'results': search_results})
 
     except Exception as e:
         app.logger.error(f"Error in /semantic-search endpoint: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error during semantic search.'}), 500
 
 # --- NEW AI FEATURE: Recommendation System Endpoint ---
+def format_recommendation(document_metadata, score):
+    return {
+        'id': document_metadata['id'], # Already a string from initial ingestion
+        'title': document_metadata['title'],
+        'author': document_metadata['author'],
+        # FIX: Use .get() here to prevent KeyError if 'abstract' is missing in some metadata entries
+        'abstract': document_metadata.get('abstract', 'No abstract available'),
+        'similarity_score': score # Cosine similarity, higher = more similar
+    }
+
 @app.route('/recommend-theses', methods=['POST'])
 def recommend_theses():
     try:
+        with stage('load_indexes'):
+            search_indexes.get()
         data = request.get_json()
         thesis_id = data.get('thesis_id')
         top_k = data.get('top_k', 5) # Number of recommendations to return
@@ -345,65 +672,77 @@ def recommend_theses():
         if not thesis_id:
             return jsonify({'error': 'No thesis_id provided for recommendation.'}), 400
         
-        if db is None:
-            return jsonify({'error': 'MongoDB connection not available. Cannot recommend theses.'}), 500
-        
-        if faiss_index is None or not thesis_data:
+        if index_sync.ntotal == 0:
             return jsonify({'error': 'Recommendation index not initialized. Please check server logs.'}), 500
 
-        theses_collection = db[COLLECTION_NAME]
-        
-        # 1. Fetch the target thesis's content from MongoDB
-        try:
-            target_thesis = theses_collection.find_one({'_id': ObjectId(thesis_id)}, {'abstract': 1, 'full_text': 1})
-        except InvalidId: # Catch specific exception for invalid ID format
-            return jsonify({'error': 'Invalid thesis ID format.'}), 400
-        except Exception:
-            return jsonify({'error': 'Database error when fetching target thesis.'}), 500
-
-
-        if not target_thesis:
-            return jsonify({'error': 'Target thesis not found in the database.'}), 404
-
-        # Prioritize full_text if available, otherwise use abstract for embedding
-        target_text = target_thesis.get('full_text') or target_thesis.get('abstract', '')
-        
-        if not target_text:
-            return jsonify({'error': 'Target thesis has no content to generate recommendations.'}), 400
-
-        # 2. Generate embedding for target thesis
-        target_embedding = search_model.encode([target_text])
-        target_embedding = np.array(target_embedding).astype('float32')
+        # Answer straight from the precomputed k-NN table when it has a row for this thesis
+        faiss_id = index_sync.ids.get(str(thesis_id))
+        with stage('knn_lookup'):
+            neighbours = knn_graph.lookup(faiss_id, top_k) if faiss_id is not None else None
+        if neighbours is not None:
+            recommended_theses = [
+                format_recommendation(index_sync.metadata[int(f)], float(score))
+                for f, score in zip(*neighbours) if int(f) in index_sync.metadata
+            ]
+            with stage('serialize'):
+                return jsonify({'recommendations': recommended_theses[:top_k]})
+
+        # 1. Reuse the thesis's stored embedding: no MongoDB round trip and no model inference
+        target_embedding = index_sync.vector_for(str(thesis_id))
+
+        if target_embedding is None:
+            # Not indexed yet (or no stored vector): fall back to fetching and encoding it
+            if db is None:
+                return jsonify({'error': 'MongoDB connection not available. Cannot recommend theses.'}), 500
+
+            theses_collection = db[COLLECTION_NAME]
+            try:
+                with stage('mongo_find_one'):
+                    target_thesis = theses_collection.find_one({'_id': ObjectId(thesis_id)}, {'abstract': 1, 'full_text': 1})
+            except InvalidId: # Catch specific exception for invalid ID format
+                return jsonify({'error': 'Invalid thesis ID format.'}), 400
+            except Exception:
+                return jsonify({'error': 'Database error when fetching target thesis.'}), 500
+
+            if not target_thesis:
+                return jsonify({'error': 'Target thesis not found in the database.'}), 404
+
+            # Encode the same text the index uses (the abstract), so the cached vector
+            # is picked up by the next index sync; full_text only when there is no abstract
+            target_text = embedding_text(target_thesis) or source_text(target_thesis)
+
+            if not target_text:
+                return jsonify({'error': 'Target thesis has no content to generate recommendations.'}), 400
+
+            # 2. Generate embedding for target thesis and keep it for next time
+            with stage('encode'):
+                target_embedding = query_encoder.encode([target_text])
+            target_embedding = np.array(target_embedding).astype('float32')
+            embedding_store.put(str(thesis_id), content_hash(target_text), target_embedding[0])
 
         # 3. Perform search on FAISS index
         # We search for top_k + 1 to account for the possibility of the target thesis itself being in the results
-        distances, indices = faiss_index.search(target_embedding, top_k + 1)
+        with stage('search'):
+            hits = index_sync.search(target_embedding, top_k + 1)
         
         recommended_theses = []
         target_mongo_id_str = str(thesis_id) # Convert to string for comparison
 
         # 4. Format results and filter out the target thesis
-        for i, idx in enumerate(indices[0]):
-            document_metadata = thesis_data[idx]
+        for score, document_metadata in hits:
             
             # Ensure we don't recommend the thesis itself
             if str(document_metadata['id']) != target_mongo_id_str:
-                recommended_theses.append({
-                    'id': document_metadata['id'], # Already a string from initial ingestion
-                    'title': document_metadata['title'],
-                    'author': document_metadata['author'],
-                    # FIX: Use .get() here to prevent KeyError if 'abstract' is missing in some metadata entries
-                    'abstract': document_metadata.get('abstract', 'No abstract available'), 
-                    'similarity_score': float(distances[0][i]) # Lower distance = higher similarity
-                })
+                recommended_theses.append(format_recommendation(document_metadata, score))
             
             if len(recommended_theses) >= top_k:
                 break
         
-        # Sort by similarity score (lowest distance first for IndexFlatL2)
-        recommended_theses.sort(key=lambda x: x['similarity_score'])
+        # Sort by similarity score (highest first)
+        recommended_theses.sort(key=lambda x: x['similarity_score'], reverse=True)
 
-        return jsonify({'recommendations': recommended_theses})
+        with stage('serialize'):
+            return jsonify({'recommendations': recommended_theses})
 
     except Exception as e:
         app.logger.error(f"Error in /recommend-theses endpoint: {e}", exc_info=True)
@@ -437,26 +776,27 @@ def get_thesis_by_id(thesis_id):
 
         # Fetch the document by its _id.
         # Project all necessary fields for the ThesisDetailPage.jsx
-        thesis = theses_collection.find_one(
-            {'_id': object_id},
-            {
-                '_id': 1, 
-                'title': 1, 
-                'authorName': 1, 
-                'abstract': 1, 
-                'publicationDate': 1, 
-                'keywords': 1, 
-                'full_text': 1,
-                'department': 1,     # Added
-                'submissionYear': 1,   # Added
-                'status': 1,           # Added
-                'analysisStatus': 1,   # Added for AI Analysis Section
-                'aiSummary': 1,      # Added for AI Analysis Section
-                'aiKeywords': 1,       # Added for AI Analysis Section
-                'aiSentiment': 1,      # Added for AI Analysis Section
-                'filePath': 1            # Added for Download PDF link
-            }
-        )
+        with stage('mongo_find_one'):
+            thesis = theses_collection.find_one(
+                {'_id': object_id},
+                {
+                    '_id': 1, 
+                    'title': 1, 
+                    'authorName': 1, 
+                    'abstract': 1, 
+                    'publicationDate': 1, 
+                    'keywords': 1, 
+                    'full_text': 1,
+                    'department': 1,     # Added
+                    'submissionYear': 1,   # Added
+                    'status': 1,           # Added
+                    'analysisStatus': 1,   # Added for AI Analysis Section
+                    'aiSummary': 1,      # Added for AI Analysis Section
+                    'aiKeywords': 1,       # Added for AI Analysis Section
+                    'aiSentiment': 1,      # Added for AI Analysis Section
+                    'filePath': 1            # Added for Download PDF link
+                }
+            )
         
         # --- ADDED LOGGING START ---
         if thesis:
@@ -477,52 +817,62 @@ def get_thesis_by_id(thesis_id):
         app.logger.error(f"An unexpected error occurred in /theses/<id> endpoint for ID {thesis_id}: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error fetching thesis details.'}), 500
 
+# Readability scores come from one counting pass per text (textstat's rules, same numbers),
+# cached by content hash; see readability.py
+readability_engine = ReadabilityEngine()
+
+def readability_scores(text):
+    return readability_engine.scores(text)
+
 # --- NEW AI FEATURE: Readability Score Analysis ---
+# Optional per-chapter scores: "by_chapter": true splits the text at its chapter headings,
+# or the document is sent as "chapters": ["...", ...] / [{"title": ..., "text": ...}, ...]
 @app.route('/readability', methods=['POST'])
 def get_readability_scores():
     try:
         data = request.get_json()
         text = data.get('text', '')
+        chapters = data.get('chapters')
+
+        if chapters:
+            if not isinstance(chapters, list):
+                return jsonify({'error': 'chapters must be a list of texts or {"title", "text"} objects.'}), 400
+            texts = [c.get('text', '') if isinstance(c, dict) else str(c) for c in chapters]
+            titles = [(c.get('title') if isinstance(c, dict) else None) or f'Chapter {i + 1}'
+                      for i, c in enumerate(chapters)]
+            with stage('readability'):
+                return jsonify(readability_engine.score_chunks(texts, titles))
 
         if not text:
             return jsonify({'error': 'No text provided for readability analysis.'}), 400
 
-        # Calculate various readability scores
-        flesch_reading_ease = textstat.flesch_reading_ease(text)
-        flesch_kincaid_grade = textstat.flesch_kincaid_grade(text)
-        gunning_fog = textstat.gunning_fog(text)
-        smog_index = textstat.smog_index(text)
-        automated_readability_index = textstat.automated_readability_index(text)
-        dale_chall_readability_score = textstat.dale_chall_readability_score(text)
-        
-        return jsonify({
-            'flesch_reading_ease': flesch_reading_ease,
-            'flesch_kincaid_grade': flesch_kincaid_grade,
-            'gunning_fog': gunning_fog,
-            'smog_index': smog_index,
-            'automated_readability_index': automated_readability_index,
-            'dale_chall_readability_score': dale_chall_readability_score,
-            'note': 'Lower Flesch Reading Ease means harder to read. Other scores represent grade levels.'
-        })
+        with stage('readability'):
+            return jsonify(readability_engine.scores(text, by_chapter=bool(data.get('by_chapter'))))
 
     except Exception as e:
         app.logger.error(f"Error in /readability endpoint: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error during readability analysis.'}), 500
 
 
-# --- NEW AI FEATURE: Automated Tagging / Keyword Suggestion (Conceptual) ---
-# This is a conceptual example. In a real scenario, you'd train an ML model.
-PREDEFINED_TAGS = {
-    "Artificial Intelligence": ["ai", "machine learning", "deep learning", "neural network", "computer vision", "nlp", "natural language processing", "robotics"],
-    "Computer Science": ["algorithm", "data structure", "software engineering", "programming", "cybersecurity", "networking", "database"],
-    "Engineering": ["electrical engineering", "mechanical engineering", "civil engineering", "aerospace engineering", "materials science", "robotics"],
-    "Environmental Science": ["climate change", "sustainability", "ecology", "pollution", "conservation", "renewable energy"],
-    "Medical Science": ["medicine", "biology", "biotechnology", "genetics", "pharmaceuticals", "public health", "disease"],
-    "Social Science": ["sociology", "psychology", "economics", "political science", "anthropology", "education"],
-    "Mathematics": ["algebra", "calculus", "statistics", "geometry", "numerical analysis", "optimization"],
-    "Physics": ["quantum physics", "astrophysics", "thermodynamics", "optics", "mechanics"],
-    "Chemistry": ["organic chemistry", "inorganic chemistry", "biochemistry", "analytical chemistry", "materials chemistry"]
-}
+# --- NEW AI FEATURE: Automated Tagging / Keyword Suggestion ---
+# The taxonomy (tag -> keywords) is read from tag_taxonomy.json and compiled into a word-level
+# Aho-Corasick matcher; edits to the file are picked up without a restart (see tag_engine.py).
+# mode "embedding" instead ranks tags by similarity to per-tag centroid embeddings.
+tag_engine = TagEngine(encode=encode)
+tag_engine.load()
+
+def predefined_tags_for(text):
+    # Tags with a whole-word keyword match anywhere in the text (one pass over the text)
+    return tag_engine.match(text)
+
+def fallback_tags(parsed):
+    # If no direct keyword matches, use spaCy to find noun chunks as general tags
+    fallback_keywords = parsed.noun_chunks
+    # Limit fallback keywords to a reasonable number
+    return [kw.title() for kw in fallback_keywords[:5] if len(kw) > 2]
+
+def suggest_tags_for(text, parsed):
+    return {'suggested_tags': predefined_tags_for(text) or fallback_tags(parsed)}
 
 @app.route('/suggest-tags', methods=['POST'])
 def suggest_tags():
@@ -533,22 +883,21 @@ def suggest_tags():
         if not text:
             return jsonify({'error': 'No text provided for tag suggestion.'}), 400
 
-        text_lower = text.lower()
-        suggested = []
+        if data.get('mode') == 'embedding':
+            with stage('encode'):
+                query_embedding = query_encoder.encode([text])[0]
+            scored = tag_engine.classify(query_embedding)
+            return jsonify({
+                'suggested_tags': [tag for tag, _ in scored],
+                'scores': {tag: score for tag, score in scored}
+            })
 
-        for tag, keywords in PREDEFINED_TAGS.items():
-            # Check if any of the keywords for a tag are present in the text
-            # A more robust approach would use NLP features like TF-IDF or embeddings
-            if any(keyword in text_lower for keyword in keywords):
-                suggested.append(tag)
-        
+        with stage('tag_match'):
+            suggested = predefined_tags_for(text)
         if not suggested:
-            # If no direct keyword matches, use spaCy to find noun chunks as general tags
-            doc = nlp(text)
-            fallback_keywords = list(set([chunk.text.lower() for chunk in doc.noun_chunks]))
-            # Limit fallback keywords to a reasonable number
-            suggested.extend([kw.title() for kw in fallback_keywords[:5] if len(kw) > 2])
-
+            with stage('parse'):
+                parsed = documents.parse(text)
+            suggested = fallback_tags(parsed)
 
         return jsonify({'suggested_tags': suggested})
 
@@ -556,6 +905,169 @@ def suggest_tags():
         app.logger.error(f"Error in /suggest-tags endpoint: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error during tag suggestion.'}), 500
 
+
+@app.route('/tags/reload', methods=['POST'])
+def reload_tags():
+    try:
+        return jsonify(tag_engine.load())
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Could not load tag taxonomy: {e}'}), 400
+
+
+# --- Batch NLP endpoints ---
+# /analyze/batch, /suggest-tags/batch and /readability/batch take
+#   {"texts": [...]} or {"thesis_ids": [...]}, plus optional "batch_size" and "n_process",
+# run spaCy over the whole batch with nlp.pipe and stream one JSON line per item
+# (application/x-ndjson) as soon as it is ready:
+#   {"index": 0, "thesis_id": "...", "result": {...}}   or   {"index": 1, "error": "..."}
+# A bad item only produces an error line; the rest of the batch carries on.
+NLP_BATCH_SIZE = int(os.environ.get("NLP_BATCH_SIZE", 32))
+NLP_N_PROCESS = int(os.environ.get("NLP_N_PROCESS", 1))
+NLP_BATCH_MAX_ITEMS = int(os.environ.get("NLP_BATCH_MAX_ITEMS", 10000))
+THESIS_FETCH_CHUNK = 100
+
+def _ndjson(index, thesis_id, result=None, error=None):
+    line = {'index': index}
+    if thesis_id is not None:
+        line['thesis_id'] = thesis_id
+    if error is not None:
+        line['error'] = error
+    else:
+        line['result'] = result
+    return json.dumps(line, default=str) + '\n'
+
+def _batch_items(texts, thesis_ids):
+    # (index, thesis_id, text, error) per requested item; theses are fetched lazily in chunks
+    if texts is not None:
+        for index, text in enumerate(texts):
+            if isinstance(text, str) and text.strip():
+                yield index, None, text, None
+            else:
+                yield index, None, None, 'No text provided.'
+        return
+
+    collection = db[COLLECTION_NAME]
+    for start in range(0, len(thesis_ids), THESIS_FETCH_CHUNK):
+        chunk = thesis_ids[start:start + THESIS_FETCH_CHUNK]
+        try:
+            object_ids = [ObjectId(t) for t in chunk if isinstance(t, str) and ObjectId.is_valid(t)]
+            found = {str(doc['_id']): doc for doc in collection.find(
+                {'_id': {'$in': object_ids}}, {'full_text': 1, 'abstract': 1})}
+        except Exception as e:
+            app.logger.error(f"Error fetching theses for batch: {e}", exc_info=True)
+            for offset, thesis_id in enumerate(chunk):
+                yield start + offset, thesis_id, None, 'Could not fetch thesis.'
+            continue
+        for offset, thesis_id in enumerate(chunk):
+            doc = found.get(thesis_id)
+            if not isinstance(thesis_id, str) or not ObjectId.is_valid(thesis_id):
+                yield start + offset, thesis_id, None, 'Invalid thesis ID format.'
+            elif doc is None:
+                yield start + offset, thesis_id, None, 'Thesis not found.'
+            elif not source_text(doc):
+                yield start + offset, thesis_id, None, 'Thesis has no text to analyze.'
+            else:
+                yield start + offset, thesis_id, source_text(doc), None
+
+def _stream_batch(items, handler, batch_size, n_process, needs_doc):
+    # handler(text, parsed) -> result. Texts for which needs_doc(text) is false skip spaCy (parsed=None);
+    # texts parsed before come from the document cache, very long ones are parsed in segments.
+    ready = deque()       # lines for items that never reach the pipe
+    inflight = deque()    # (text, (index, thesis_id)) handed to nlp.pipe, not yet returned
+
+    def handle(text, context, parsed):
+        index, thesis_id = context
+        try:
+            return _ndjson(index, thesis_id, result=handler(text, parsed))
+        except Exception as e:
+            app.logger.error(f"Error processing batch item {index}: {e}", exc_info=True)
+            return _ndjson(index, thesis_id, error='Processing failed for this item.')
+
+    def to_parse():
+        for index, thesis_id, text, error in items:
+            if error is not None:
+                ready.append(_ndjson(index, thesis_id, error=error))
+            elif not needs_doc(text):
+                ready.append(handle(text, (index, thesis_id), None))
+            elif documents.cached(text) is not None or documents.needs_segments(text):
+                try:
+                    ready.append(handle(text, (index, thesis_id), documents.parse(text)))
+                except Exception as e:
+                    ready.append(_ndjson(index, thesis_id, error=f'Text could not be parsed: {e}'))
+            else:
+                inflight.append((text, (index, thesis_id)))
+                yield text, (index, thesis_id)
+
+    pending = to_parse()
+    while True:
+        try:
+            for doc, context in nlp.get().pipe(pending, as_tuples=True, batch_size=batch_size, n_process=n_process):
+                text, _ = inflight.popleft()
+                while ready:
+                    yield ready.popleft()
+                yield handle(text, context, documents.remember(text, [(0, doc)]))
+            break
+        except Exception as e:
+            # One text broke its batch: redo that batch
+            # item by item, then resume piping the rest
+            if not inflight:
+                raise
+            app.logger.error(f"nlp.pipe failed, retrying batch item by item: {e}")
+            while inflight:
+                text, (index, thesis_id) = inflight.popleft()
+                try:
+                    parsed = documents.parse(text)
+                except Exception as item_error:
+                    yield _ndjson(index, thesis_id, error=f'Text could not be parsed: {item_error}')
+                    continue
+                yield handle(text, (index, thesis_id), parsed)
+    while ready:
+        yield ready.popleft()
+
+def _batch_endpoint(name, handler, needs_doc):
+    try:
+        data = request.get_json(silent=True) or {}
+        texts = data.get('texts')
+        thesis_ids = data.get('thesis_ids')
+
+        if not isinstance(texts, list) and not isinstance(thesis_ids, list):
+            return jsonify({'error': 'Provide a list of "texts" or "thesis_ids".'}), 400
+        if isinstance(texts, list):
+            thesis_ids = None
+        elif db is None:
+            return jsonify({'error': 'MongoDB connection not available. Cannot fetch theses.'}), 500
+        if len(texts if texts is not None else thesis_ids) > NLP_BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {NLP_BATCH_MAX_ITEMS} items per batch.'}), 400
+
+        batch_size = max(1, int(data.get('batch_size', NLP_BATCH_SIZE)))
+        n_process = max(1, min(int(data.get('n_process', NLP_N_PROCESS)), os.cpu_count() or 1))
+
+    except (TypeError, ValueError):
+        return jsonify({'error': 'batch_size and n_process must be integers.'}), 400
+
+    def generate():
+        try:
+            yield from _stream_batch(_batch_items(texts, thesis_ids), handler, batch_size, n_process, needs_doc)
+        except Exception as e:
+            app.logger.error(f"Error in /{name}/batch endpoint: {e}", exc_info=True)
+            yield json.dumps({'error': f'Internal server error during batch {name}.'}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    return _batch_endpoint('analyze', analyze_doc, needs_doc=lambda text: True)
+
+@app.route('/suggest-tags/batch', methods=['POST'])
+def suggest_tags_batch():
+    # Only texts without a predefined tag match need the noun-chunk fallback (and a parse)
+    return _batch_endpoint('suggest-tags', suggest_tags_for, needs_doc=lambda text: not predefined_tags_for(text))
+
+@app.route('/readability/batch', methods=['POST'])
+def readability_batch():
+    # Readability never needs a parse, so the handler ignores the (always None) parsed argument
+    return _batch_endpoint('readability', lambda text, parsed: readability_scores(text), needs_doc=lambda text: False)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5002))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,101 @@
+# --- ANN index benchmark ---
+# Compares the index types from ann_index.py on synthetic corpora shaped like
+# all-MiniLM-L6-v2 embeddings (384 dims, clustered, normalized). For each
+# corpus size it reports recall@k against the exact Flat index, p50/p99
+# single-query latency, build time and serialized index size.
+#
+#   python benchmark_index.py                          # 10k and 100k vectors
+#   python benchmark_index.py --sizes 10000 100000 1000000 --json results.json
+import argparse
+import json
+import time
+
+import numpy as np
+
+import ann_index
+
+DIMENSION = 384
+
+
+def synthetic_corpus(n, d, n_queries, seed=0):
+    # Theses cluster by topic, so points are drawn around a few hundred centers
+    rng = np.random.default_rng(seed)
+    n_topics = max(10, int(np.sqrt(n)))
+    centers = rng.standard_normal((n_topics, d)).astype('float32')
+    corpus = np.empty((n, d), dtype='float32')
+    for start in range(0, n, 100000):
+        stop = min(n, start + 100000)
+        topics = rng.integers(0, n_topics, stop - start)
+        corpus[start:stop] = centers[topics] + 0.6 * rng.standard_normal((stop - start, d)).astype('float32')
+    topics = rng.integers(0, n_topics, n_queries)
+    queries = centers[topics] + 0.6 * rng.standard_normal((n_queries, d)).astype('float32')
+    return ann_index.normalize(corpus), ann_index.normalize(queries)
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / float(len(truth) * k)
+
+
+def benchmark(index_type, corpus, queries, truth, k):
+    n, d = corpus.shape
+    started = time.perf_counter()
+    train = corpus[:ann_index.training_size(index_type, n)]
+    index = ann_index.create_index(d, n, train, index_type=index_type)
+    index.add_with_ids(corpus, np.arange(n, dtype='int64'))
+    build_seconds = time.perf_counter() - started
+
+    # One query per call, the way the Flask endpoints search
+    latencies = []
+    found = []
+    for query in queries:
+        started = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found.append(ids[0])
+
+    return {
+        'index_type': ann_index.index_type_of(index),
+        'n': n,
+        'recall_at_k': round(recall_at_k(found, truth, k), 4),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'build_seconds': round(build_seconds, 2),
+        'memory_mb': round(ann_index.memory_bytes(index) / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types on synthetic thesis embeddings.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--types', nargs='+', default=list(ann_index.INDEX_TYPES), choices=ann_index.INDEX_TYPES)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--dimension', type=int, default=DIMENSION)
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'type':<10}{'n':>9}{'recall@' + str(args.k):>11}{'p50 ms':>9}{'p99 ms':>9}{'build s':>9}{'MB':>8}")
+    for n in args.sizes:
+        corpus, queries = synthetic_corpus(n, args.dimension, args.queries)
+        # Ground truth comes from the exact inner-product scan
+        exact = ann_index.create_index(args.dimension, n, index_type='flat')
+        exact.add_with_ids(corpus, np.arange(n, dtype='int64'))
+        _, truth = exact.search(queries, args.k)
+        del exact
+
+        for index_type in args.types:
+            row = benchmark(index_type, corpus, queries, truth, args.k)
+            row['requested_type'] = index_type
+            results.append(row)
+            print(f"{row['index_type']:<10}{n:>9}{row['recall_at_k']:>11.4f}{row['p50_ms']:>9.3f}"
+                  f"{row['p99_ms']:>9.3f}{row['build_seconds']:>9.2f}{row['memory_mb']:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'k': args.k, 'queries': args.queries, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
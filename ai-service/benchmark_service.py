@@ -0,0 +1,675 @@
+# --- Service benchmark and load test ---
+# Measures ai-service offline, so a change can be compared before and after:
+#
+#   python benchmark_service.py corpus --theses 2000 --pdfs 50 --out bench_corpus
+#   python benchmark_service.py micro --corpus bench_corpus --json micro.json
+#   python benchmark_service.py load --corpus bench_corpus --concurrency 8 --duration 30 --json load.json
+#   python benchmark_service.py compare before.json after.json
+#
+# corpus   writes a synthetic thesis corpus (bench_corpus/theses.json: titles, abstracts,
+#          chaptered full texts with some copied paragraphs, departments, years) and PDFs
+#          of the first --pdfs theses for /extract-text. The same --seed gives the same corpus.
+# micro    times the building blocks in-process: query and batch encoding, index build,
+#          vector search, spaCy analysis, readability and tagging
+# load     starts app.py on a local port against the corpus and drives its endpoints with
+#          --concurrency HTTP clients; reports throughput and p50/p95/p99 per endpoint.
+#          --isolate runs one endpoint at a time; --url drives a server that is already
+#          running (gunicorn, staging) whose database was filled with `seed`.
+# seed     loads the corpus into a MongoDB database (--mongo-uri, --db)
+# compare  lists the metrics of the second run that are worse than the first by more than
+#          --tolerance, and exits with status 1 if there are any
+#
+# In-process, the app reads the corpus from mongomock, an in-memory MongoDB stand-in
+# (pip install mongomock; not a service dependency), or from --mongo-uri. Its index
+# files go to a temporary directory. Nothing is downloaded: the model must already be
+# in the Hugging Face cache (or exported, for ENCODER_BACKEND=onnx-int8).
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+CORPUS_FILE = 'theses.json'
+BENCH_DB_NAME = os.environ.get("BENCH_DB_NAME", "thesis_benchmark")
+
+# --- Synthetic corpus ---
+TOPICS = {
+    'Computer Science': ['neural', 'network', 'machine', 'learning', 'algorithm', 'graph', 'database', 'compiler',
+                         'distributed', 'security', 'encryption', 'classification', 'dataset', 'software', 'cloud'],
+    'Electrical Engineering': ['power', 'grid', 'voltage', 'signal', 'antenna', 'circuit', 'converter', 'wireless',
+                               'transmission', 'renewable', 'solar', 'inverter', 'battery', 'frequency', 'sensor'],
+    'Civil Engineering': ['concrete', 'structural', 'bridge', 'soil', 'seismic', 'traffic', 'pavement', 'hydraulic',
+                          'beam', 'foundation', 'steel', 'flood', 'urban', 'drainage', 'load'],
+    'Business Administration': ['market', 'customer', 'finance', 'investment', 'brand', 'supply', 'chain', 'banking',
+                                'strategy', 'management', 'retail', 'employee', 'performance', 'growth', 'risk'],
+    'English': ['novel', 'poetry', 'narrative', 'colonial', 'identity', 'discourse', 'translation', 'drama',
+                'renaissance', 'feminist', 'memory', 'language', 'literature', 'myth', 'voice'],
+    'Pharmacy': ['drug', 'protein', 'gene', 'clinical', 'patients', 'bacterial', 'cell', 'dose', 'tumour',
+                 'enzyme', 'formulation', 'toxicity', 'plant', 'extract', 'antibiotic'],
+}
+ACADEMIC_WORDS = ['study', 'analysis', 'results', 'method', 'approach', 'data', 'proposed', 'significant',
+                  'evaluation', 'framework', 'experiment', 'impact', 'effect', 'system', 'design', 'model',
+                  'observed', 'compared', 'improved', 'existing', 'research', 'findings', 'process', 'factors',
+                  'relationship', 'techniques', 'quality', 'efficient', 'measured', 'considered']
+FUNCTION_WORDS = ['the', 'of', 'and', 'in', 'to', 'a', 'for', 'with', 'on', 'is', 'that', 'by', 'this', 'are']
+CHAPTER_TITLES = ['Introduction', 'Literature Review', 'Methodology', 'Results and Discussion', 'Conclusion']
+FIRST_NAMES = ['Shuvo', 'Ayesha', 'Rahim', 'Nusrat', 'Tanvir', 'Farhana', 'Imran', 'Sadia', 'Arif', 'Maliha']
+LAST_NAMES = ['Roy', 'Rahman', 'Hossain', 'Akter', 'Islam', 'Chowdhury', 'Ahmed', 'Khan', 'Das', 'Sarker']
+
+
+def _sentence(rng, topic_words, low=10, high=26):
+    words = []
+    for _ in range(rng.randint(low, high)):
+        roll = rng.random()
+        pool = topic_words if roll < 0.35 else ACADEMIC_WORDS if roll < 0.8 else FUNCTION_WORDS
+        words.append(rng.choice(pool))
+    return ' '.join(words).capitalize() + '.'
+
+
+def _paragraph(rng, topic_words):
+    return ' '.join(_sentence(rng, topic_words) for _ in range(rng.randint(4, 8)))
+
+
+def synthetic_thesis(rng, number, full_text_words, paragraph_pool, copy_rate):
+    department = rng.choice(sorted(TOPICS))
+    topic_words = TOPICS[department]
+    abstract = ' '.join(_sentence(rng, topic_words) for _ in range(rng.randint(6, 10)))
+
+    chapters = []
+    per_chapter = max(full_text_words // len(CHAPTER_TITLES), 1)
+    for chapter, title in enumerate(CHAPTER_TITLES, 1):
+        paragraphs, chapter_words = [], 0
+        while chapter_words < per_chapter:
+            if paragraph_pool and rng.random() < copy_rate:
+                paragraph = rng.choice(paragraph_pool)    # copied from an earlier thesis
+            else:
+                paragraph = _paragraph(rng, topic_words)
+                if len(paragraph_pool) < 5000:
+                    paragraph_pool.append(paragraph)
+            paragraphs.append(paragraph)
+            chapter_words += len(paragraph.split())
+        chapters.append(f"CHAPTER {chapter} {title}\n\n" + '\n\n'.join(paragraphs))
+
+    title_words = rng.sample(topic_words, 3)
+    return {
+        '_id': f'{number + 1:024x}',
+        'title': f"A Study of {title_words[0].title()} {title_words[1].title()} in {title_words[2].title()} Systems",
+        'authorName': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        'abstract': abstract,
+        'full_text': '\n\n'.join(chapters),
+        'keywords': rng.sample(topic_words, 4),
+        'department': department,
+        'submissionYear': rng.randint(2015, 2025),
+        'status': rng.choices(['approved', 'pending', 'rejected'], weights=[85, 10, 5])[0],
+    }
+
+
+def search_queries(rng, count):
+    # Short topic phrases, the shape of real search box input; repeated ones exercise the caches
+    queries = []
+    for _ in range(count):
+        topic_words = TOPICS[rng.choice(sorted(TOPICS))]
+        queries.append(' '.join(rng.sample(topic_words, rng.randint(1, 3))))
+    return queries
+
+
+def write_pdf(path, text):
+    import pymupdf
+
+    with pymupdf.open() as document:
+        for start in range(0, len(text), 2500):
+            page = document.new_page()
+            page.insert_textbox(pymupdf.Rect(50, 50, 545, 792), text[start:start + 2500], fontsize=8)
+        document.save(path)
+
+
+def generate_corpus(out, theses, pdfs, full_text_words, copy_rate, n_queries, seed):
+    rng = random.Random(seed)
+    os.makedirs(out, exist_ok=True)
+    paragraph_pool = []
+    docs = [synthetic_thesis(rng, i, full_text_words, paragraph_pool, copy_rate) for i in range(theses)]
+    if pdfs:
+        os.makedirs(os.path.join(out, 'pdfs'), exist_ok=True)
+    for doc in docs[:pdfs]:
+        doc['filePath'] = os.path.join('pdfs', f"{doc['_id']}.pdf")
+        write_pdf(os.path.join(out, doc['filePath']), doc['full_text'])
+    corpus = {'seed': seed, 'theses': docs, 'queries': search_queries(rng, n_queries)}
+    with open(os.path.join(out, CORPUS_FILE), 'w') as f:
+        json.dump(corpus, f)
+    print(f"Wrote {len(docs)} theses ({sum(len(d['full_text'].split()) for d in docs)} words of full text), "
+          f"{min(pdfs, len(docs))} PDFs and {n_queries} queries to {out}.")
+    return corpus
+
+
+def read_corpus(directory):
+    with open(os.path.join(directory, CORPUS_FILE)) as f:
+        corpus = json.load(f)
+    corpus['directory'] = os.path.abspath(directory)
+    return corpus
+
+
+def seed_collection(collection, corpus):
+    # Replaces the collection's contents with the corpus; PDF paths become absolute
+    from bson.objectid import ObjectId
+
+    documents = []
+    for doc in corpus['theses']:
+        doc = dict(doc, _id=ObjectId(doc['_id']))
+        if doc.get('filePath'):
+            doc['filePath'] = os.path.join(corpus['directory'], doc['filePath'])
+        documents.append(doc)
+    collection.delete_many({})
+    for start in range(0, len(documents), 1000):
+        collection.insert_many(documents[start:start + 1000])
+    print(f"Loaded {len(documents)} theses into {collection.full_name}.")
+
+
+# --- Timing helpers ---
+def summarize(latencies_ms, seconds, errors=0):
+    latencies = np.asarray(latencies_ms, dtype='float64')
+    if not len(latencies):
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': int(len(latencies)),
+        'errors': errors,
+        'error_rate': round(errors / len(latencies), 4),
+        'per_second': round(len(latencies) / seconds, 2) if seconds > 0 else 0,
+        'mean_ms': round(float(latencies.mean()), 3),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'max_ms': round(float(latencies.max()), 3),
+    }
+
+
+def time_calls(function, items):
+    # The first item is run once untimed, so one-off costs (lazy loads, cold word caches) aren't counted
+    if items:
+        function(items[0])
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        call_started = time.perf_counter()
+        function(item)
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'encoder_backend': os.environ.get("ENCODER_BACKEND", "torch"),
+        'index_type': os.environ.get("INDEX_TYPE", "auto"),
+    }
+
+
+# --- Micro-benchmarks ---
+def micro_benchmarks(corpus, n_queries, n_texts, n_full_texts, index_size, k):
+    import ann_index
+    from doc_analysis import DocumentAnalyzer, load_pipeline, analyze_doc
+    from encoder_backends import load_model
+    from readability import ReadabilityEngine
+    from tag_engine import TagEngine
+
+    theses = corpus['theses']
+    abstracts = [d['abstract'] for d in theses[:n_texts]]
+    full_texts = [d['full_text'] for d in theses[:n_full_texts]]
+    queries = corpus['queries'][:n_queries]
+    results = {}
+
+    def run(name, benchmark):
+        print(f"  {name} ...", flush=True)
+        try:
+            results[name] = benchmark()
+        except (ImportError, OSError, RuntimeError) as e:
+            print(f"  {name} skipped: {e}")
+            results[name] = {'skipped': str(e)}
+
+    state = {}
+
+    def encode_query():
+        state['model'] = model = load_model()
+        return time_calls(lambda q: model.encode([q]), queries)
+
+    def encode_batch():
+        model = state.get('model') or load_model()
+        batches = [abstracts[i:i + 64] for i in range(0, len(abstracts), 64)]
+        result = time_calls(lambda batch: model.encode(batch, batch_size=64), batches)
+        result['texts_per_second'] = round(result['per_second'] * len(abstracts) / len(batches), 1)
+        state['vectors'] = ann_index.normalize(np.asarray(model.encode(abstracts, batch_size=64), dtype='float32'))
+        state['queries'] = ann_index.normalize(np.asarray(model.encode(queries, batch_size=64), dtype='float32'))
+        return result
+
+    def index_build():
+        vectors = state.get('vectors')
+        if vectors is None:
+            raise RuntimeError("needs the encoder benchmarks")
+        # Corpora bigger than the sample are made of jittered copies of its vectors
+        rng = np.random.default_rng(0)
+        n = max(index_size, len(vectors))
+        corpus_vectors = vectors[np.arange(n) % len(vectors)]
+        corpus_vectors = ann_index.normalize(corpus_vectors + 0.05 * rng.standard_normal(corpus_vectors.shape).astype('float32'))
+        started = time.perf_counter()
+        index_type = ann_index.choose_index_type(n)
+        train = corpus_vectors[:ann_index.training_size(index_type, n)]
+        index = ann_index.create_index(corpus_vectors.shape[1], n, train, index_type=index_type)
+        index.add_with_ids(corpus_vectors, np.arange(n, dtype='int64'))
+        seconds = time.perf_counter() - started
+        state['index'] = index
+        return {'vectors': n, 'index_type': ann_index.index_type_of(index), 'build_seconds': round(seconds, 3),
+                'vectors_per_second': round(n / seconds, 1), 'memory_mb': round(ann_index.memory_bytes(index) / 2 ** 20, 2)}
+
+    def vector_search():
+        index = state.get('index')
+        if index is None:
+            raise RuntimeError("needs the index build benchmark")
+        return time_calls(lambda q: index.search(q.reshape(1, -1), k), state['queries'])
+
+    def spacy_analysis(texts):
+        def benchmark():
+            # No parse cache: every text is parsed
+            nlp = load_pipeline()
+            analyzer = DocumentAnalyzer(lambda: nlp, cache_mb=0)
+            return time_calls(lambda text: analyze_doc(text, analyzer.parse(text)), texts)
+        return benchmark
+
+    def readability(by_chapter):
+        def benchmark():
+            engine = ReadabilityEngine(cache_mb=0)
+            return time_calls(lambda text: engine.scores(text, by_chapter=by_chapter), full_texts)
+        return benchmark
+
+    def tagging():
+        engine = TagEngine()
+        engine.load()
+        return time_calls(engine.match, full_texts)
+
+    run('encode_query', encode_query)
+    run('encode_batch', encode_batch)
+    run('index_build', index_build)
+    run('vector_search', vector_search)
+    run('spacy_analysis_abstract', spacy_analysis(abstracts))
+    run('spacy_analysis_full_text', spacy_analysis(full_texts))
+    run('readability_full_text', readability(False))
+    run('readability_by_chapter', readability(True))
+    run('tagging_full_text', tagging)
+    return results
+
+
+# --- HTTP load driver ---
+class Scenario:
+    def __init__(self, name, method, path, body=None, weight=1, needs_mongodb=False):
+        self.name = name
+        self.method = method
+        self.path = path            # str, or function(rng) -> str
+        self.body = body            # None, or function(rng) -> dict
+        self.weight = weight
+        self.needs_mongodb = needs_mongodb  # uses queries mongomock can't run
+
+    def request(self, rng):
+        path = self.path(rng) if callable(self.path) else self.path
+        body = json.dumps(self.body(rng)).encode() if self.body else None
+        return self.method, path, body
+
+
+def scenarios(corpus):
+    theses = corpus['theses']
+    queries = corpus['queries']
+    ids = [d['_id'] for d in theses]
+    pdf_ids = [d['_id'] for d in theses if d.get('filePath')]
+    # Zipf-like popularity: a few queries make up most of the traffic, as in production
+    query_weights = [1 / (rank + 1) for rank in range(len(queries))]
+
+    def query(rng):
+        return rng.choices(queries, weights=query_weights)[0]
+
+    def paragraph(rng):
+        paragraphs = rng.choice(theses)['full_text'].split('\n\n')
+        return rng.choice(paragraphs[1:] or paragraphs)
+
+    def chapter(rng):
+        return rng.choice(rng.choice(theses)['full_text'].split('CHAPTER ')[1:] or [''])
+
+    found = [
+        Scenario('semantic-search', 'POST', '/semantic-search', lambda rng: {'query': query(rng), 'top_k': 10}, weight=8),
+        Scenario('semantic-search:keyword', 'POST', '/semantic-search',
+                 lambda rng: {'query': query(rng), 'top_k': 10, 'mode': 'keyword'}, weight=2),
+        Scenario('semantic-search:full_text', 'POST', '/semantic-search',
+                 lambda rng: {'query': query(rng), 'top_k': 10, 'scope': 'full_text'}, weight=2, needs_mongodb=True),
+        Scenario('recommend-theses', 'POST', '/recommend-theses', lambda rng: {'thesis_id': rng.choice(ids), 'top_k': 5}, weight=4),
+        Scenario('theses', 'GET', lambda rng: f'/theses/{rng.choice(ids)}', weight=4),
+        Scenario('check-plagiarism', 'POST', '/check-plagiarism', lambda rng: {'text': paragraph(rng)}, weight=2),
+        Scenario('analyze', 'POST', '/analyze', lambda rng: {'text': rng.choice(theses)['abstract']}, weight=2),
+        Scenario('readability', 'POST', '/readability', lambda rng: {'text': chapter(rng)}, weight=2),
+        Scenario('suggest-tags', 'POST', '/suggest-tags', lambda rng: {'text': rng.choice(theses)['abstract']}, weight=2),
+        Scenario('check-grammar', 'POST', '/check-grammar', lambda rng: {'text': rng.choice(theses)['abstract']}, weight=1),
+        Scenario('near-duplicates', 'GET', '/near-duplicates', weight=1),
+    ]
+    if pdf_ids:
+        found.append(Scenario('extract-text', 'POST', '/extract-text', lambda rng: {'thesis_id': rng.choice(pdf_ids)}, weight=1))
+    return found
+
+
+def _send(connection, method, path, body):
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def drive(base_url, chosen, concurrency, duration, max_requests, seed):
+    # Closed loop: each client sends its next request as soon as the last one is answered.
+    # Client i draws its requests from Random(seed + i), so runs send the same sequence.
+    target = urlsplit(base_url)
+    weights = [scenario.weight for scenario in chosen]
+    samples = {scenario.name: [] for scenario in chosen}
+    errors = {scenario.name: 0 for scenario in chosen}
+    lock = threading.Lock()
+    remaining = [max_requests or float('inf')]
+    deadline = time.perf_counter() + duration
+
+    def client(number):
+        rng = random.Random(seed + number)
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=120)
+        while time.perf_counter() < deadline:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            scenario = rng.choices(chosen, weights=weights)[0]
+            method, path, body = scenario.request(rng)
+            started = time.perf_counter()
+            try:
+                ok = 200 <= _send(connection, method, path, body) < 300
+            except (OSError, http.client.HTTPException):
+                ok = False
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=120)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                samples[scenario.name].append(elapsed)
+                errors[scenario.name] += not ok
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    results = {name: summarize(samples[name], seconds, errors[name]) for name in samples if samples[name]}
+    results['all'] = summarize([ms for name in samples for ms in samples[name]], seconds, sum(errors.values()))
+    return results
+
+
+def warm_up(base_url, chosen, seed):
+    # One untimed request per endpoint: loads the models and fills the indexes
+    target = urlsplit(base_url)
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=600)
+    rng = random.Random(seed - 1)
+    for scenario in chosen:
+        try:
+            status = _send(connection, *scenario.request(rng))
+        except (OSError, http.client.HTTPException) as e:
+            status = e
+            connection.close()
+            connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=600)
+        if status != 200:
+            print(f"  warm-up {scenario.name}: {status}")
+    connection.close()
+
+
+def _get_json(base_url, path, method='GET'):
+    target = urlsplit(base_url)
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=600)
+    try:
+        connection.request(method, path, body=b'{}' if method == 'POST' else None, headers={'Content-Type': 'application/json'})
+        return json.loads(connection.getresponse().read() or b'null')
+    finally:
+        connection.close()
+
+
+def sync_indexes(base_url, expected, timeout=600):
+    # Index sync, then wait for the background refreshes (k-NN table, plagiarism and passage indexes)
+    print(f"  index sync: {_get_json(base_url, '/index/sync', 'POST')}")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        passages = (_get_json(base_url, '/cache/stats') or {}).get('passages', {})
+        if passages.get('theses', 0) >= expected:
+            return
+        time.sleep(1)
+    print(f"  passage index still incomplete after {timeout}s; full-text numbers will be off.")
+
+
+def start_app(corpus, mongo_uri, db_name):
+    # Imports app.py in this process (state files in a temporary directory) and serves it on a free port.
+    # The corpus replaces whatever is in the collection, so it goes to its own database.
+    os.environ['DB_NAME'] = db_name
+    if mongo_uri:
+        os.environ['MONGO_URI'] = mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("The in-process load test needs mongomock (pip install mongomock) or --mongo-uri.")
+        import pymongo
+
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *args, **kwargs: client
+    os.environ.setdefault('INDEX_SYNC_INTERVAL', '0')
+    os.chdir(tempfile.mkdtemp(prefix='thesis-benchmark-'))
+
+    import logging
+    from werkzeug.serving import make_server
+
+    import app as service
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    seed_collection(service.db[service.COLLECTION_NAME], corpus)
+    server = make_server('127.0.0.1', 0, service.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name='benchmark-server').start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def load_test(corpus, args):
+    chosen = scenarios(corpus)
+    if args.endpoints:
+        unknown = set(args.endpoints) - {s.name for s in chosen}
+        if unknown:
+            raise SystemExit(f"Unknown endpoints: {', '.join(sorted(unknown))}. Choose from: {', '.join(s.name for s in chosen)}.")
+        chosen = [s for s in chosen if s.name in args.endpoints]
+    mongomock_used = not args.url and not args.mongo_uri
+    skipped = {}
+    if mongomock_used:
+        skipped = {s.name: 'needs MongoDB features mongomock lacks; use --mongo-uri' for s in chosen if s.needs_mongodb}
+        chosen = [s for s in chosen if not s.needs_mongodb]
+
+    base_url = args.url or start_app(corpus, args.mongo_uri, args.db)
+    if not args.url or args.sync:
+        sync_indexes(base_url, len(corpus['theses']))
+    warm_up(base_url, chosen, args.seed)
+
+    if args.isolate:
+        results = {}
+        for scenario in chosen:
+            print(f"  {scenario.name} ...", flush=True)
+            results[scenario.name] = drive(base_url, [scenario], args.concurrency, args.duration, args.requests, args.seed)[scenario.name]
+    else:
+        print(f"  {len(chosen)} endpoints, {args.concurrency} clients, {args.duration}s ...", flush=True)
+        results = drive(base_url, chosen, args.concurrency, args.duration, args.requests, args.seed)
+    for name, reason in skipped.items():
+        results[name] = {'skipped': reason}
+    return results
+
+
+# --- Reports ---
+def print_table(results):
+    print(f"{'name':<28}{'n':>8}{'err':>6}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in results.items():
+        if 'skipped' in row:
+            print(f"{name:<28}  skipped: {row['skipped']}")
+        elif 'p50_ms' in row:
+            print(f"{name:<28}{row['requests']:>8}{row['errors']:>6}{row['per_second']:>10.1f}"
+                  f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+        else:
+            print(f"{name:<28}  " + ', '.join(f'{key}={value}' for key, value in row.items()))
+
+
+def write_report(path, kind, settings, results):
+    report = {'kind': kind, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+              'settings': settings, 'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {path}.")
+
+
+def _direction(metric):
+    # +1 if higher is better, -1 if lower is better, 0 if the metric isn't compared
+    if metric.endswith('per_second'):
+        return 1
+    if metric == 'max_ms':
+        return 0    # one outlier, too noisy to compare
+    if metric.endswith('_ms') or metric.endswith('_seconds') or metric in ('error_rate', 'memory_mb'):
+        return -1
+    return 0
+
+
+def compare(before, after, tolerance, min_delta_ms):
+    # (name, metric, before, after, relative change) of every metric that got worse than tolerance allows
+    regressions = []
+    for name, old in before['results'].items():
+        new = after['results'].get(name)
+        if not new or 'skipped' in old or 'skipped' in new:
+            continue
+        for metric, old_value in old.items():
+            direction = _direction(metric)
+            new_value = new.get(metric)
+            if not direction or not isinstance(old_value, (int, float)) or not isinstance(new_value, (int, float)):
+                continue
+            if metric.endswith('_ms') and abs(new_value - old_value) < min_delta_ms:
+                continue    # timer noise on fast operations
+            if old_value == 0:
+                worse = direction < 0 and new_value > 0
+                change = float('inf') if worse else 0.0
+            else:
+                change = (new_value - old_value) / old_value
+                worse = change * direction < -tolerance
+            if worse:
+                regressions.append((name, metric, old_value, new_value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark and load test for the ai-service endpoints.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    corpus_parser = commands.add_parser('corpus', help="Write a synthetic thesis corpus")
+    corpus_parser.add_argument('--out', default='bench_corpus')
+    corpus_parser.add_argument('--theses', type=int, default=1000)
+    corpus_parser.add_argument('--pdfs', type=int, default=20, help="Also write PDFs of the first N theses")
+    corpus_parser.add_argument('--full-text-words', type=int, default=3000)
+    corpus_parser.add_argument('--copy-rate', type=float, default=0.03, help="Share of paragraphs copied from earlier theses")
+    corpus_parser.add_argument('--queries', type=int, default=300)
+    corpus_parser.add_argument('--seed', type=int, default=0)
+
+    seed_parser = commands.add_parser('seed', help="Load the corpus into MongoDB for a --url load test")
+    seed_parser.add_argument('--corpus', default='bench_corpus')
+    seed_parser.add_argument('--mongo-uri', required=True)
+    seed_parser.add_argument('--db', default=BENCH_DB_NAME)
+    seed_parser.add_argument('--collection', default=os.environ.get("COLLECTION_NAME", "theses"))
+
+    micro_parser = commands.add_parser('micro', help="Time encoding, index build, search, analysis, readability and tagging")
+    micro_parser.add_argument('--corpus', default='bench_corpus')
+    micro_parser.add_argument('--queries', type=int, default=200)
+    micro_parser.add_argument('--texts', type=int, default=500, help="Abstracts to encode and analyze")
+    micro_parser.add_argument('--full-texts', type=int, default=20)
+    micro_parser.add_argument('--index-size', type=int, default=0, help="Vectors in the built index (default: --texts)")
+    micro_parser.add_argument('--k', type=int, default=10)
+    micro_parser.add_argument('--json')
+
+    load_parser = commands.add_parser('load', help="Drive the HTTP endpoints with concurrent clients")
+    load_parser.add_argument('--corpus', default='bench_corpus')
+    load_parser.add_argument('--url', help="Server to drive instead of an in-process app")
+    load_parser.add_argument('--mongo-uri', help="MongoDB for the in-process app instead of mongomock")
+    load_parser.add_argument('--db', default=BENCH_DB_NAME, help="Database the in-process app reads (its collection is replaced)")
+    load_parser.add_argument('--sync', action='store_true', help="With --url: run an index sync first")
+    load_parser.add_argument('--concurrency', type=int, default=8)
+    load_parser.add_argument('--duration', type=float, default=30, help="Seconds per run")
+    load_parser.add_argument('--requests', type=int, default=0, help="Stop after this many requests")
+    load_parser.add_argument('--endpoints', nargs='+', help="Only these endpoints (scenario names)")
+    load_parser.add_argument('--isolate', action='store_true', help="Run each endpoint on its own")
+    load_parser.add_argument('--seed', type=int, default=1)
+    load_parser.add_argument('--json')
+
+    compare_parser = commands.add_parser('compare', help="Flag regressions between two result files")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--tolerance', type=float, default=0.10, help="Allowed relative slowdown")
+    compare_parser.add_argument('--min-delta-ms', type=float, default=0.5, help="Ignore latency changes smaller than this")
+    args = parser.parse_args()
+
+    if args.command == 'corpus':
+        generate_corpus(args.out, args.theses, args.pdfs, args.full_text_words, args.copy_rate, args.queries, args.seed)
+        return
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        if before.get('kind') != after.get('kind') or before.get('settings') != after.get('settings'):
+            print("Note: the runs used different settings; their numbers may not be comparable.")
+        regressions = compare(before, after, args.tolerance, args.min_delta_ms)
+        for name, metric, old, new, change in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new} ({change:+.1%})")
+        if not regressions:
+            print(f"No regressions beyond {args.tolerance:.0%}.")
+        sys.exit(1 if regressions else 0)
+
+    corpus = read_corpus(args.corpus)
+    if args.json:
+        args.json = os.path.abspath(args.json)    # the in-process app runs in a temporary directory
+    if args.command == 'seed':
+        from pymongo import MongoClient
+        seed_collection(MongoClient(args.mongo_uri)[args.db][args.collection], corpus)
+        return
+    if args.command == 'micro':
+        settings = {'queries': args.queries, 'texts': args.texts, 'full_texts': args.full_texts,
+                    'index_size': args.index_size or args.texts, 'k': args.k, 'theses': len(corpus['theses'])}
+        results = micro_benchmarks(corpus, args.queries, args.texts, args.full_texts, settings['index_size'], args.k)
+        print_table(results)
+        if args.json:
+            write_report(args.json, 'micro', settings, results)
+        return
+
+    settings = {'concurrency': args.concurrency, 'duration': args.duration, 'requests': args.requests,
+                'isolate': args.isolate, 'seed': args.seed, 'theses': len(corpus['theses']),
+                'target': args.url or ('mongodb' if args.mongo_uri else 'mongomock')}
+    results = load_test(corpus, args)
+    print_table(results)
+    if args.json:
+        write_report(args.json, 'load', settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# --- Shared document analysis ---
+# Every endpoint that needs linguistic structure (noun chunks, sentences,
+# token counts) gets it from one spaCy pass per text. The pipeline is loaded
+# without the components nothing here uses (NER, lemmatizer), and the parts
+# of each parse the endpoints need are cached by content hash, so /analyze,
+# /suggest-tags and the batch endpoints reuse one parse of the same text.
+#
+# The cache keeps a compact summary of the parse rather than the spaCy Doc,
+# which for a full thesis would be tens of MB.
+import os
+import re
+
+from thesis_text import content_hash
+from search_cache import LRUCache
+
+SPACY_MODEL = os.environ.get("SPACY_MODEL", "en_core_web_sm")
+# noun_chunks need the tagger, attribute_ruler and parser; sentences come from the parser
+SPACY_EXCLUDE = ['ner', 'lemmatizer']
+DOC_CACHE_MB = float(os.environ.get("DOC_CACHE_MB", 64))
+# Longer texts are parsed as paragraph-aligned segments (spaCy's max_length is 1M chars,
+# and parser memory grows with document length)
+DOC_SEGMENT_CHARS = int(os.environ.get("DOC_SEGMENT_CHARS", 100000))
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def load_pipeline(model=SPACY_MODEL):
+    import spacy
+    return spacy.load(model, exclude=SPACY_EXCLUDE)
+
+
+def segments(text, size=DOC_SEGMENT_CHARS):
+    # (offset, segment) pieces of at most ~size chars, split at paragraph breaks where possible
+    if len(text) <= size:
+        yield 0, text
+        return
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            breaks = [m.end() for m in _PARAGRAPH_BREAK.finditer(text, start, end)]
+            if breaks and breaks[-1] > start:
+                end = breaks[-1]
+            else:
+                space = text.rfind(' ', start, end)
+                end = space + 1 if space > start else end
+        yield start, text[start:end]
+        start = end
+
+
+class ParsedText:
+    # What the endpoints use from a parse: sentence spans, noun chunks (lowercased,
+    # unique, in order of appearance) and token counts
+    __slots__ = ('text', 'sentences', 'noun_chunks', 'tokens', 'words')
+
+    def __init__(self, text, sentences, noun_chunks, tokens, words):
+        self.text = text
+        self.sentences = sentences
+        self.noun_chunks = noun_chunks
+        self.tokens = tokens
+        self.words = words
+
+    def sentence_texts(self, limit=None):
+        spans = self.sentences if limit is None else self.sentences[:limit]
+        return [self.text[start:end] for start, end in spans]
+
+    @classmethod
+    def from_docs(cls, text, parts):
+        # parts: (offset, spaCy Doc) for each segment of text
+        sentences, chunks, tokens, words = [], {}, 0, 0
+        for offset, doc in parts:
+            sentences.extend((offset + s.start_char, offset + s.end_char) for s in doc.sents if s.text.strip())
+            for chunk in doc.noun_chunks:
+                chunks.setdefault(chunk.text.lower(), None)
+            for token in doc:
+                if not token.is_space:
+                    tokens += 1
+                    if not token.is_punct:
+                        words += 1
+        return cls(text, sentences, list(chunks), tokens, words)
+
+    def to_cache(self):
+        return {'sentences': self.sentences, 'noun_chunks': self.noun_chunks,
+                'tokens': self.tokens, 'words': self.words}
+
+
+class DocumentAnalyzer:
+    def __init__(self, load_nlp, cache_mb=DOC_CACHE_MB):
+        # load_nlp() returns the spaCy pipeline, which is only loaded once a text needs parsing
+        self.load_nlp = load_nlp
+        self.cache = LRUCache(cache_mb)
+
+    def cached(self, text):
+        entry = self.cache.get(content_hash(text))
+        if entry is None:
+            return None
+        return ParsedText(text, entry['sentences'], entry['noun_chunks'], entry['tokens'], entry['words'])
+
+    def remember(self, text, parts):
+        parsed = ParsedText.from_docs(text, parts)
+        self.cache.put(content_hash(text), parsed.to_cache())
+        return parsed
+
+    def parse(self, text):
+        parsed = self.cached(text)
+        if parsed is not None:
+            return parsed
+        pieces = list(segments(text))
+        if len(pieces) == 1:
+            return self.remember(text, [(0, self.load_nlp()(text))])
+        docs = self.load_nlp().pipe([segment for _, segment in pieces])
+        return self.remember(text, [(offset, doc) for (offset, _), doc in zip(pieces, docs)])
+
+    def needs_segments(self, text):
+        return len(text) > DOC_SEGMENT_CHARS
+
+
+# Summary, keywords and sentiment, as /analyze returns them and the analysis jobs store them
+def analyze_doc(text, parsed):
+    # --- Keyword Extraction with spaCy ---
+    keywords = parsed.noun_chunks
+
+    # --- Summarization from the spaCy sentence split ---
+    summary = ' '.join(parsed.sentence_texts(3)) # Get first 3 sentences for summary
+
+    # --- Sentiment Analysis with TextBlob (polarity only, no second tokenization) ---
+    from textblob import TextBlob  # imported on first use: it pulls in NLTK
+    sentiment_score = TextBlob(text).sentiment.polarity
+    sentiment = 'Neutral'
+    if sentiment_score > 0.1:
+        sentiment = 'Positive'
+    elif sentiment_score < -0.1:
+        sentiment = 'Negative'
+
+    return {
+        'summary': summary,
+        'keywords': keywords[:10],
+        'sentiment': sentiment
+    }
@@ -0,0 +1,88 @@
+# --- Persistent embedding store ---
+# Caches thesis embeddings in SQLite, keyed by thesis id and embedding model,
+# and tagged with the hash of the text that was encoded. A lookup only hits
+# when the hash still matches, so edited theses are re-encoded automatically.
+# The index sync writes every vector it encodes here, which lets
+# /recommend-theses skip both the Mongo fetch and the model.
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+EMBEDDING_STORE_PATH = os.environ.get("EMBEDDING_STORE_PATH", "thesis_embeddings.sqlite3")
+
+
+class EmbeddingStore:
+    def __init__(self, model_name, path=EMBEDDING_STORE_PATH):
+        self.model_name = model_name
+        self.path = path
+        self.lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        # WAL lets every gunicorn worker read while one of them writes
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " thesis_id TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " content_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " PRIMARY KEY (thesis_id, model))"
+        )
+        self.conn.commit()
+
+    def after_fork(self):
+        # SQLite connections must not be shared across processes
+        self.lock = threading.Lock()
+        self._connect()
+
+    def get(self, thesis_id, content_hash):
+        return self.get_many([(thesis_id, content_hash)]).get(thesis_id)
+
+    def get_many(self, keys):
+        # keys: (thesis_id, content_hash) pairs; returns {thesis_id: vector} for the hits
+        found = {}
+        wanted = dict(keys)
+        ids = list(wanted)
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT thesis_id, content_hash, vector FROM embeddings"
+                    f" WHERE model = ? AND thesis_id IN ({','.join('?' * len(chunk))})",
+                    [self.model_name] + chunk
+                ).fetchall()
+                for thesis_id, content_hash, blob in rows:
+                    if wanted[thesis_id] == content_hash:
+                        found[thesis_id] = np.frombuffer(blob, dtype='float32')
+        return found
+
+    def put(self, thesis_id, content_hash, vector):
+        self.put_many([(thesis_id, content_hash, vector)])
+
+    def put_many(self, items):
+        rows = [
+            (thesis_id, self.model_name, content_hash, np.asarray(vector, dtype='float32').tobytes())
+            for thesis_id, content_hash, vector in items
+        ]
+        with self.lock:
+            # One row per thesis and model: a new hash replaces the stale vector
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def delete_many(self, thesis_ids):
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM embeddings WHERE thesis_id = ? AND model = ?",
+                [(thesis_id, self.model_name) for thesis_id in thesis_ids]
+            )
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model_name,)
+            ).fetchone()[0]
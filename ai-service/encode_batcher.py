@@ -0,0 +1,107 @@
+# --- Micro-batching for SentenceTransformer.encode ---
+# Request handlers each encode one short text. Encoding them one at a time
+# leaves most of the model's batch throughput unused, so concurrent calls are
+# queued, collected for a few milliseconds (or until the batch is full),
+# encoded together in one call, and handed back to their callers.
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+ENCODE_BATCH_WINDOW_MS = float(os.environ.get("ENCODE_BATCH_WINDOW_MS", 5))
+ENCODE_MAX_BATCH_SIZE = int(os.environ.get("ENCODE_MAX_BATCH_SIZE", 64))
+
+
+class EncodeBatcher:
+    def __init__(self, encode, window_ms=ENCODE_BATCH_WINDOW_MS, max_batch_size=ENCODE_MAX_BATCH_SIZE):
+        self._encode = encode
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+        self.busy_seconds = 0.0
+
+    def encode(self, texts):
+        # Same call shape as SentenceTransformer.encode(list_of_texts); blocks until encoded
+        if not texts:
+            return np.empty((0, 0), dtype='float32')
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def _ensure_worker(self):
+        # Also restarts the worker in forked gunicorn workers, where the parent's thread is gone
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._stats_lock = threading.Lock()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, daemon=True, name="encode-batcher")
+                self._thread.start()
+
+    def _collect(self):
+        # Blocks for the first request, then gathers more until the window closes or the batch is full
+        requests = [self._queue.get()]
+        size = len(requests[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            requests.append(item)
+            size += len(item[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            texts = [text for request_texts, _ in requests for text in request_texts]
+            started = time.perf_counter()
+            try:
+                embeddings = np.asarray(self._encode(texts), dtype='float32')
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - started
+
+            offset = 0
+            for request_texts, future in requests:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+            with self._stats_lock:
+                self.batches += 1
+                self.texts += len(texts)
+                self.largest_batch = max(self.largest_batch, len(texts))
+                self.busy_seconds += elapsed
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'batches': self.batches,
+                'texts': self.texts,
+                'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else 0,
+                'largest_batch': self.largest_batch,
+                'encode_seconds': round(self.busy_seconds, 3),
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+            }
@@ -0,0 +1,169 @@
+# --- Sentence embedding backends ---
+# ENCODER_BACKEND picks what runs all-MiniLM-L6-v2:
+#   torch      the fp32 PyTorch model (default)
+#   onnx-int8  a dynamically int8-quantized ONNX export of the same model, run
+#              by onnxruntime from local files (no network at runtime); about
+#              a quarter of the weight memory and several times the CPU
+#              throughput. Export it once with
+#
+#                python encoder_backends.py export
+#
+# Both return the same normalized 384-dim vectors through .encode(texts), but
+# int8 vectors are not interchangeable with fp32 ones: stored embeddings are
+# keyed by backend (embedding_model_name) and the index is rebuilt when the
+# backend changes. How far the int8 model drifts from fp32 on this corpus:
+#
+#   python encoder_backends.py check --limit 2000
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+ENCODER_BACKENDS = ('torch', 'onnx-int8')
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.environ.get(
+    "ONNX_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', f'{MODEL_NAME}-onnx'))
+# Kernel set the quantized weights are laid out for: avx2 runs on any x86-64 server,
+# avx512_vnni is faster where the CPU has it, arm64 for ARM hosts. This picks what export
+# writes; the loader opens whichever one export recorded in EXPORT_MARKER.
+ONNX_QUANTIZATION = os.environ.get("ONNX_QUANTIZATION", "avx2")
+EXPORT_MARKER = 'quantization.json'
+
+
+def quantized_file_name(quantization=ONNX_QUANTIZATION):
+    # Where sentence-transformers' export_dynamic_quantized_onnx_model writes the model
+    return f'onnx/model_qint8_{quantization}.onnx'
+
+
+def exported_quantization(model_dir=ONNX_MODEL_DIR):
+    # The quantization the last export wrote; ONNX_QUANTIZATION for exports without a marker
+    try:
+        with open(os.path.join(model_dir, EXPORT_MARKER), "r") as f:
+            return json.load(f)['quantization']
+    except (OSError, ValueError, KeyError):
+        return ONNX_QUANTIZATION
+
+
+def embedding_model_name(backend=ENCODER_BACKEND):
+    # Name the embedding store and the index state record vectors under
+    return MODEL_NAME if backend == 'torch' else f'{MODEL_NAME}-{backend}'
+
+
+def load_model(backend=ENCODER_BACKEND):
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown ENCODER_BACKEND '{backend}'. Use one of: {', '.join(ENCODER_BACKENDS)}.")
+    if backend == 'torch':
+        return SentenceTransformer(MODEL_NAME)
+    file_name = quantized_file_name(exported_quantization())
+    model_file = os.path.join(ONNX_MODEL_DIR, file_name)
+    if not os.path.exists(model_file):
+        raise FileNotFoundError(f"{model_file} not found; run 'python encoder_backends.py export' first.")
+    return SentenceTransformer(ONNX_MODEL_DIR, backend='onnx', local_files_only=True,
+                               model_kwargs={'file_name': file_name, 'provider': 'CPUExecutionProvider'})
+
+
+def export(model_dir=ONNX_MODEL_DIR, quantization=ONNX_QUANTIZATION):
+    # Downloads the model once (or uses the Hugging Face cache), exports it to ONNX and
+    # writes the int8 version next to it. Everything the server needs ends up in model_dir.
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(MODEL_NAME, backend='onnx')
+    model.save(model_dir)
+    export_dynamic_quantized_onnx_model(model, quantization, model_dir)
+    # Tells load_model which file to open, whatever ONNX_QUANTIZATION the server runs with
+    with open(os.path.join(model_dir, EXPORT_MARKER), "w") as f:
+        json.dump({'quantization': quantization, 'file_name': quantized_file_name(quantization)}, f)
+    print(f"Exported {MODEL_NAME} to {os.path.join(model_dir, quantized_file_name(quantization))}.")
+
+
+def _throughput(model, texts, batch_size):
+    model.encode(texts[:batch_size], batch_size=batch_size)    # warm-up, not timed
+    started = time.perf_counter()
+    vectors = np.asarray(model.encode(texts, batch_size=batch_size), dtype='float32')
+    return vectors, len(texts) / max(time.perf_counter() - started, 1e-9)
+
+
+def _normalized(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(queries, corpus, k, exclude_self=False):
+    scores = queries @ corpus.T
+    if exclude_self:
+        np.fill_diagonal(scores, -np.inf)
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def compare(reference, candidate, corpus_texts, query_texts, k=10, batch_size=64):
+    # Cosine drift of candidate vs reference embeddings of the same texts, and how many of the
+    # reference top-k neighbours the candidate still finds (queries vs corpus, corpus vs corpus)
+    reference_corpus, reference_speed = _throughput(reference, corpus_texts, batch_size)
+    candidate_corpus, candidate_speed = _throughput(candidate, corpus_texts, batch_size)
+    reference_corpus, candidate_corpus = _normalized(reference_corpus), _normalized(candidate_corpus)
+    reference_queries = _normalized(np.asarray(reference.encode(query_texts, batch_size=batch_size), dtype='float32'))
+    candidate_queries = _normalized(np.asarray(candidate.encode(query_texts, batch_size=batch_size), dtype='float32'))
+
+    k = min(k, len(corpus_texts) - 1)
+    drift = np.sum(reference_corpus * candidate_corpus, axis=1)
+
+    def recall(expected, found):
+        return float(np.mean([len(set(e) & set(f)) / len(e) for e, f in zip(expected, found)]))
+
+    return {
+        'texts': len(corpus_texts),
+        'queries': len(query_texts),
+        'k': k,
+        'cosine_to_reference': {
+            'mean': round(float(drift.mean()), 5),
+            'p1': round(float(np.percentile(drift, 1)), 5),
+            'min': round(float(drift.min()), 5)
+        },
+        'query_recall_at_k': round(recall(_top_k(reference_queries, reference_corpus, k),
+                                          _top_k(candidate_queries, candidate_corpus, k)), 4),
+        'neighbour_recall_at_k': round(recall(_top_k(reference_corpus, reference_corpus, k, True),
+                                              _top_k(candidate_corpus, candidate_corpus, k, True)), 4),
+        'reference_texts_per_second': round(reference_speed, 1),
+        'candidate_texts_per_second': round(candidate_speed, 1),
+        'speedup': round(candidate_speed / reference_speed, 2)
+    }
+
+
+def _corpus(limit):
+    # Abstracts are what the index encodes; titles stand in for search queries
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+    collection = client[os.environ.get("DB_NAME", "digi-thesis_DB")][os.environ.get("COLLECTION_NAME", "theses")]
+    docs = list(collection.find({'abstract': {'$nin': [None, '']}}, {'title': 1, 'abstract': 1}).limit(limit))
+    return [d['abstract'] for d in docs], [d.get('title') or d['abstract'][:100] for d in docs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or check the int8 ONNX embedding backend.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="Write the quantized model to ONNX_MODEL_DIR")
+    export_parser.add_argument('--quantization', default=ONNX_QUANTIZATION, choices=('avx2', 'avx512', 'avx512_vnni', 'arm64'),
+                               help=f"Kernel set to quantize for; recorded in {EXPORT_MARKER}, which the server "
+                                    "reads to open this file")
+    check_parser = commands.add_parser('check', help="Compare the int8 backend with the fp32 model on the thesis corpus")
+    check_parser.add_argument('--limit', type=int, default=2000)
+    check_parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(quantization=args.quantization)
+        return
+    corpus, queries = _corpus(args.limit)
+    if len(corpus) < 2:
+        print("Need at least two theses with abstracts to compare.")
+        return
+    print(json.dumps(compare(load_model('torch'), load_model('onnx-int8'), corpus, queries, args.k), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# --- Pooled LanguageTool grammar checking ---
+# A fixed set of LanguageTool backends (each its own local Java server) shared
+# by all requests. Long texts are split at paragraph boundaries and the pieces
+# are checked in parallel on whichever backends are free; match offsets are
+# shifted back onto the original text.
+#
+# A backend whose check fails or whose Java process has exited (see
+# hs_err_pid12140.log) is taken out of rotation, restarted in the background
+# and warmed up with a short check before it serves requests again. The
+# failed piece is retried on another backend.
+#
+# Backends are started on first use in each process, so gunicorn workers
+# never share (or kill) each other's Java servers.
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from doc_analysis import segments
+
+GRAMMAR_POOL_SIZE = int(os.environ.get("GRAMMAR_POOL_SIZE", 2))
+GRAMMAR_CHUNK_CHARS = int(os.environ.get("GRAMMAR_CHUNK_CHARS", 5000))
+# Seconds a check waits for a free backend before giving up
+GRAMMAR_TIMEOUT = float(os.environ.get("GRAMMAR_TIMEOUT", 60))
+WARM_UP_TEXT = "This is a short sentence to warm up the grammar checker."
+MAX_RESTART_DELAY = 60
+
+
+class GrammarUnavailable(Exception):
+    pass
+
+
+class _Backend:
+    def __init__(self, number):
+        self.number = number
+        self.tool = None
+        self.state = 'starting'      # starting -> ready <-> busy; restarting / failed after an error
+        self.started_at = None
+        self.restarts = 0
+        self.checks = 0
+        self.failures = 0
+        self.last_error = None
+
+    def alive(self):
+        # language_tool_python keeps the Java server's Popen in _server (absent for remote servers)
+        server = getattr(self.tool, '_server', None)
+        return self.tool is not None and (server is None or server.poll() is None)
+
+
+class GrammarPool:
+    def __init__(self, factory, size=GRAMMAR_POOL_SIZE, chunk_chars=GRAMMAR_CHUNK_CHARS, timeout=GRAMMAR_TIMEOUT):
+        self.factory = factory
+        self.size = size
+        self.chunk_chars = chunk_chars
+        self.timeout = timeout
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._stats_lock = threading.Lock()
+            self._idle = queue.Queue()
+            self._executor = ThreadPoolExecutor(max_workers=self.size * 2, thread_name_prefix="grammar")
+            self.backends = [_Backend(number) for number in range(self.size)]
+            self.waiting = 0
+            self.in_flight = 0
+            self.chunks_checked = 0
+            self.texts_checked = 0
+            self.check_seconds = 0.0
+            self._pid = os.getpid()
+            for backend in self.backends:
+                self._restart(backend, first=True)
+
+    def start(self):
+        # Optional eager start (otherwise the first check starts the backends)
+        self._ensure_started()
+
+    # --- Backend lifecycle ---
+    def _restart(self, backend, first=False):
+        if not first:
+            backend.state = 'restarting'
+            backend.restarts += 1
+        threading.Thread(target=self._run_backend, args=(backend,), daemon=True,
+                         name=f"grammar-backend-{backend.number}").start()
+
+    def _run_backend(self, backend):
+        # Starts (or restarts) one backend, retrying with backoff until it comes up
+        delay = 1
+        while True:
+            old, backend.tool = backend.tool, None
+            if old is not None:
+                try:
+                    old.close()
+                except Exception:
+                    pass
+            try:
+                tool = self.factory()
+                tool.check(WARM_UP_TEXT)
+            except Exception as e:
+                backend.state = 'failed'
+                backend.last_error = str(e)
+                print(f"Error starting LanguageTool backend {backend.number}: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RESTART_DELAY)
+                continue
+            backend.tool = tool
+            backend.started_at = time.time()
+            backend.state = 'ready'
+            self._idle.put(backend)
+            return
+
+    def _acquire(self, deadline):
+        with self._stats_lock:
+            self.waiting += 1
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise GrammarUnavailable('No grammar checker backend became available in time.')
+                try:
+                    backend = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if backend.alive():
+                    backend.state = 'busy'
+                    return backend
+                self._fail(backend, 'LanguageTool server process exited')
+        finally:
+            with self._stats_lock:
+                self.waiting -= 1
+
+    def _fail(self, backend, error):
+        backend.failures += 1
+        backend.last_error = str(error)
+        print(f"LanguageTool backend {backend.number} failed ({error}); restarting.")
+        self._restart(backend)
+
+    # --- Checking ---
+    def _check_chunk(self, offset, chunk, deadline):
+        # One retry on another backend if the first one fails mid-check
+        last_error = None
+        for _ in range(2):
+            backend = self._acquire(deadline)
+            started = time.perf_counter()
+            try:
+                matches = backend.tool.check(chunk)
+            except Exception as e:
+                last_error = e
+                self._fail(backend, e)
+                continue
+            backend.checks += 1
+            backend.state = 'ready'
+            self._idle.put(backend)
+            with self._stats_lock:
+                self.chunks_checked += 1
+                self.check_seconds += time.perf_counter() - started
+            return [{
+                'message': match.message,
+                'replacements': match.replacements,
+                'offset': match.offset + offset,
+                'length': match.errorLength,
+                'ruleId': match.ruleId
+            } for match in matches]
+        raise GrammarUnavailable(f'Grammar check failed: {last_error}')
+
+    def check(self, text):
+        # Issues for the whole text, offsets relative to text, in text order
+        self._ensure_started()
+        deadline = time.monotonic() + self.timeout
+        pieces = list(segments(text, self.chunk_chars))
+        with self._stats_lock:
+            self.in_flight += len(pieces)
+        try:
+            if len(pieces) == 1:
+                issues = self._check_chunk(0, text, deadline)
+            else:
+                futures = [self._executor.submit(self._check_chunk, offset, chunk, deadline) for offset, chunk in pieces]
+                issues = [issue for future in futures for issue in future.result()]
+        finally:
+            with self._stats_lock:
+                self.in_flight -= len(pieces)
+        with self._stats_lock:
+            self.texts_checked += 1
+        return issues
+
+    def available(self):
+        self._ensure_started()
+        return any(backend.state in ('ready', 'busy', 'starting', 'restarting') for backend in self.backends)
+
+    def stats(self, start=True):
+        # start=False (health and readiness probes) reports a pool this process hasn't started
+        # yet as such, instead of starting its JVMs
+        if not start and self._pid != os.getpid():
+            return {
+                'started': False,
+                'backends': [{'number': number, 'state': 'not_started'} for number in range(self.size)],
+                'chunk_chars': self.chunk_chars
+            }
+        self._ensure_started()
+        now = time.time()
+        with self._stats_lock:
+            return {
+                'started': True,
+                'backends': [{
+                    'number': backend.number,
+                    'state': backend.state,
+                    'alive': backend.alive(),
+                    'uptime_seconds': round(now - backend.started_at, 1) if backend.started_at and backend.state in ('ready', 'busy') else 0,
+                    'restarts': backend.restarts,
+                    'checks': backend.checks,
+                    'failures': backend.failures,
+                    'last_error': backend.last_error
+                } for backend in self.backends],
+                'idle_backends': self._idle.qsize(),
+                'waiting_checks': self.waiting,
+                'chunks_in_flight': self.in_flight,
+                'texts_checked': self.texts_checked,
+                'chunks_checked': self.chunks_checked,
+                'mean_chunk_seconds': round(self.check_seconds / self.chunks_checked, 4) if self.chunks_checked else 0,
+                'chunk_chars': self.chunk_chars
+            }
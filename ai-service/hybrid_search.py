@@ -0,0 +1,309 @@
+# --- Hybrid keyword + vector search ---
+# /semantic-search ranks theses by two retrievers and fuses the rankings with
+# reciprocal-rank fusion (score = sum of 1 / (RRF_K + rank)):
+#   keyword  BM25 over title, abstract and keywords (an in-process inverted index)
+#   vector   the FAISS index in index_sync.py
+#
+# Facet filters (status, department, submissionYear) are applied inside both
+# retrievers rather than after them: each facet value has a precomputed bitmap
+# over FAISS ids, the bitmaps of a query are combined with numpy, and FAISS
+# only visits ids in the result (an IDSelectorBitmap), so a filtered query
+# still returns top_k hits whenever that many theses match the filters.
+#
+# Everything here is derived from index_sync.metadata and updated
+# incrementally whenever the index generation moves: only the theses in the
+# index's change log are re-read and re-tokenized, and result metadata is
+# read from the (shared, memory-mapped) index metadata when a hit is returned.
+import math
+import os
+import re
+import threading
+
+import faiss
+import numpy as np
+
+import ann_index
+
+RRF_K = int(os.environ.get("RRF_K", 60))
+# Hits taken from each retriever before fusion
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 50))
+# Filters matching at most this many theses are scored exactly instead of through the ANN index
+FILTER_EXACT_MAX = int(os.environ.get("FILTER_EXACT_MAX", 4096))
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Title words count this many times, so a title match outranks the same word deep in an abstract
+TITLE_WEIGHT = 2
+
+SEARCH_MODES = ('hybrid', 'vector', 'keyword')
+FACETS = {'status': 'status', 'department': 'department', 'submissionYear': 'year'}
+# Public search only shows approved theses unless the request filters on status itself
+DEFAULT_FILTERS = {'status': ['approved']}
+
+_WORD_RE = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has in is it its of on or that the this to was were will with
+""".split())
+
+
+def tokenize(text):
+    return [w for w in _WORD_RE.findall(text.lower()) if w not in STOPWORDS and len(w) > 1]
+
+
+def document_terms(metadata):
+    terms = tokenize(metadata.get('title') or '') * TITLE_WEIGHT
+    terms += tokenize(metadata.get('abstract') or '')
+    for keyword in metadata.get('keywords') or []:
+        terms += tokenize(str(keyword))
+    return terms
+
+
+def facet_value(value):
+    # Department names differ in case and spacing between submissions
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    return value
+
+
+class FilterError(ValueError):
+    pass
+
+
+class HybridSearch:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = None
+        # Only what scoring and filtering need; result metadata is read from index_sync.metadata
+        self.faiss_of = {}      # thesis id -> faiss_id
+        self.thesis_of = {}     # faiss_id -> thesis id
+        self.doc_terms = {}     # faiss_id -> distinct terms, to take it out of the postings again
+        self.doc_facets = {}    # faiss_id -> bitmap keys it is set in
+        self.postings = {}      # term -> {faiss_id: term frequency}
+        self.doc_lengths = {}   # faiss_id -> number of terms
+        self.total_length = 0
+        self._arrays = {}       # term -> (faiss_ids, tfs) arrays, built on first use
+        self.size = 0           # length of the id-indexed arrays (> max faiss id)
+        self.live = np.zeros(0, dtype=bool)
+        self.lengths = np.zeros(0, dtype='float32')
+        self.bitmaps = {}       # (facet, value) -> bool array over faiss ids
+
+    # --- Maintenance ---
+    def _clear(self):
+        self.faiss_of, self.thesis_of, self.doc_terms, self.doc_facets = {}, {}, {}, {}
+        self.postings, self.doc_lengths, self._arrays = {}, {}, {}
+        self.total_length = 0
+        self.size = 0
+        self.live = np.zeros(0, dtype=bool)
+        self.lengths = np.zeros(0, dtype='float32')
+        self.bitmaps = {}
+
+    def _grow(self, size):
+        # Doubles the id-indexed arrays, so adding theses one at a time stays cheap
+        size = max(size, 2 * self.size)
+        self.live = np.concatenate([self.live, np.zeros(size - self.size, dtype=bool)])
+        self.lengths = np.concatenate([self.lengths, np.zeros(size - self.size, dtype='float32')])
+        for key, bitmap in self.bitmaps.items():
+            self.bitmaps[key] = np.concatenate([bitmap, np.zeros(size - self.size, dtype=bool)])
+        self.size = size
+
+    def _remove(self, faiss_id):
+        for term in self.doc_terms.pop(faiss_id):
+            postings = self.postings[term]
+            del postings[faiss_id]
+            if not postings:
+                del self.postings[term]
+            self._arrays.pop(term, None)
+        self.total_length -= self.doc_lengths.pop(faiss_id)
+        for key in self.doc_facets.pop(faiss_id):
+            self.bitmaps[key][faiss_id] = False
+        self.live[faiss_id] = False
+        self.lengths[faiss_id] = 0
+        del self.faiss_of[self.thesis_of.pop(faiss_id)]
+
+    def _add(self, faiss_id, metadata):
+        terms = document_terms(metadata)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[faiss_id] = count
+            self._arrays.pop(term, None)
+        self.doc_terms[faiss_id] = tuple(counts)
+        self.doc_lengths[faiss_id] = len(terms)
+        self.total_length += len(terms)
+
+        if faiss_id >= self.size:
+            self._grow(faiss_id + 1)
+        keys = tuple((facet, facet_value(metadata.get(field))) for facet, field in FACETS.items())
+        for key in keys:
+            if key not in self.bitmaps:
+                self.bitmaps[key] = np.zeros(self.size, dtype=bool)
+            self.bitmaps[key][faiss_id] = True
+        self.doc_facets[faiss_id] = keys
+        self.live[faiss_id] = True
+        self.lengths[faiss_id] = len(terms)
+        self.thesis_of[faiss_id] = metadata['id']
+        self.faiss_of[metadata['id']] = faiss_id
+
+    def refresh(self, index_sync):
+        # Brings the postings and facet bitmaps up to the index's current generation. Only the
+        # theses the index's change log lists are re-read; everything is read the first time,
+        # or when this worker fell further behind than the log reaches.
+        with index_sync.lock:
+            generation = index_sync.generation
+            if generation == self.generation:
+                return False
+            changed = index_sync.changes_since(self.generation)
+            if changed is None:
+                updates = None
+                current = dict(index_sync.metadata.items())
+            else:
+                updates = {}
+                for thesis_id in changed:
+                    faiss_id = index_sync.ids.get(thesis_id)
+                    metadata = index_sync.metadata.get(faiss_id) if faiss_id is not None else None
+                    updates[thesis_id] = (faiss_id, metadata)
+        with self.lock:
+            if self.generation is not None and self.generation >= generation:
+                return False    # another request got there first
+            if updates is None:
+                self._clear()
+                for faiss_id, metadata in current.items():
+                    self._add(faiss_id, metadata)
+                reindexed = len(current)
+            else:
+                for thesis_id, (faiss_id, metadata) in updates.items():
+                    if thesis_id in self.faiss_of:
+                        self._remove(self.faiss_of[thesis_id])
+                    if metadata is not None:
+                        self._add(faiss_id, metadata)
+                reindexed = len(updates)
+            self.generation = generation
+        print(f"Hybrid search refreshed: {reindexed} theses re-indexed, {len(self.postings)} terms, generation {generation}.")
+        return True
+
+    # --- Filters ---
+    def filter_mask(self, filters):
+        # filters: {facet: value or [values]}; submissionYear also takes {"min": .., "max": ..}.
+        # A facet set to None is not filtered. Returns a bool array over faiss ids.
+        if not isinstance(filters or {}, dict):
+            raise FilterError("filters must be an object, e.g. {\"department\": \"Computer Science\"}.")
+        mask = self.live.copy()
+        for facet, wanted in dict(DEFAULT_FILTERS, **(filters or {})).items():
+            if facet not in FACETS:
+                raise FilterError(f"Unknown filter '{facet}'. Use one of: {', '.join(FACETS)}.")
+            if wanted is None:
+                continue
+            if isinstance(wanted, dict):
+                if facet != 'submissionYear':
+                    raise FilterError("Ranges are only supported for submissionYear.")
+                low, high = wanted.get('min', -math.inf), wanted.get('max', math.inf)
+                values = [v for f, v in self.bitmaps if f == facet and isinstance(v, (int, float)) and low <= v <= high]
+            else:
+                values = wanted if isinstance(wanted, list) else [wanted]
+                if facet == 'submissionYear':
+                    try:
+                        values = [int(v) for v in values]
+                    except (TypeError, ValueError):
+                        raise FilterError("submissionYear must be a year or a list of years.")
+            selected = np.zeros(self.size, dtype=bool)
+            for value in values:
+                bitmap = self.bitmaps.get((facet, facet_value(value)))
+                if bitmap is not None:
+                    selected |= bitmap
+            mask &= selected
+        return mask
+
+    # --- Retrievers ---
+    def _term_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self.postings.get(term, {})
+            arrays = (np.fromiter(postings.keys(), dtype='int64', count=len(postings)),
+                      np.fromiter(postings.values(), dtype='float32', count=len(postings)))
+            self._arrays[term] = arrays
+        return arrays
+
+    def keyword_search(self, query, mask, k):
+        # (faiss_ids, bm25 scores) of the k best keyword matches among mask
+        n = len(self.doc_lengths)
+        if not n:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+        average_length = self.total_length / n or 1.0
+        scores = np.zeros(self.size, dtype='float32')
+        for term in set(tokenize(query)):
+            ids, tfs = self._term_arrays(term)
+            if not len(ids):
+                continue
+            idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[ids] / average_length)
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        scores[~mask] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return candidates.astype('int64'), scores[candidates]
+
+    def vector_search(self, index_sync, query_embedding, mask, k):
+        # (faiss_ids, cosine scores) of the k nearest vectors among mask; caller holds index_sync.lock
+        allowed = np.flatnonzero(mask)
+        k = min(k, len(allowed))
+        if k == 0:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+        query = ann_index.normalize(query_embedding[:1])
+        index = index_sync.index
+        if len(allowed) <= FILTER_EXACT_MAX:
+            vectors = ann_index.normalize(ann_index.reconstruct_all(index, allowed))
+            scores = vectors @ query[0]
+            top = np.argsort(-scores, kind='stable')[:k]
+            return allowed[top].astype('int64'), scores[top]
+        # The bitmap must outlive the search: FAISS only keeps a pointer to it (and its size in bytes)
+        packed = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(packed), faiss.swig_ptr(packed))
+        for widen in (1, 8):
+            # HNSW/IVF can come back short when the filter is selective; search wider once
+            scores, ids = index.search(query, k, params=ann_index.search_parameters(index, selector, widen))
+            found = ids[0] >= 0
+            if found.sum() >= k:
+                break
+        return ids[0][found], scores[0][found]
+
+    def matching_theses(self, index_sync, filters):
+        # Thesis ids passing filters, for searches that don't go through the FAISS index (passages)
+        self.refresh(index_sync)
+        with self.lock:
+            return {self.thesis_of[faiss_id] for faiss_id in np.flatnonzero(self.filter_mask(filters)).tolist()}
+
+    def search(self, index_sync, query, query_embedding, top_k, filters=None, mode='hybrid'):
+        # Returns (score, metadata, details) triples, best first. details has each retriever's
+        # score for the hit (None when that retriever didn't return it).
+        if mode not in SEARCH_MODES:
+            raise FilterError(f"Unknown search mode '{mode}'. Use one of: {', '.join(SEARCH_MODES)}.")
+        # Catch up outside the index lock first; the second refresh only sees a change
+        # that landed in between, so the bitmaps always match the index being searched
+        self.refresh(index_sync)
+        with index_sync.lock:
+            self.refresh(index_sync)
+            with self.lock:
+                mask = self.filter_mask(filters)
+                depth = top_k if mode != 'hybrid' else max(top_k, HYBRID_CANDIDATES)
+                keyword = self.keyword_search(query, mask, depth) if mode != 'vector' else None
+                vector = self.vector_search(index_sync, query_embedding, mask, depth) if mode != 'keyword' else None
+
+                if mode == 'vector':
+                    ranked = [(float(s), int(f)) for f, s in zip(*vector)]
+                elif mode == 'keyword':
+                    ranked = [(float(s), int(f)) for f, s in zip(*keyword)]
+                else:
+                    fused = {}
+                    for ids, _ in (vector, keyword):
+                        for rank, faiss_id in enumerate(ids.tolist()):
+                            fused[faiss_id] = fused.get(faiss_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+                    ranked = sorted(((score, faiss_id) for faiss_id, score in fused.items()), key=lambda x: -x[0])
+
+                vector_scores = dict(zip(*(a.tolist() for a in vector))) if vector is not None else {}
+                keyword_scores = dict(zip(*(a.tolist() for a in keyword))) if keyword is not None else {}
+                return [(score, index_sync.metadata[faiss_id], {
+                    'vector_score': vector_scores.get(faiss_id),
+                    'keyword_score': keyword_scores.get(faiss_id)
+                }) for score, faiss_id in ranked[:top_k]]
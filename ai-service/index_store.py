@@ -0,0 +1,209 @@
+# --- Memory-mapped index store ---
+# On-disk format of the search index that every gunicorn worker maps instead
+# of loading: each published generation is a directory holding the FAISS
+# index and its metadata as flat arrays plus one UTF-8 blob, all opened with
+# mmap, so N workers share one copy in the page cache.
+#
+#   thesis_index_store/
+#     CURRENT                  name of the live generation (swapped atomically)
+#     resume_token.json        change-stream position reached without a new generation
+#     *.request                work handed to the sync leader by other processes (index_sync.py)
+#     gen-00000042-1f2e3d4c/
+#       index.faiss
+#       faiss_ids.npy          sorted int64 faiss ids
+#       offsets.npy            metadata record i is blob[offsets[i]:offsets[i + 1]] (JSON)
+#       blob.bin
+#       mongo_ids.npy          sorted mongo _ids, with faiss_of.npy and hash_of.npy alongside
+#       faiss_of.npy
+#       hash_of.npy
+#       state.json             next_id, tombstones, resume token, generation, ...
+#
+# A generation is written to a temporary directory, renamed into place and
+# only then named in CURRENT, so a reader always opens an index and the
+# metadata that belong together.
+import json
+import os
+import shutil
+import uuid
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+
+import ann_index
+
+INDEX_STORE_DIR = os.environ.get("INDEX_STORE_DIR", "thesis_index_store")
+# Older generations are kept for a while: a worker may still be opening one it just read from CURRENT
+INDEX_STORE_KEEP = int(os.environ.get("INDEX_STORE_KEEP", 3))
+CURRENT_FILE = 'CURRENT'
+
+
+class FrozenMap(Mapping):
+    # Read-only dict over two parallel arrays: sorted keys and their values.
+    # Lookups are a binary search on the (memory-mapped) key array.
+    def __init__(self, keys, values, decode):
+        self.keys_array = keys
+        self.values_array = values
+        self.decode = decode
+        self.is_text = keys.dtype.kind == 'S'
+
+    def _position(self, key):
+        if self.is_text:
+            if not isinstance(key, str):
+                return -1
+            key = key.encode('utf-8')
+        elif isinstance(key, (str, bytes, float)) or key is None:
+            return -1
+        position = int(np.searchsorted(self.keys_array, key))
+        if position < len(self.keys_array) and self.keys_array[position] == key:
+            return position
+        return -1
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position < 0:
+            raise KeyError(key)
+        return self.decode(self.values_array, position)
+
+    def __contains__(self, key):
+        return self._position(key) >= 0
+
+    def __iter__(self):
+        if self.is_text:
+            return (key.decode('utf-8') for key in self.keys_array)
+        return (int(key) for key in self.keys_array)
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def items(self):
+        return ((key, self.decode(self.values_array, i)) for i, key in enumerate(self))
+
+
+def _decode_int(values, i):
+    return int(values[i])
+
+
+def _decode_text(values, i):
+    return values[i].decode('ascii')
+
+
+class _Records:
+    # Slices of the metadata blob by record number
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+
+def _decode_record(records, i):
+    start, end = int(records.offsets[i]), int(records.offsets[i + 1])
+    return json.loads(bytes(records.blob[start:end]).decode('utf-8'))
+
+
+def _map_blob(path):
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype='uint8')
+    return np.memmap(path, dtype='uint8', mode='r')
+
+
+def _save_array(directory, name, array):
+    np.save(os.path.join(directory, name), array, allow_pickle=False)
+
+
+def _load_array(directory, name):
+    return np.load(os.path.join(directory, name), mmap_mode='r', allow_pickle=False)
+
+
+def current(store_dir=INDEX_STORE_DIR):
+    # Name of the live generation, or None before the first publish
+    try:
+        with open(os.path.join(store_dir, CURRENT_FILE), "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def publish(index, metadata, ids, hashes, state, store_dir=INDEX_STORE_DIR):
+    # Writes a new generation and makes it the live one; returns its name.
+    # metadata: {faiss_id: dict}, ids: {mongo_id: faiss_id}, hashes: {mongo_id: hash}
+    os.makedirs(store_dir, exist_ok=True)
+    name = f"gen-{int(state.get('generation', 0)):08d}-{uuid.uuid4().hex[:8]}"
+    tmp_dir = os.path.join(store_dir, f"{name}.tmp")
+    os.makedirs(tmp_dir)
+
+    faiss.write_index(index, os.path.join(tmp_dir, 'index.faiss'))
+
+    faiss_ids = np.array(sorted(metadata), dtype='int64')
+    offsets = np.zeros(len(faiss_ids) + 1, dtype='int64')
+    with open(os.path.join(tmp_dir, 'blob.bin'), 'wb') as blob:
+        for i, faiss_id in enumerate(faiss_ids):
+            record = json.dumps(metadata[int(faiss_id)], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            blob.write(record)
+            offsets[i + 1] = offsets[i] + len(record)
+    _save_array(tmp_dir, 'faiss_ids.npy', faiss_ids)
+    _save_array(tmp_dir, 'offsets.npy', offsets)
+
+    mongo_ids = sorted(ids)
+    _save_array(tmp_dir, 'mongo_ids.npy', np.array([m.encode('utf-8') for m in mongo_ids], dtype='S'))
+    _save_array(tmp_dir, 'faiss_of.npy', np.array([ids[m] for m in mongo_ids], dtype='int64'))
+    # Entries without a recorded hash are stored as b'' and read back as missing
+    _save_array(tmp_dir, 'hash_of.npy', np.array([(hashes.get(m) or '').encode('ascii') for m in mongo_ids], dtype='S40'))
+
+    with open(os.path.join(tmp_dir, 'state.json'), "w") as f:
+        json.dump(dict(state, index_type=ann_index.index_type_of(index)), f)
+
+    os.replace(tmp_dir, os.path.join(store_dir, name))
+    pointer_tmp = os.path.join(store_dir, f"{CURRENT_FILE}.tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_tmp, os.path.join(store_dir, CURRENT_FILE))
+    prune(store_dir, keep=name)
+    return name
+
+
+def prune(store_dir=INDEX_STORE_DIR, keep=None):
+    # Drops all but the newest INDEX_STORE_KEEP generations, and directories left by an interrupted publish
+    entries = sorted(d for d in os.listdir(store_dir) if d.startswith('gen-'))
+    old = [d for d in entries if d != keep and not d.endswith('.tmp')]
+    stale = [d for d in entries if d.endswith('.tmp')] + old[:max(0, len(old) - (INDEX_STORE_KEEP - 1))]
+    for name in stale:
+        # Windows can't delete files another worker still maps; they go on a later publish
+        shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+
+
+def read_index_mapped(path, index_type=None):
+    # Maps the vectors read-only where FAISS supports it; falls back to a normal read
+    if index_type in ann_index.INDEX_TYPES:
+        try:
+            return faiss.read_index(path, ann_index.mmap_flags(index_type)), True
+        except RuntimeError as e:
+            print(f"Could not memory-map {path} ({e}); reading it into memory.")
+    return faiss.read_index(path), False
+
+
+def open_generation(name, store_dir=INDEX_STORE_DIR):
+    # Returns (index, mapped, metadata, ids, hashes, state); the mappings are FrozenMaps
+    directory = os.path.join(store_dir, name)
+    with open(os.path.join(directory, 'state.json'), "r") as f:
+        state = json.load(f)
+    index, mapped = read_index_mapped(os.path.join(directory, 'index.faiss'), state.get('index_type'))
+
+    records = _Records(_load_array(directory, 'offsets.npy'), _map_blob(os.path.join(directory, 'blob.bin')))
+    metadata = FrozenMap(_load_array(directory, 'faiss_ids.npy'), records, _decode_record)
+    mongo_ids = _load_array(directory, 'mongo_ids.npy')
+    ids = FrozenMap(mongo_ids, _load_array(directory, 'faiss_of.npy'), _decode_int)
+    hash_of = _load_array(directory, 'hash_of.npy')
+    hashed = np.flatnonzero(hash_of != b'')
+    if len(hashed) == len(hash_of):
+        hashes = FrozenMap(mongo_ids, hash_of, _decode_text)
+    else:
+        hashes = FrozenMap(np.asarray(mongo_ids[hashed]), np.asarray(hash_of[hashed]), _decode_text)
+    return index, mapped, metadata, ids, hashes, state
+
+
+def thaw(mapping):
+    # Plain dict copy of a FrozenMap, for the process that applies changes
+    return dict(mapping.items()) if isinstance(mapping, FrozenMap) else mapping
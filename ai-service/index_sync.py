@@ -0,0 +1,793 @@
+# --- Incremental FAISS index maintenance ---
+# Keeps the search index in step with the theses collection without
+# re-encoding the whole corpus. Every thesis gets a stable int64 FAISS id
+# (stored next to a hash of the text it was encoded from), so new, edited
+# and deleted theses only touch their own vectors.
+#
+# The index and its metadata are published as memory-mapped generations
+# (see index_store.py). Workers that only search keep the mapped, read-only
+# copy; the sync leader copies it into memory the first time it has a change
+# to apply.
+#
+# A sync pass streams the collection through a batched cursor in _id order
+# and applies changes BUILD_CHUNK_SIZE theses at a time, so memory is bounded
+# by one chunk however large the corpus is. Long passes (the first build, a
+# full rebuild) publish a checkpoint every BUILD_CHECKPOINT_SECONDS that
+# records the last _id applied; a pass interrupted by a crash or restart
+# resumes after it. Offline builds, optionally encoding across several
+# processes:
+#
+#   python index_sync.py [--full] [--processes 4]
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+
+import faiss
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+import ann_index
+import index_store
+from thesis_text import content_hash
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines run a single process, so no leader election is needed
+    fcntl = None
+
+# Pre-store files; they are read once and published as the first generation
+INDEX_PATH = os.environ.get("INDEX_PATH", "thesis_index.faiss")
+METADATA_PATH = os.environ.get("METADATA_PATH", "thesis_metadata.json")
+CHECKPOINT_PATH = os.environ.get("INDEX_SYNC_CHECKPOINT", "thesis_sync_checkpoint.json")
+# Stream position after events that changed nothing, next to the generations in the store
+RESUME_TOKEN_FILE = 'resume_token.json'
+LOCK_FILE = 'sync.lock'
+# Left by a process that isn't the leader when asked for a full rebuild; the leader runs it
+REBUILD_REQUEST_FILE = 'rebuild.request'
+# refresh-<uuid>.request: theses whose text changed outside the index (new PDF text); the
+# leader passes them to its listeners, the only writers of the derived indexes
+REFRESH_REQUEST_PREFIX = 'refresh-'
+REQUEST_SUFFIX = '.request'
+ENCODE_BATCH_SIZE = 256
+# Documents per cursor round trip, and changed theses encoded and added per chunk
+SYNC_CURSOR_BATCH = int(os.environ.get("SYNC_CURSOR_BATCH", 1000))
+BUILD_CHUNK_SIZE = int(os.environ.get("BUILD_CHUNK_SIZE", 4096))
+BUILD_CHECKPOINT_SECONDS = float(os.environ.get("BUILD_CHECKPOINT_SECONDS", 300))
+# Rebuild (from stored vectors, no re-encoding) once this share of an HNSW index is tombstoned
+TOMBSTONE_COMPACT_RATIO = 0.2
+# Theses changed by each of the last CHANGE_LOG_GENERATIONS generations, published with them so
+# workers update derived indexes (hybrid_search.py) for just those; bigger changes aren't listed
+CHANGE_LOG_GENERATIONS = 64
+CHANGE_LOG_MAX_IDS = 1000
+
+# Only the fields needed to build the embedding text and the result metadata
+SYNC_PROJECTION = {'_id': 1, 'abstract': 1, 'title': 1, 'authorName': 1,
+                   'keywords': 1, 'status': 1, 'department': 1, 'submissionYear': 1}
+
+
+def embedding_text(doc):
+    # Abstracts keep the index lightweight and are good enough for recommendations
+    return doc.get('abstract') or ''
+
+
+def make_metadata(doc):
+    return {
+        'id': str(doc['_id']),
+        'title': doc.get('title', 'No Title'),
+        'author': doc.get('authorName', 'Unknown Author'),
+        'abstract': doc.get('abstract', ''),
+        # Keyword search and facet filters (hybrid_search.py)
+        'keywords': doc.get('keywords') or [],
+        'status': doc.get('status'),
+        'department': doc.get('department'),
+        'year': doc.get('submissionYear')
+    }
+
+
+def _cursor_id(value):
+    # build_cursor is stored as a string; thesis _ids are ObjectIds
+    return ObjectId(value) if ObjectId.is_valid(value) else value
+
+
+def _atomic_write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+class IndexSync:
+    def __init__(self, collection, encode, store=None, store_dir=index_store.INDEX_STORE_DIR,
+                 index_path=INDEX_PATH, metadata_path=METADATA_PATH, checkpoint_path=CHECKPOINT_PATH,
+                 encode_batch_size=ENCODE_BATCH_SIZE):
+        self.collection = collection
+        self.encode = encode
+        self.encode_batch_size = encode_batch_size
+        # Optional EmbeddingStore: vectors found there (same thesis, same text) aren't re-encoded
+        self.store = store
+        self.store_dir = store_dir
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        self.checkpoint_path = checkpoint_path
+        # Searches and sync passes share one lock so readers never see a half-applied batch
+        self.lock = threading.RLock()
+        self.index = None
+        self.mapped = False     # index is the read-only memory-mapped copy of the live generation
+        # Read-only FrozenMaps while mapped, dicts once the leader has changes to apply
+        self.metadata = {}      # faiss_id -> result metadata
+        self.ids = {}           # mongo _id string -> faiss_id
+        self.hashes = {}        # mongo _id string -> hash of the encoded text
+        self.next_id = 0
+        self.tombstones = set() # removed faiss ids still inside an index that can't drop them
+        self.resume_token = None
+        self.build_cursor = None  # last _id applied by a sync pass that hasn't finished
+        self.last_sync = None
+        self.generation = 0     # bumped on every change that reaches disk
+        self.changes = []       # [generation, thesis ids it changed (None: too many)], oldest first
+        self.published = None   # name of the store generation this process has open
+        self.model = None       # embedding model the published vectors came from
+        self.is_leader = False  # holds the flock on sync.lock: the only process that writes generations
+        self._lock_file = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.listeners = []     # called with this IndexSync after each change is saved
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal if self.index is not None else 0
+
+    # --- Persistence ---
+    def load(self):
+        name = index_store.current(self.store_dir)
+        if name is None:
+            return self._load_legacy()
+        if name == self.published:
+            return True
+
+        print(f"Opening FAISS index generation {name}...")
+        index, mapped, metadata, ids, hashes, state = index_store.open_generation(name, self.store_dir)
+        ann_index.tune(index, len(metadata))
+        with self.lock:
+            # Swapped together, so a search never pairs one generation's index with another's metadata
+            self.index, self.mapped = index, mapped
+            self.metadata, self.ids, self.hashes = metadata, ids, hashes
+            self.next_id = state.get('next_id', max(metadata, default=-1) + 1)
+            self.tombstones = set(state.get('tombstones', []))
+            self.resume_token = state.get('resume_token')
+            self.build_cursor = state.get('build_cursor')
+            self.last_sync = state.get('last_sync')
+            self.generation = state.get('generation', 0)
+            self.changes = state.get('changes', [])
+            self.model = state.get('model')
+            self.published = name
+            saved = self._read_resume_token()
+            if saved.get('generation') == self.generation:
+                # The stream moved past this generation without changing the index
+                self.resume_token = saved.get('resume_token')
+                self.last_sync = saved.get('last_sync', self.last_sync)
+        print(f"FAISS index loaded ({self.ntotal} vectors, generation {self.generation}"
+              f"{', memory-mapped' if mapped else ''}).")
+        return True
+
+    def _load_legacy(self):
+        # thesis_index.faiss + thesis_metadata.json from before the store: read once, then published
+        if not (os.path.exists(self.index_path) and os.path.exists(self.metadata_path)):
+            print("No existing FAISS index found. The first sync will build it.")
+            return False
+
+        print("Loading FAISS index from file...")
+        index = faiss.read_index(self.index_path)
+        with open(self.metadata_path, "r") as f:
+            metadata_list = json.load(f)
+
+        checkpoint = {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+
+        with self.lock:
+            self.index, self.mapped = index, False
+            self.metadata = {}
+            for position, entry in enumerate(metadata_list):
+                faiss_id = int(entry.pop('faiss_id', position))
+                self.metadata[faiss_id] = entry
+
+            self.ids = checkpoint.get('ids') or {m['id']: fid for fid, m in self.metadata.items()}
+            # Entries without a recorded hash are re-encoded once on the next sync
+            self.hashes = checkpoint.get('hashes', {})
+            self.next_id = checkpoint.get('next_id', max(self.metadata, default=-1) + 1)
+            self.tombstones = set(checkpoint.get('tombstones', []))
+            self.resume_token = checkpoint.get('resume_token')
+            self.last_sync = checkpoint.get('last_sync')
+            self.generation = checkpoint.get('generation', 0)
+
+            if not ann_index.has_stable_ids(index):
+                # Index written before stable ids existed: FAISS ids are the old list positions.
+                # The vectors are reused as-is; no re-encoding is needed to migrate.
+                print("Migrating positional FAISS index to stable ids...")
+                self._rebuild_from_vectors(np.arange(index.ntotal, dtype='int64'))
+            elif not ann_index.is_cosine(index):
+                print("Migrating L2 FAISS index to normalized cosine vectors...")
+                self._rebuild_from_vectors(faiss.vector_to_array(index.id_map))
+            else:
+                ann_index.tune(self.index, len(self.metadata))
+            if self.index is not None and self.acquire_leadership():
+                self.save()
+
+        print(f"FAISS index loaded ({self.ntotal} vectors, generation {self.generation}).")
+        return True
+
+    def _ensure_writable(self):
+        # Called under the lock before a change: the mapped generation is read-only, so the
+        # leader takes an in-memory copy of it (once; later changes reuse that copy)
+        if self.mapped:
+            self.index = faiss.read_index(os.path.join(self.store_dir, self.published, 'index.faiss'))
+            ann_index.tune(self.index, len(self.metadata))
+            self.mapped = False
+        self.metadata = index_store.thaw(self.metadata)
+        self.ids = index_store.thaw(self.ids)
+        self.hashes = index_store.thaw(self.hashes)
+
+    def save(self):
+        with self.lock:
+            if self.store is not None:
+                self.model = self.store.model_name
+            self.published = index_store.publish(self.index, self.metadata, self.ids, self.hashes, {
+                'next_id': self.next_id,
+                'tombstones': sorted(self.tombstones),
+                'resume_token': self.resume_token,
+                'build_cursor': self.build_cursor,
+                'last_sync': self.last_sync,
+                'generation': self.generation,
+                'changes': self.changes,
+                'model': self.model,
+            }, self.store_dir)
+        self._notify()
+
+    def _save_resume_token(self):
+        _atomic_write_json(os.path.join(self.store_dir, RESUME_TOKEN_FILE), {
+            'generation': self.generation,
+            'resume_token': self.resume_token,
+            'last_sync': self.last_sync,
+        })
+
+    def _read_resume_token(self):
+        # Only valid for the generation it was written against; a later publish carries its own
+        try:
+            with open(os.path.join(self.store_dir, RESUME_TOKEN_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def reload(self):
+        # Opens the generation the leader published last, if it isn't the one already open
+        if index_store.current(self.store_dir) in (None, self.published):
+            return
+        try:
+            self.load()
+        except (OSError, RuntimeError, ValueError) as e:
+            # e.g. a generation pruned between reading CURRENT and opening it
+            print(f"Error opening published FAISS index, retrying: {e}")
+
+    # --- Leader election ---
+    def acquire_leadership(self):
+        # One process writes and publishes generations; the others only reload them. The flock
+        # is kept for the life of the process, and taken over when its holder exits.
+        if self.is_leader:
+            return True
+        if self._lock_file is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            self._lock_file = open(os.path.join(self.store_dir, LOCK_FILE), "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        self.is_leader = True
+        # The previous leader may have published since this process last looked
+        self.reload()
+        return True
+
+    def request_rebuild(self):
+        _atomic_write_json(os.path.join(self.store_dir, REBUILD_REQUEST_FILE), {'requested_at': time.time()})
+
+    def _take_rebuild_request(self):
+        try:
+            os.remove(os.path.join(self.store_dir, REBUILD_REQUEST_FILE))
+        except OSError:
+            return False
+        return True
+
+    def request_refresh(self, thesis_ids):
+        # Listeners re-read these theses even though the index itself didn't change
+        if self.is_leader:
+            self._notify(thesis_ids)
+            return
+        os.makedirs(self.store_dir, exist_ok=True)
+        name = f"{REFRESH_REQUEST_PREFIX}{uuid.uuid4().hex}{REQUEST_SUFFIX}"
+        _atomic_write_json(os.path.join(self.store_dir, name), {'thesis_ids': list(thesis_ids)})
+
+    def _take_refresh_requests(self):
+        thesis_ids = set()
+        for name in os.listdir(self.store_dir):
+            if not (name.startswith(REFRESH_REQUEST_PREFIX) and name.endswith(REQUEST_SUFFIX)):
+                continue
+            path = os.path.join(self.store_dir, name)
+            try:
+                with open(path, "r") as f:
+                    thesis_ids.update(json.load(f)['thesis_ids'])
+                os.remove(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping index refresh request {name}: {e}")
+        return sorted(thesis_ids)
+
+    def _handle_requests(self):
+        # Work other processes handed to the leader
+        if self._take_rebuild_request():
+            self.rebuild()
+        thesis_ids = self._take_refresh_requests()
+        if thesis_ids:
+            self._notify(thesis_ids)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, thesis_ids=()):
+        # Only the process that writes the index (the sync leader) notifies. thesis_ids: theses
+        # whose text changed outside the index, which listeners re-read as well.
+        for listener in self.listeners:
+            try:
+                listener(self, thesis_ids)
+            except Exception as e:
+                print(f"Index listener {listener} failed: {e}")
+
+    def _bump_generation(self, thesis_ids):
+        # Called under the lock for every change
+        self.generation += 1
+        thesis_ids = sorted(set(thesis_ids))
+        self.changes.append([self.generation, thesis_ids if len(thesis_ids) <= CHANGE_LOG_MAX_IDS else None])
+        del self.changes[:-CHANGE_LOG_GENERATIONS]
+
+    def changes_since(self, generation):
+        # Thesis ids added, edited or removed after `generation` (caller holds the lock), or None
+        # when the change log doesn't cover them all and the caller has to compare everything
+        if generation == self.generation:
+            return set()
+        if generation is None or generation > self.generation:
+            return None
+        entries = [ids for logged, ids in self.changes if logged > generation]
+        if len(entries) != self.generation - generation or any(ids is None for ids in entries):
+            return None
+        return set().union(*entries)
+
+    # --- In-place index updates ---
+    def _remove_ids(self, faiss_ids):
+        if not faiss_ids or self.index is None:
+            return
+        if ann_index.supports_remove(self.index):
+            self.index.remove_ids(np.array(faiss_ids, dtype='int64'))
+        else:
+            # Tombstoned ids have no metadata, so search() skips them until the next compaction
+            self.tombstones.update(faiss_ids)
+
+    def _rebuild_from_vectors(self, faiss_ids):
+        # Re-creates the index (new type, metric or compaction) from vectors it already holds
+        self.mapped = False
+        live_ids = np.array([i for i in faiss_ids if int(i) in self.metadata and int(i) not in self.tombstones], dtype='int64')
+        vectors = ann_index.reconstruct_all(self.index, live_ids)
+        if vectors is None:
+            self.index = None
+        else:
+            vectors = ann_index.normalize(vectors)
+            train = vectors[:ann_index.training_size(ann_index.choose_index_type(len(vectors)), len(vectors))]
+            self.index = ann_index.create_index(vectors.shape[1], len(vectors), train)
+            self.index.add_with_ids(vectors, live_ids)
+        self.tombstones = set()
+
+    def compact(self):
+        # Switches index type as the corpus grows past a threshold, and drops HNSW tombstones
+        with self.lock:
+            if self.index is None:
+                return False
+            live = len(self.metadata)
+            wanted = ann_index.choose_index_type(live)
+            current = ann_index.index_type_of(self.index)
+            if wanted == current and len(self.tombstones) <= TOMBSTONE_COMPACT_RATIO * max(live, 1):
+                return False
+            if current == 'ivf_pq':
+                print("Rebuilding from IVF-PQ codes is lossy; POST /index/sync with full=true for exact vectors.")
+            print(f"Rebuilding {current} FAISS index as {wanted} ({live} vectors, {len(self.tombstones)} tombstones)...")
+            self._rebuild_from_vectors(list(self.metadata))
+            # Same ids and metadata, so nothing derived from them changes
+            self._bump_generation(())
+            return True
+
+    def apply(self, upserts=(), deletes=(), expected=None):
+        # upserts: Mongo documents carrying SYNC_PROJECTION fields; deletes: _id strings.
+        # expected: corpus size to plan the index for when this creates it (default: the upserts)
+        pending = []
+        metadata_updates = {}
+        stale_ids = []
+        touched = []
+
+        for doc in upserts:
+            mongo_id = str(doc['_id'])
+            text = embedding_text(doc)
+            if not text:
+                # A thesis without an abstract has nothing to index
+                deletes = list(deletes) + [mongo_id]
+                continue
+            digest = content_hash(text)
+            if mongo_id in self.ids and self.hashes.get(mongo_id) == digest:
+                # Title/author edits only change the stored metadata
+                if self.metadata.get(self.ids[mongo_id]) != make_metadata(doc):
+                    metadata_updates[self.ids[mongo_id]] = make_metadata(doc)
+                    touched.append(mongo_id)
+                continue
+            pending.append((mongo_id, digest, text, make_metadata(doc)))
+
+        removed = 0
+        with self.lock:
+            if pending or deletes or metadata_updates:
+                self._ensure_writable()
+                self.metadata.update(metadata_updates)
+            for mongo_id in deletes:
+                faiss_id = self.ids.pop(mongo_id, None)
+                self.hashes.pop(mongo_id, None)
+                if faiss_id is not None:
+                    stale_ids.append(faiss_id)
+                    self.metadata.pop(faiss_id, None)
+                    touched.append(mongo_id)
+                    removed += 1
+            self._remove_ids(stale_ids)
+        if self.store is not None and deletes:
+            self.store.delete_many(deletes)
+
+        expected = max(expected or 0, len(pending))
+        if len(pending) < ann_index.training_size(ann_index.choose_index_type(expected), expected):
+            # Too few vectors in hand to train an index planned for the whole corpus;
+            # compact() switches type once the corpus has grown
+            expected = len(pending)
+        encoded = 0
+        start = 0
+        while start < len(pending):
+            batch_size = self.encode_batch_size
+            if self.index is None:
+                # IVF indexes are trained on the first batch, so it must be large enough
+                batch_size = max(batch_size, ann_index.training_size(ann_index.choose_index_type(expected), expected))
+            batch = pending[start:start + batch_size]
+            start += batch_size
+            # Encode outside the lock so searches keep running during a large sync
+            embeddings, batch_encoded = self._embed(batch)
+            encoded += batch_encoded
+
+            with self.lock:
+                if self.index is None:
+                    self.index = ann_index.create_index(embeddings.shape[1], expected, embeddings)
+                can_replace = ann_index.supports_remove(self.index)
+                faiss_ids = []
+                replaced = []
+                for mongo_id, digest, _, metadata in batch:
+                    faiss_id = self.ids.get(mongo_id)
+                    if faiss_id is not None:
+                        replaced.append(faiss_id)
+                        if not can_replace:
+                            # The old vector stays behind as a tombstone, so the new one needs a fresh id
+                            self.metadata.pop(faiss_id, None)
+                            faiss_id = None
+                    if faiss_id is None:
+                        faiss_id = self.next_id
+                        self.next_id += 1
+                        self.ids[mongo_id] = faiss_id
+                    self.hashes[mongo_id] = digest
+                    self.metadata[faiss_id] = metadata
+                    faiss_ids.append(faiss_id)
+                self._remove_ids(replaced)
+                self.index.add_with_ids(embeddings, np.array(faiss_ids, dtype='int64'))
+
+        changed = len(pending) + removed + len(metadata_updates)
+        if changed:
+            with self.lock:
+                self._bump_generation(touched + [mongo_id for mongo_id, _, _, _ in pending])
+        return {
+            'encoded': encoded,
+            'reused': len(pending) - encoded,
+            'removed': removed,
+            'metadata_updated': len(metadata_updates)
+        }
+
+    def _embed(self, batch):
+        # batch: (mongo_id, digest, text, metadata) tuples.
+        # Returns the normalized vectors in batch order and how many needed the model.
+        cached = {}
+        if self.store is not None:
+            cached = self.store.get_many([(mongo_id, digest) for mongo_id, digest, _, _ in batch])
+        missing = [item for item in batch if item[0] not in cached]
+        if missing:
+            vectors = np.asarray(self.encode([text for _, _, text, _ in missing]), dtype='float32')
+            for (mongo_id, _, _, _), vector in zip(missing, vectors):
+                cached[mongo_id] = vector
+            if self.store is not None:
+                self.store.put_many([
+                    (mongo_id, digest, vector) for (mongo_id, digest, _, _), vector in zip(missing, vectors)
+                ])
+        embeddings = ann_index.normalize(np.vstack([cached[item[0]] for item in batch]))
+        return embeddings, len(missing)
+
+    def vector_for(self, mongo_id):
+        # The stored embedding of an indexed thesis, without touching MongoDB or the model
+        vector = self.vectors_for([mongo_id]).get(mongo_id)
+        return vector.reshape(1, -1) if vector is not None else None
+
+    def vectors_for(self, mongo_ids):
+        # {mongo_id: vector} for the indexed theses among mongo_ids
+        with self.lock:
+            keys = [(m, self.hashes[m]) for m in mongo_ids if m in self.hashes and m in self.ids]
+        found = self.store.get_many(keys) if self.store is not None else {}
+        missing = [(m, digest) for m, digest in keys if m not in found]
+        if not missing:
+            return found
+        with self.lock:
+            # Vectors indexed before the store existed; IVF-PQ codes are too lossy to reuse
+            if self.index is None or ann_index.index_type_of(self.index) == 'ivf_pq':
+                return found
+            rebuilt = [(m, digest, self.index.reconstruct(int(self.ids[m]))) for m, digest in missing if m in self.ids]
+        if self.store is not None and rebuilt:
+            self.store.put_many(rebuilt)
+        found.update((m, vector) for m, _, vector in rebuilt)
+        return found
+
+    # --- Change detection ---
+    def poll(self):
+        # Reconciles against a projection-only scan. Only hashes are compared here;
+        # the model runs just for theses whose abstract is new or different.
+        resume_after = self.build_cursor
+        query = {}
+        if resume_after is not None:
+            print(f"Resuming interrupted index sync after _id {resume_after}...")
+            query = {'_id': {'$gt': _cursor_id(resume_after)}}
+        expected = None
+        chunk_size = BUILD_CHUNK_SIZE
+        if self.index is None:
+            # The first chunk trains the index, so it is planned for (and holds enough vectors
+            # to train for) the whole collection
+            expected = self.collection.estimated_document_count()
+            chunk_size = max(chunk_size, ann_index.training_size(ann_index.choose_index_type(expected), expected))
+
+        totals = {'encoded': 0, 'reused': 0, 'removed': 0, 'metadata_updated': 0}
+
+        def add(stats):
+            for key, value in stats.items():
+                totals[key] += value
+
+        seen = set()
+        upserts = []
+        last_checkpoint = time.monotonic()
+        cursor = self.collection.find(query, SYNC_PROJECTION).sort('_id', 1).batch_size(SYNC_CURSOR_BATCH)
+        for doc in cursor:
+            mongo_id = str(doc['_id'])
+            seen.add(mongo_id)
+            text = embedding_text(doc)
+            faiss_id = self.ids.get(mongo_id)
+            if (faiss_id is None or not text
+                    or self.hashes.get(mongo_id) != content_hash(text)
+                    or self.metadata.get(faiss_id) != make_metadata(doc)):
+                upserts.append(doc)
+            if len(upserts) < chunk_size:
+                continue
+            add(self.apply(upserts, expected=expected))
+            upserts, chunk_size = [], BUILD_CHUNK_SIZE
+            # Everything up to and including this thesis is now in the index
+            self.build_cursor = mongo_id
+            if self.index is not None and time.monotonic() - last_checkpoint >= BUILD_CHECKPOINT_SECONDS:
+                self.save()
+                last_checkpoint = time.monotonic()
+                print(f"FAISS index checkpoint: {totals} so far ({self.ntotal} vectors).")
+
+        # A resumed pass didn't see the theses before its cursor, so deletions among
+        # them are left to the next full pass
+        deletes = [] if resume_after is not None else [mongo_id for mongo_id in self.ids if mongo_id not in seen]
+        add(self.apply(upserts, deletes, expected))
+        self.build_cursor = None
+        return totals
+
+    def sync(self):
+        if self.collection is None:
+            print("MongoDB connection not available. Skipping index sync.")
+            return None
+        if not self.acquire_leadership():
+            # Another process applies the changes; this one only follows what it publishes
+            self.reload()
+            return None
+        if self.store is not None and self.model not in (None, self.store.model_name):
+            # Vectors from another encoder backend don't share an embedding space with this one
+            print(f"FAISS index was encoded with {self.model}; rebuilding it for {self.store.model_name}.")
+            return self.rebuild()
+        started = time.time()
+        resumed = self.build_cursor is not None
+        try:
+            stats = self.poll()
+        except PyMongoError as e:
+            print(f"Error syncing FAISS index with MongoDB: {e}")
+            return None
+        self.last_sync = started
+        compacted = self.compact()
+        if any(stats.values()) or compacted or resumed or self.published is None:
+            if self.index is not None:
+                self.save()
+            print(f"FAISS index synced: {stats} ({self.ntotal} vectors, generation {self.generation}).")
+        return stats
+
+    def rebuild(self):
+        # Rebuilds from scratch; vectors the embedding store holds for this model are reused
+        if not self.acquire_leadership():
+            # Only the leader may replace the index: hand the rebuild to it
+            self.request_rebuild()
+            self.reload()
+            return None
+        with self.lock:
+            self.index, self.mapped = None, False
+            self.metadata, self.ids, self.hashes = {}, {}, {}
+            self.next_id = 0
+            self.tombstones = set()
+            self.resume_token = None
+            self.build_cursor = None
+            self.model = None
+        return self.sync()
+
+    def watch(self):
+        # Applies change-stream events as they arrive. Needs a replica set (Atlas has one);
+        # raises OperationFailure on a standalone server so the caller can fall back to polling.
+        watch_kwargs = {'full_document': 'updateLookup'}
+        if self.resume_token:
+            watch_kwargs['resume_after'] = self.resume_token
+        with self.collection.watch(**watch_kwargs) as stream:
+            if self.resume_token is None:
+                # Pick up anything that changed before the stream was opened
+                self.sync()
+            while not self._stop.is_set():
+                self._handle_requests()
+                change = stream.try_next()
+                if change is None:
+                    continue
+                operation = change['operationType']
+                mongo_id = str(change['documentKey']['_id'])
+                stats = None
+                if operation == 'delete':
+                    stats = self.apply(deletes=[mongo_id])
+                elif operation in ('insert', 'update', 'replace') and change.get('fullDocument'):
+                    stats = self.apply(upserts=[change['fullDocument']])
+                self.resume_token = stream.resume_token
+                self.last_sync = time.time()
+                compacted = self.compact()
+                if compacted or (stats and any(stats.values())):
+                    self.save()
+                else:
+                    # A write the index doesn't store (e.g. analysis results): only the stream
+                    # position moves, so no generation is published and no listener runs
+                    self._save_resume_token()
+
+    # --- Background sync ---
+    def _run(self, interval):
+        notified = False
+        while not self._stop.is_set():
+            if not self.acquire_leadership():
+                # One process (gunicorn worker) writes; the others reload what it publishes
+                self.reload()
+                self._stop.wait(interval)
+                continue
+            if not notified:
+                # Let listeners catch up with whatever the previous leader published
+                notified = True
+                self._notify()
+            self._handle_requests()
+
+            try:
+                self.watch()
+            except OperationFailure:
+                # No change streams on this server (or the resume token expired): poll instead
+                self.resume_token = None
+                self.sync()
+                self._stop.wait(interval)
+            except Exception as e:
+                print(f"Change stream interrupted, polling until it can be reopened: {e}")
+                self.sync()
+                self._stop.wait(interval)
+
+    def start_background(self, interval):
+        if self.collection is None or interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True, name="index-sync")
+        self._thread.start()
+
+    def after_fork(self):
+        # Locks held by the parent's sync thread at fork time would never be released here
+        self.lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        # The flock belongs to the parent's open file: the child never leads through it, and
+        # closing its copy of the descriptor leaves the parent's lock in place
+        self.is_leader = False
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        if self.store is not None:
+            self.store.after_fork()
+
+    def stop_background(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    # --- Queries ---
+    def search_ids(self, query_embeddings, k):
+        # Batch search returning raw (scores, faiss_ids) arrays; may include tombstoned ids
+        query_embeddings = ann_index.normalize(query_embeddings)
+        with self.lock:
+            # Over-fetch by the number of tombstones so deleted theses can't push out live hits
+            fetch = min(k + len(self.tombstones), self.index.ntotal)
+            return self.index.search(query_embeddings, fetch)
+
+    def range_search_ids(self, query_embeddings, min_score):
+        # Every vector scoring above min_score: (lims, scores, faiss_ids) as returned by FAISS
+        query_embeddings = ann_index.normalize(query_embeddings)
+        with self.lock:
+            return self.index.range_search(query_embeddings, min_score)
+
+    def search(self, query_embeddings, k):
+        # Returns (cosine similarity, metadata) pairs, most similar first
+        with self.lock:
+            scores, faiss_ids = self.search_ids(query_embeddings[:1], k)
+            results = []
+            for score, faiss_id in zip(scores[0], faiss_ids[0]):
+                # FAISS pads with -1 when the index holds fewer than k vectors
+                if faiss_id >= 0 and int(faiss_id) in self.metadata:
+                    results.append((float(score), self.metadata[int(faiss_id)]))
+            return results[:k]
+
+
+def main():
+    from pymongo import MongoClient
+
+    from embedding_store import EmbeddingStore
+    from encoder_backends import load_model, embedding_model_name
+
+    parser = argparse.ArgumentParser(description="Build or update the FAISS index from MongoDB without the server.")
+    parser.add_argument('--full', action='store_true', help="Re-index every thesis (stored vectors are still reused)")
+    parser.add_argument('--processes', type=int, default=1, help="Encode across this many CPU processes")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+    collection = client[os.environ.get("DB_NAME", "digi-thesis_DB")][os.environ.get("COLLECTION_NAME", "theses")]
+    model = None
+    pool = None
+
+    def encode(texts):
+        return model.encode(texts, pool=pool) if pool is not None else model.encode(texts)
+
+    # Bigger batches keep every process of the pool busy
+    index_sync = IndexSync(collection, encode, EmbeddingStore(embedding_model_name()),
+                           encode_batch_size=ENCODE_BATCH_SIZE * max(1, args.processes))
+    if not index_sync.acquire_leadership():
+        print("A running server is the index sync leader; stop it or let it build the index.")
+        return
+    model = load_model()
+    if args.processes > 1:
+        pool = model.start_multi_process_pool(['cpu'] * args.processes)
+    try:
+        index_sync.load()
+        stats = index_sync.rebuild() if args.full else index_sync.sync()
+        print(f"Done: {stats} ({index_sync.ntotal} vectors, generation {index_sync.generation}).")
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+
+if __name__ == "__main__":
+    main()
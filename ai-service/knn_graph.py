@@ -0,0 +1,245 @@
+# --- Precomputed k-NN recommendation graph ---
+# Stores every thesis's top-N most similar theses (FAISS ids + cosine scores)
+# in a compact .npz table, so /recommend-theses is a binary search and a row
+# read instead of a model call and an index scan. The table is rebuilt with
+# chunked batch searches, and after index changes only the rows that are
+# affected (new or edited theses, rows pointing at removed ones, rows a new
+# thesis now belongs in) are searched again.
+#
+#   python knn_graph.py                 # full offline build from the saved index
+#   python knn_graph.py --duplicates    # also print near-duplicate clusters
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+KNN_GRAPH_PATH = os.environ.get("KNN_GRAPH_PATH", "thesis_knn.npz")
+KNN_GRAPH_NEIGHBOURS = int(os.environ.get("KNN_GRAPH_NEIGHBOURS", 20))
+# Cosine similarity above which two theses are reported as near-duplicates
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", 0.95))
+SEARCH_CHUNK_SIZE = 1024
+# Past this share of changed rows a full rebuild is cheaper than patching
+FULL_REBUILD_RATIO = 0.3
+
+
+class KnnGraph:
+    def __init__(self, path=KNN_GRAPH_PATH, neighbours=KNN_GRAPH_NEIGHBOURS):
+        self.path = path
+        self.neighbours = neighbours
+        # Row i describes row_ids[i] (sorted), built from the text with hash row_hashes[i]
+        self.row_ids = np.empty(0, dtype='int64')
+        self.row_hashes = np.empty(0, dtype='U40')
+        self.neighbour_ids = np.empty((0, neighbours), dtype='int64')
+        self.scores = np.empty((0, neighbours), dtype='float16')
+        self.built_at = None
+        self._mtime = None
+        self._checked = 0
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+
+    # --- Persistence ---
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as table:
+            self.row_ids = table['row_ids']
+            self.row_hashes = table['row_hashes']
+            self.neighbour_ids = table['neighbour_ids']
+            self.scores = table['scores']
+            self.built_at = float(table['built_at'])
+        self._mtime = os.path.getmtime(self.path)
+        print(f"Loaded k-NN graph ({len(self.row_ids)} theses x {self.neighbour_ids.shape[1]} neighbours).")
+        return True
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(tmp_path, row_ids=self.row_ids, row_hashes=self.row_hashes,
+                 neighbour_ids=self.neighbour_ids, scores=self.scores, built_at=self.built_at)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+
+    def reload_if_changed(self):
+        # Workers that don't run the refresh pick up the leader's table (checked at most once a second)
+        now = time.time()
+        if now - self._checked < 1:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    # --- Lookups ---
+    def lookup(self, faiss_id, top_k):
+        # (neighbour faiss ids, scores) for one thesis, or None if it has no row
+        self.reload_if_changed()
+        row_ids = self.row_ids
+        row = np.searchsorted(row_ids, faiss_id)
+        if row >= len(row_ids) or row_ids[row] != faiss_id or top_k > self.neighbour_ids.shape[1]:
+            return None
+        return self.neighbour_ids[row], self.scores[row].astype('float32')
+
+    def duplicate_clusters(self, threshold=DUPLICATE_THRESHOLD):
+        # Connected components of the "score >= threshold" edges, largest first
+        self.reload_if_changed()
+        rows, cols = np.nonzero(self.scores >= threshold)
+        parent = {}
+
+        def find(x):
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        edges = []
+        for row, col in zip(rows, cols):
+            a, b = int(self.row_ids[row]), int(self.neighbour_ids[row, col])
+            if b < 0:
+                continue
+            parent[find(a)] = find(b)
+            edges.append((a, float(self.scores[row, col])))
+
+        clusters = {}
+        for node in list(parent):
+            clusters.setdefault(find(node), {'members': [], 'max_score': 0.0})['members'].append(node)
+        for node, score in edges:
+            cluster = clusters[find(node)]
+            cluster['max_score'] = max(cluster['max_score'], round(score, 4))
+        result = [dict(c, members=sorted(c['members'])) for c in clusters.values()]
+        result.sort(key=lambda c: (-len(c['members']), -c['max_score']))
+        return result
+
+    # --- Building ---
+    def _search_rows(self, index_sync, faiss_ids, id_to_mongo):
+        # Neighbour rows for faiss_ids via chunked batch searches over the live index
+        neighbour_ids = np.full((len(faiss_ids), self.neighbours), -1, dtype='int64')
+        scores = np.zeros((len(faiss_ids), self.neighbours), dtype='float16')
+        for start in range(0, len(faiss_ids), SEARCH_CHUNK_SIZE):
+            chunk = faiss_ids[start:start + SEARCH_CHUNK_SIZE]
+            mongo_ids = [id_to_mongo[f] for f in chunk]
+            vectors = index_sync.vectors_for(mongo_ids)
+            present = [i for i, m in enumerate(mongo_ids) if m in vectors]
+            if not present:
+                continue
+            # +1 for the thesis itself, which is always its own nearest neighbour
+            found_scores, found_ids = index_sync.search_ids(
+                np.vstack([vectors[mongo_ids[i]] for i in present]), self.neighbours + 1)
+            for i, ids_row, scores_row in zip(present, found_ids, found_scores):
+                keep = [(f, s) for f, s in zip(ids_row, scores_row)
+                        if f >= 0 and f != chunk[i] and int(f) in index_sync.metadata][:self.neighbours]
+                if keep:
+                    neighbour_ids[start + i, :len(keep)] = [f for f, _ in keep]
+                    scores[start + i, :len(keep)] = [s for _, s in keep]
+        return neighbour_ids, scores
+
+    def refresh(self, index_sync):
+        with index_sync.lock:
+            id_to_mongo = {fid: mongo_id for mongo_id, fid in index_sync.ids.items()}
+            current = {fid: index_sync.hashes.get(mongo_id, '') for fid, mongo_id in id_to_mongo.items()}
+        previous = dict(zip(self.row_ids.tolist(), self.row_hashes.tolist()))
+        # An edited thesis counts as removed (old vector) and added (new vector)
+        removed = {fid for fid, digest in previous.items() if current.get(fid) != digest}
+        added = [fid for fid, digest in current.items() if previous.get(fid) != digest]
+        if not removed and not added and len(previous) == len(current):
+            return {'rows_searched': 0}
+
+        started = time.time()
+        if not previous or len(removed) + len(added) > FULL_REBUILD_RATIO * max(len(current), 1):
+            affected = sorted(current)
+            rows = {}
+        else:
+            kept = [i for i, fid in enumerate(self.row_ids.tolist()) if fid not in removed]
+            rows = {int(self.row_ids[i]): (self.neighbour_ids[i], self.scores[i]) for i in kept}
+            affected = set(added)
+            removed_array = np.array(sorted(removed), dtype='int64')
+            for fid, (neighbour_ids, scores) in rows.items():
+                # Rows that pointed at a removed thesis lost a neighbour
+                if np.isin(neighbour_ids, removed_array).any():
+                    affected.add(fid)
+            if added:
+                # Rows whose weakest neighbour is beaten by a new vector gain one. A range search
+                # down to the weakest score of any row finds all of them, not just the new
+                # thesis's own top neighbours (k-NN isn't symmetric).
+                worst = {fid: (-1.0 if row[0][-1] < 0 else float(row[1][-1])) for fid, row in rows.items()}
+                vectors = index_sync.vectors_for([id_to_mongo[f] for f in added])
+                if vectors and worst:
+                    _, found_scores, found_ids = index_sync.range_search_ids(
+                        np.vstack(list(vectors.values())), min(worst.values()))
+                    for fid, score in zip(found_ids.tolist(), found_scores.tolist()):
+                        if fid in worst and score > worst[fid]:
+                            affected.add(fid)
+            affected = sorted(affected)
+
+        neighbour_ids, scores = self._search_rows(index_sync, affected, id_to_mongo)
+        for i, fid in enumerate(affected):
+            rows[fid] = (neighbour_ids[i], scores[i])
+
+        ordered = sorted(rows)
+        self.row_ids = np.array(ordered, dtype='int64')
+        self.row_hashes = np.array([current[f] for f in ordered], dtype='U40')
+        self.neighbour_ids = np.vstack([rows[f][0] for f in ordered]) if ordered else np.empty((0, self.neighbours), dtype='int64')
+        self.scores = np.vstack([rows[f][1] for f in ordered]).astype('float16') if ordered else np.empty((0, self.neighbours), dtype='float16')
+        self.built_at = time.time()
+        self.save()
+        print(f"k-NN graph refreshed: {len(affected)} of {len(ordered)} rows searched in {time.time() - started:.1f}s.")
+        return {'rows_searched': len(affected)}
+
+    def after_fork(self):
+        # A refresh running in the parent at fork time would otherwise hold the lock forever
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+
+    def refresh_async(self, index_sync, thesis_ids=()):
+        # Index listener: refreshes in the background; changes arriving meanwhile trigger one more pass.
+        # A request for thesis_ids alone means their text changed, not their vectors: nothing to do.
+        if thesis_ids:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            self._rerun = True
+            return
+
+        def run():
+            try:
+                while True:
+                    self._rerun = False
+                    self.refresh(index_sync)
+                    if not self._rerun:
+                        break
+            except Exception as e:
+                print(f"Error refreshing k-NN graph: {e}")
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, daemon=True, name="knn-graph").start()
+
+
+def main():
+    from index_sync import IndexSync
+    from embedding_store import EmbeddingStore
+    from encoder_backends import embedding_model_name
+
+    parser = argparse.ArgumentParser(description="Build the k-NN recommendation graph from the saved FAISS index.")
+    parser.add_argument('--duplicates', action='store_true', help="Print near-duplicate clusters afterwards")
+    parser.add_argument('--threshold', type=float, default=DUPLICATE_THRESHOLD)
+    args = parser.parse_args()
+
+    # Offline: no MongoDB and no model; vectors come from the store or the index itself
+    index_sync = IndexSync(None, None, EmbeddingStore(embedding_model_name()))
+    if not index_sync.load():
+        return
+    graph = KnnGraph()
+    graph.load()
+    graph.refresh(index_sync)
+    if args.duplicates:
+        for cluster in graph.duplicate_clusters(args.threshold):
+            titles = [index_sync.metadata[f]['title'] for f in cluster['members'] if f in index_sync.metadata]
+            print(f"{cluster['max_score']:.3f}  {titles}")
+
+
+if __name__ == "__main__":
+    main()
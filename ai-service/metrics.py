@@ -0,0 +1,420 @@
+# --- Request latency metrics ---
+# Every request is timed per endpoint, and its hot stages (query encoding, the
+# FAISS search, MongoDB reads, JSON serialization, ...) per endpoint and stage,
+# into fixed-bucket histograms. GET /metrics returns them in the Prometheus text
+# format, together with the service's counters and gauges (index size, cache
+# hits, queue depths). A stage is timed with
+#
+#   with metrics.stage('encode'):
+#       vector = query_encoder.encode([query])
+#
+# or @metrics.timed('encode') on a function. Stages nest (an inner stage's time
+# also counts toward the outer one) and belong to the endpoint serving the
+# current request; outside a request they are recorded under endpoint "none".
+#
+# gunicorn runs several workers and a scrape reaches only one of them, so every
+# worker writes its numbers to METRICS_DIR (about once a second when they
+# changed) and /metrics adds up all the files. Files of exited workers are kept,
+# so their requests stay in the totals; per-worker gauges (cache and queue state)
+# are reported with a pid label for live workers only. Empty METRICS_DIR reports
+# the answering process alone. Clear the directory on deploy to reset the totals.
+#
+# Slow-request profiling is off unless PROFILE_SLOW_MS is set: a sampling thread
+# then records the stack of each in-flight request every PROFILE_INTERVAL_MS,
+# and a request slower than PROFILE_SLOW_MS has its samples written to
+# PROFILE_DIR in the folded-stack format flamegraph.pl and speedscope read:
+#
+#   flamegraph.pl profiles/semantic_search-20240501-101500-1830ms-4242.folded > flame.svg
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "thesis_metrics")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 1))
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Only the newest profiles are kept
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 200))
+
+HISTOGRAMS = {
+    'thesis_request_duration_seconds': (('endpoint',), 'Request latency by endpoint.'),
+    'thesis_stage_duration_seconds': (('endpoint', 'stage'), 'Latency of the stages inside a request.'),
+}
+COUNTERS = {
+    'thesis_requests_total': (('endpoint', 'status'), 'Requests served, by endpoint and HTTP status.'),
+    'thesis_slow_requests_profiled_total': (('endpoint',), 'Slow requests whose profile was written to PROFILE_DIR.'),
+}
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._gauge_sources = []      # (function, per_worker)
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.histograms = {}          # (name, labels) -> [bucket counts..., +Inf count], sum
+        self.counters = Counter()     # (name, labels) -> value
+        self._pid = os.getpid()
+        self._started = time.time()
+        self._dirty = False
+        self._flusher = None
+        self._warned = False
+
+    def after_fork(self):
+        # A forked worker starts from zero: the master's numbers are not its own
+        self._reset()
+
+    def add_gauges(self, function, per_worker=False):
+        # function() returns (name, type, help, labels dict, value) samples. Shared gauges
+        # (index size, job queue) are read by the process answering the scrape; per-worker
+        # ones (its caches, its encoder queue) are saved with its numbers and get a pid label.
+        self._gauge_sources.append((function, per_worker))
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            entry = self.histograms.get((name, labels))
+            if entry is None:
+                entry = self.histograms[(name, labels)] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            bucket = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    bucket = i
+                    break
+            entry[0][bucket] += 1
+            entry[1] += seconds
+            self._dirty = True
+        self._ensure_flusher()
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+            self._dirty = True
+        self._ensure_flusher()
+
+    # --- Sharing numbers between workers ---
+    def _path(self):
+        # Start time in the name: a later worker reusing the pid must not overwrite the old counts
+        return os.path.join(self.directory, f'worker-{self._pid}-{int(self._started * 1000)}.json')
+
+    def _gauges(self, per_worker):
+        samples = []
+        for function, source_per_worker in self._gauge_sources:
+            if source_per_worker != per_worker:
+                continue
+            try:
+                samples.extend(function())
+            except Exception as e:
+                print(f"Metrics: gauge collection failed: {e}")
+        return samples
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [[name, list(labels), counts[:], total] for (name, labels), (counts, total) in self.histograms.items()]
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            self._dirty = False
+        return {'pid': self._pid, 'histograms': histograms, 'counters': counters,
+                'gauges': [list(sample) for sample in self._gauges(per_worker=True)]}
+
+    def flush(self):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path()
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            if not self._warned:
+                print(f"Metrics: could not write {self.directory} ({e}); /metrics reports this worker only.")
+                self._warned = True
+
+    def _ensure_flusher(self):
+        if not self.directory or self._flusher is not None:
+            return
+        with self.lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        # Written when something changed, and every so often anyway to refresh the per-worker gauges
+        ticks = 0
+        while True:
+            time.sleep(self.flush_seconds)
+            ticks += 1
+            if self._dirty or ticks % 15 == 0:
+                self.flush()
+
+    def _snapshots(self):
+        # This process's numbers and those of every other worker that saved any
+        own = self.snapshot()
+        if not self.directory:
+            return [own]
+        self.flush()
+        snapshots = [own]
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return snapshots
+        own_name = os.path.basename(self._path())
+        for name in names:
+            if not name.startswith('worker-') or not name.endswith('.json') or name == own_name:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _alive(snapshot.get('pid')):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return snapshots
+
+    # --- Prometheus text format ---
+    def render(self):
+        histograms, counters, worker_gauges = {}, Counter(), []
+        for snapshot in self._snapshots():
+            for name, labels, counts, total in snapshot['histograms']:
+                entry = histograms.setdefault((name, tuple(labels)), [[0] * len(counts), 0.0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+            for name, labels, value in snapshot['counters']:
+                counters[(name, tuple(labels))] += value
+            for name, kind, help_text, labels, value in snapshot['gauges']:
+                worker_gauges.append((name, kind, help_text, dict(labels, pid=snapshot['pid']), value))
+
+        lines = []
+        for name, (label_names, help_text) in HISTOGRAMS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for (entry_name, labels), (counts, total) in sorted(histograms.items()):
+                if entry_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(label_names, labels, [("le", _number(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(label_names, labels)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(label_names, labels)} {cumulative}')
+        for name, (label_names, help_text) in COUNTERS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (entry_name, labels), value in sorted(counters.items()):
+                if entry_name == name:
+                    lines.append(f'{name}{_labels(label_names, labels)} {_number(value)}')
+
+        declared = set()
+        for name, kind, help_text, labels, value in self._gauges(per_worker=False) + worker_gauges:
+            if value is None:
+                continue
+            if name not in declared:
+                declared.add(name)
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines.append(f'{name}{_labels(labels.keys(), labels.values())} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass    # exists, owned by someone else
+    return True
+
+
+# --- Sampling profiler for slow requests ---
+def _folded(frame):
+    # root;...;leaf stack of a frame, one entry per function
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms=PROFILE_SLOW_MS, interval_ms=PROFILE_INTERVAL_MS, directory=PROFILE_DIR):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.lock = threading.Lock()
+        self._requests = {}     # thread id -> Counter of folded stacks
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def _ensure_started(self):
+        # One sampler thread per process; it doesn't survive a fork, so workers start their own
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._requests = {}
+            threading.Thread(target=self._sample_loop, name='slow-request-profiler', daemon=True).start()
+
+    def begin(self):
+        self._ensure_started()
+        with self.lock:
+            self._requests[threading.get_ident()] = Counter()
+
+    def end(self, endpoint, seconds):
+        # True if the request was slow and its profile was written
+        with self.lock:
+            samples = self._requests.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return False
+        try:
+            self._write(endpoint, seconds, samples)
+        except OSError as e:
+            print(f"Profiler: could not write the profile of a slow {endpoint} request: {e}")
+            return False
+        return True
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self._requests:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._requests.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_folded(frame)] += 1
+                frames = frame = None   # don't keep the sampled frames (and their locals) alive
+
+    def _write(self, endpoint, seconds, samples):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{endpoint}-{time.strftime('%Y%m%d-%H%M%S')}-{int(seconds * 1000)}ms-{os.getpid()}.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        print(f"Slow request to {endpoint} ({seconds * 1000:.0f} ms): profile written to {path}")
+        profiles = sorted((os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith('.folded')),
+                          key=os.path.getmtime)
+        for old in profiles[:-PROFILE_MAX_FILES]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+registry = Registry()
+profiler = SlowRequestProfiler()
+
+
+def after_fork():
+    registry.after_fork()
+
+
+def add_gauges(function, per_worker=False):
+    registry.add_gauges(function, per_worker)
+
+
+def current_endpoint():
+    return getattr(_local, 'endpoint', None) or 'none'
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('thesis_stage_duration_seconds', (current_endpoint(), name), time.perf_counter() - started)
+
+
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def begin_request(endpoint):
+    _local.endpoint = endpoint
+    _local.started = time.perf_counter()
+    if profiler.enabled:
+        profiler.begin()
+
+
+def end_request(status):
+    # Safe to call twice (after_request, then teardown): only the first call records
+    started = getattr(_local, 'started', None)
+    if started is None:
+        return
+    endpoint = current_endpoint()
+    seconds = time.perf_counter() - started
+    _local.started = None
+    _local.endpoint = None
+    registry.observe('thesis_request_duration_seconds', (endpoint,), seconds)
+    registry.inc('thesis_requests_total', (endpoint, str(status)))
+    if profiler.enabled and profiler.end(endpoint, seconds):
+        registry.inc('thesis_slow_requests_profiled_total', (endpoint,))
+
+
+def instrument(app):
+    # Times every request of a Flask app; register before the app's other hooks so they are timed too.
+    # A streamed response is timed up to its first byte, not until the stream ends.
+    from flask import request
+
+    @app.before_request
+    def _begin_request_timer():
+        begin_request(request.endpoint or 'unmatched')
+
+    @app.after_request
+    def _end_request_timer(response):
+        end_request(response.status_code)
+        return response
+
+    @app.teardown_request
+    def _end_failed_request_timer(error=None):
+        end_request(500)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,401 @@
+# --- Full-text passage index ---
+# The search index embeds abstracts only, and the model truncates its input
+# to 256 word pieces anyway, so a query about a thesis's methods or results
+# chapter never reaches them. This index covers the whole text: each thesis
+# is split into overlapping word windows (passages), every passage is
+# embedded, and a query is matched against all passages and pooled back to
+# theses, either by the best passage (max) or by the sum over the thesis's
+# retrieved passages (sum). Every hit carries its best passage's offset.
+#
+# Passage vectors are stored as float16 (768 bytes each for 384 dims). With
+# PASSAGE_CODEC=pq they become 8-bit product-quantization codes (96 bytes)
+# once there are enough passages to train the codebooks, which keeps
+# millions of passages in memory.
+#
+# Like the plagiarism index it follows the search index: the sync leader
+# embeds new and edited theses and saves one .npz, and the other workers
+# reload it when it changes.
+import hashlib
+import json
+import os
+import threading
+import time
+
+import faiss
+import numpy as np
+from bson.objectid import ObjectId
+
+import ann_index
+from plagiarism import tokenize
+from thesis_text import SOURCE_TEXT_VERSION, source_text
+
+PASSAGE_INDEX_PATH = os.environ.get("PASSAGE_INDEX_PATH", "thesis_passages.npz")
+# ~160 words stay inside the model's 256 word-piece window; consecutive passages share 40
+PASSAGE_WORDS = int(os.environ.get("PASSAGE_WORDS", 160))
+PASSAGE_STRIDE = int(os.environ.get("PASSAGE_STRIDE", 120))
+PASSAGE_ENCODE_BATCH = 64
+PASSAGE_CODEC = os.environ.get("PASSAGE_CODEC", "fp16")   # fp16 or pq
+# Passages retrieved per query before pooling them into theses
+PASSAGE_CANDIDATES = int(os.environ.get("PASSAGE_CANDIDATES", 200))
+POOLING = ('max', 'sum')
+
+PROJECTION = {'_id': 1, 'full_text': 1, 'abstract': 1}
+# What passage offsets point into: the same choice as source_text, made by MongoDB
+_FULL_TEXT = {'$ifNull': ['$full_text', '']}
+_SOURCE_TEXT = {'$cond': [{'$and': [{'$gt': [{'$strLenCP': {'$trim': {'input': _FULL_TEXT}}}, 0]},
+                                    {'$ne': [{'$substrCP': [_FULL_TEXT, 0, 4]}, '%PDF']}]},
+                          _FULL_TEXT, {'$ifNull': ['$abstract', '']}]}
+
+
+def passages(text):
+    # (start, end) character spans of overlapping PASSAGE_WORDS-word windows
+    _, starts, ends = tokenize(text)
+    count = len(starts)
+    if count == 0:
+        return []
+    firsts = list(range(0, max(count - PASSAGE_WORDS, 0) + 1, PASSAGE_STRIDE))
+    if firsts[-1] + PASSAGE_WORDS < count:
+        firsts.append(count - PASSAGE_WORDS)  # tail passage, so the end of the text is covered too
+    return [(int(starts[first]), int(ends[min(count, first + PASSAGE_WORDS) - 1])) for first in firsts]
+
+
+def _codec(index):
+    return 'pq' if isinstance(index, faiss.IndexIVFPQ) else 'fp16'
+
+
+def _code_size(index):
+    return index.code_size if _codec(index) == 'pq' else faiss.downcast_index(index.index).code_size
+
+
+def _renumber_ids(index, live):
+    # Maps every FAISS id i still in index to its position in live (the sorted surviving ids)
+    if _codec(index) == 'pq':
+        invlists = index.invlists
+        for list_no in range(index.nlist):
+            size = invlists.list_size(list_no)
+            if not size:
+                continue
+            ids = np.searchsorted(live, faiss.rev_swig_ptr(invlists.get_ids(list_no), size)).astype('int64')
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * invlists.code_size).copy()
+            invlists.update_entries(list_no, 0, size, faiss.swig_ptr(ids), faiss.swig_ptr(codes))
+    else:
+        ids = faiss.vector_to_array(index.id_map)
+        faiss.copy_array_to_vector(np.searchsorted(live, ids).astype('int64'), index.id_map)
+        index.construct_rev_map()
+
+
+class PassageIndex:
+    def __init__(self, collection, encode, model_name=None, path=PASSAGE_INDEX_PATH):
+        self.collection = collection
+        self.encode = encode
+        # Embedding model the vectors came from; a saved index from another model is discarded
+        self.model_name = model_name
+        self.path = path
+        self.lock = threading.RLock()
+        self.index = None           # fp16 codes in an IndexIDMap2, or PQ codes; ids are passage numbers
+        self.thesis_ids = []        # doc index -> thesis id
+        self.doc_of = {}            # thesis id -> doc index
+        self.text_hashes = {}       # thesis id -> hash of the indexed text
+        self.index_hashes = {}      # thesis id -> search index hash (index_sync.hashes) last checked against
+        self.passage_doc = np.empty(0, dtype=np.int32)
+        self.passage_start = np.empty(0, dtype=np.int64)
+        self.passage_end = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.generation = 0
+        self._mtime = None
+        self._checked = 0
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+        self._requested = set()     # theses whose text changed outside the search index (new PDF text)
+
+    # --- Persistence ---
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as data:
+            registry = json.loads(str(data['registry']))
+            if registry.get('model') != self.model_name:
+                print(f"Passage index was encoded with {registry.get('model')}; re-embedding for {self.model_name}.")
+                self._mtime = os.path.getmtime(self.path)
+                return False
+            index = faiss.deserialize_index(data['index']) if registry.get('has_index') else None
+            with self.lock:
+                self.index = index
+                self.passage_doc = data['passage_doc']
+                self.passage_start = data['passage_start']
+                self.passage_end = data['passage_end']
+                self.alive = data['alive']
+                self.thesis_ids = registry['thesis_ids']
+                self.text_hashes = registry['text_hashes']
+                self.index_hashes = registry.get('index_hashes', {})
+                if registry.get('source_text') != SOURCE_TEXT_VERSION:
+                    # Built before raw PDF bytes were skipped: every thesis is re-checked once
+                    self.index_hashes = {}
+                self.doc_of = {t: i for i, t in enumerate(self.thesis_ids) if t in self.text_hashes}
+                self.generation = registry.get('generation', 0)
+        self._mtime = os.path.getmtime(self.path)
+        print(f"Loaded passage index ({int(self.alive.sum())} passages from {len(self.doc_of)} theses"
+              f"{', ' + _codec(index) if index is not None else ''}).")
+        return True
+
+    def save(self):
+        with self.lock:
+            self._compact()
+            self._maybe_quantize()
+            registry = json.dumps({'thesis_ids': self.thesis_ids, 'text_hashes': self.text_hashes,
+                                   'index_hashes': self.index_hashes, 'source_text': SOURCE_TEXT_VERSION,
+                                   'model': self.model_name, 'generation': self.generation,
+                                   'has_index': self.index is not None})
+            serialized = faiss.serialize_index(self.index) if self.index is not None else np.empty(0, dtype='uint8')
+            tmp_path = f"{self.path}.tmp.npz"
+            np.savez(tmp_path, index=serialized, passage_doc=self.passage_doc, passage_start=self.passage_start,
+                     passage_end=self.passage_end, alive=self.alive, registry=registry)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    def reload_if_changed(self):
+        # Workers that don't run the refresh pick up the leader's index (checked at most once a second)
+        now = time.time()
+        if now - self._checked < 1:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def _maybe_quantize(self):
+        # fp16 -> PQ codes once PASSAGE_CODEC=pq and there are enough passages to train on.
+        # Vectors are decoded from fp16 in slices, so the switch never holds them all as float32.
+        if PASSAGE_CODEC != 'pq' or self.index is None or _codec(self.index) == 'pq':
+            return
+        n = self.index.ntotal
+        if n < (1 << ann_index.PQ_NBITS) * ann_index.MIN_POINTS_PER_CENTROID:
+            return
+        base = faiss.downcast_index(self.index.index)
+        ids = faiss.vector_to_array(self.index.id_map)
+        d = self.index.d
+        sample = np.linspace(0, n - 1, min(n, 65536)).astype('int64')
+        # A single inverted list is an exhaustive PQ scan; unlike IndexPQ, IVF takes the id
+        # selector that filtered searches need and stores the passage ids itself
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(d), d, 1, ann_index.choose_pq_m(d), ann_index.PQ_NBITS,
+                                 faiss.METRIC_INNER_PRODUCT)
+        index.train(np.vstack([base.reconstruct(int(i)) for i in sample]).astype('float32'))
+        for start in range(0, n, 65536):
+            count = min(65536, n - start)
+            index.add_with_ids(base.reconstruct_n(start, count), ids[start:start + count])
+        self.index = index
+        print(f"Passage index switched to PQ codes ({n} passages, {index.code_size} bytes each).")
+
+    # --- Indexing ---
+    def _new_index(self, d):
+        return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT))
+
+    def _embed(self, text, spans):
+        # Runs outside the lock: encoding a long thesis takes a while
+        vectors = []
+        for start in range(0, len(spans), PASSAGE_ENCODE_BATCH):
+            batch = [text[a:b] for a, b in spans[start:start + PASSAGE_ENCODE_BATCH]]
+            vectors.append(np.asarray(self.encode(batch), dtype='float32'))
+        return ann_index.normalize(np.vstack(vectors))
+
+    def _swap_in(self, removed, added):
+        # Called under the lock with one refresh chunk: removed thesis ids, added
+        # (thesis_id, digest, spans, vectors) tuples. The passage arrays and the FAISS index
+        # grow once per chunk, so building the index doesn't copy them once per thesis.
+        docs = []
+        for thesis_id in removed:
+            doc = self.doc_of.pop(thesis_id, None)
+            self.text_hashes.pop(thesis_id, None)
+            if doc is not None:
+                docs.append(doc)
+        if docs:
+            dead = np.flatnonzero(np.isin(self.passage_doc, docs) & self.alive)
+            if len(dead) and self.index is not None:
+                self.index.remove_ids(dead.astype('int64'))
+            self.alive[dead] = False
+
+        new_docs, new_spans, new_vectors = [], [], []
+        for thesis_id, digest, spans, vectors in added:
+            doc = len(self.thesis_ids)
+            self.thesis_ids.append(thesis_id)
+            self.doc_of[thesis_id] = doc
+            self.text_hashes[thesis_id] = digest
+            new_docs.append(np.full(len(spans), doc, dtype=np.int32))
+            new_spans.append(np.array(spans, dtype=np.int64))
+            new_vectors.append(vectors)
+        if not new_vectors:
+            return
+        spans = np.vstack(new_spans)
+        vectors = np.vstack(new_vectors)
+        if self.index is None:
+            self.index = self._new_index(vectors.shape[1])
+        first = len(self.passage_doc)
+        self.passage_doc = np.concatenate([self.passage_doc] + new_docs)
+        self.passage_start = np.concatenate([self.passage_start, spans[:, 0]])
+        self.passage_end = np.concatenate([self.passage_end, spans[:, 1]])
+        self.alive = np.concatenate([self.alive, np.ones(len(spans), dtype=bool)])
+        self.index.add_with_ids(vectors, np.arange(first, first + len(spans), dtype='int64'))
+
+    def _compact(self):
+        # Drops removed passages once they make up a fifth of the arrays. Passage numbers (the
+        # FAISS ids) are renumbered in place; no vector is decoded or re-encoded.
+        dead = len(self.alive) - int(self.alive.sum())
+        if not dead or dead <= 0.2 * len(self.alive):
+            return
+        live = np.flatnonzero(self.alive)
+        if self.index is not None:
+            _renumber_ids(self.index, live)
+        self.passage_doc = self.passage_doc[live]
+        self.passage_start = self.passage_start[live]
+        self.passage_end = self.passage_end[live]
+        self.alive = np.ones(len(live), dtype=bool)
+        print(f"Passage index compacted: {dead} removed passages dropped.")
+
+    def refresh_theses(self, thesis_ids):
+        # Re-reads the given theses from MongoDB and re-embeds the ones whose text changed
+        if self.collection is None or not thesis_ids:
+            return 0
+        object_ids = [ObjectId(t) for t in thesis_ids if ObjectId.is_valid(t)]
+        found = {str(doc['_id']): doc for doc in self.collection.find({'_id': {'$in': object_ids}}, PROJECTION)}
+        removed, added = [], []
+        for thesis_id in thesis_ids:
+            doc = found.get(thesis_id)
+            text = source_text(doc) if doc else ''
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest() if text else None
+            if digest == self.text_hashes.get(thesis_id):
+                continue
+            removed.append(thesis_id)
+            spans = passages(text)
+            if spans:
+                added.append((thesis_id, digest, spans, self._embed(text, spans)))
+        if not removed:
+            return 0
+        with self.lock:
+            self._swap_in(removed, added)
+            self.generation += 1
+        return len(removed)
+
+    def refresh_from_index(self, index_sync, thesis_ids=()):
+        # Follows the theses the search index knows about (new, edited, deleted), plus thesis_ids.
+        # Like the plagiarism index, a thesis is re-read when its search index hash moved.
+        with index_sync.lock:
+            current = {t: index_sync.hashes.get(t) for t in index_sync.ids}
+        with self.lock:
+            known = set(self.doc_of) | set(self.index_hashes)
+            stale = ({t for t, digest in current.items() if self.index_hashes.get(t) != digest}
+                     | (known - set(current)))
+        stale = sorted(stale | (set(thesis_ids) & set(current)))
+        started = time.time()
+        changed = 0
+        for start in range(0, len(stale), 100):
+            chunk = stale[start:start + 100]
+            changed += self.refresh_theses(chunk)
+            with self.lock:
+                for thesis_id in chunk:
+                    if thesis_id in current:
+                        self.index_hashes[thesis_id] = current[thesis_id]
+                    else:
+                        self.index_hashes.pop(thesis_id, None)
+        if stale:
+            self.save()
+            print(f"Passage index refreshed: {changed} theses in {time.time() - started:.1f}s.")
+        return changed
+
+    def after_fork(self):
+        # A refresh running in the parent at fork time would otherwise hold the locks forever
+        self.lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+
+    def refresh_async(self, index_sync, thesis_ids=()):
+        # Index listener: refreshes in the background; changes arriving meanwhile trigger one more pass.
+        # thesis_ids are re-read even if the search index didn't change (e.g. their PDF text did).
+        self._requested.update(thesis_ids)
+        if not self._refresh_lock.acquire(blocking=False):
+            self._rerun = True
+            return
+
+        def run():
+            try:
+                while True:
+                    self._rerun = False
+                    requested, self._requested = self._requested, set()
+                    self.refresh_from_index(index_sync, requested)
+                    if not self._rerun:
+                        break
+            except Exception as e:
+                print(f"Error refreshing passage index: {e}")
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, daemon=True, name="passage-index").start()
+
+    # --- Querying ---
+    def search(self, query_embedding, top_k, pooling='max', allowed=None):
+        # Returns (score, thesis_id, passage) triples, best first. passage has the character
+        # offset and length of the thesis's best passage and its cosine similarity.
+        # allowed: thesis ids to search among (None = all); applied inside the FAISS search.
+        self.reload_if_changed()
+        query = ann_index.normalize(query_embedding[:1])
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                return []
+            params = None
+            if allowed is not None:
+                docs = np.zeros(len(self.thesis_ids), dtype=bool)
+                docs[[self.doc_of[t] for t in allowed if t in self.doc_of]] = True
+                mask = docs[self.passage_doc] & self.alive
+                # The bitmap must outlive the search: FAISS only keeps a pointer to it (and its size in bytes)
+                packed = np.packbits(mask, bitorder='little')
+                params = ann_index.search_parameters(self.index, faiss.IDSelectorBitmap(len(packed), faiss.swig_ptr(packed)))
+            k = min(self.index.ntotal, max(PASSAGE_CANDIDATES, top_k * 20))
+            scores, ids = self.index.search(query, k, params=params)
+
+            pooled, best, hits = {}, {}, {}
+            for score, passage in zip(scores[0].tolist(), ids[0].tolist()):
+                if passage < 0:
+                    continue
+                doc = int(self.passage_doc[passage])
+                # FAISS returns passages best first, so a thesis's first passage is its best
+                best.setdefault(doc, (score, passage))
+                hits[doc] = hits.get(doc, 0) + 1
+                if pooling == 'max':
+                    pooled.setdefault(doc, score)
+                else:
+                    pooled[doc] = pooled.get(doc, 0.0) + score
+            ranked = sorted(pooled, key=pooled.get, reverse=True)[:top_k]
+            results = []
+            for doc in ranked:
+                score, passage = best[doc]
+                start, end = int(self.passage_start[passage]), int(self.passage_end[passage])
+                results.append((pooled[doc], self.thesis_ids[doc], {
+                    'offset': start,
+                    'length': end - start,
+                    'score': score,
+                    'matched_passages': hits[doc]
+                }))
+            return results
+
+    def passage_texts(self, hits):
+        # {thesis_id: passage text} for search() results, cut out by MongoDB so full texts never
+        # cross the wire. Offsets count code points, like $substrCP.
+        if self.collection is None or not hits:
+            return {}
+        branches = [{'case': {'$eq': ['$_id', ObjectId(thesis_id)]},
+                     'then': {'$substrCP': [_SOURCE_TEXT, passage['offset'], passage['length']]}}
+                    for _, thesis_id, passage in hits]
+        pipeline = [{'$match': {'_id': {'$in': [ObjectId(thesis_id) for _, thesis_id, _ in hits]}}},
+                    {'$project': {'passage': {'$switch': {'branches': branches, 'default': ''}}}}]
+        return {str(doc['_id']): doc['passage'] for doc in self.collection.aggregate(pipeline)}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'theses': len(self.doc_of),
+                'passages': int(self.alive.sum()),
+                'codec': _codec(self.index) if self.index is not None else None,
+                'vector_bytes': self.index.ntotal * _code_size(self.index) if self.index is not None else 0
+            }
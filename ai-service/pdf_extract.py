@@ -0,0 +1,238 @@
+# --- PDF text extraction ---
+# Fills each thesis's full_text from its uploaded PDF (backend/uploads).
+# PDFs are read page by page with PyMuPDF, so only one page's text is held at
+# a time besides the output, and bulk runs spread files over a process pool.
+# Extracted text is cached by the PDF's content hash, so re-uploads of the
+# same file (the uploads folder has plenty) are never extracted twice.
+#
+#   python pdf_extract.py               # back-fill theses without extracted text
+#   python pdf_extract.py --force       # re-extract every thesis
+#   python pdf_extract.py --workers 4
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bson.objectid import ObjectId
+
+UPLOADS_DIR = os.environ.get(
+    "UPLOADS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'uploads'))
+TEXT_CACHE_PATH = os.environ.get("TEXT_CACHE_PATH", "thesis_text_cache.sqlite3")
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+HASH_CHUNK_BYTES = 1 << 20
+WRITE_BATCH_SIZE = 100
+
+_HYPHENATED = re.compile(r"(\w)-\n(\w)")
+_LINE_BREAK = re.compile(r"(?<!\n)\n(?!\n)")
+_SPACES = re.compile(r"[ \t\f\v ]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def file_hash(path):
+    # Streams the file so large PDFs are never read into memory at once
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_pdf_path(file_path):
+    # filePath is relative to the backend and may use Windows separators ("uploads\\123-x.pdf")
+    if not file_path:
+        return None
+    if os.path.isfile(file_path):
+        return file_path
+    candidate = os.path.join(UPLOADS_DIR, re.split(r"[\\/]", file_path)[-1])
+    return candidate if os.path.isfile(candidate) else None
+
+
+def normalize_text(text):
+    # Joins words hyphenated across lines and lines within a paragraph; keeps paragraph breaks
+    text = unicodedata.normalize('NFKC', text).replace('\x00', '').replace('\r', '')
+    text = _HYPHENATED.sub(r"\1\2", text)
+    text = _BLANK_LINES.sub('\n\n', text)
+    text = _LINE_BREAK.sub(' ', text)
+    text = _SPACES.sub(' ', text)
+    return '\n\n'.join(p.strip() for p in text.split('\n\n') if p.strip())
+
+
+def extract_pdf(path):
+    # Runs in pool processes, so PyMuPDF is imported here rather than by every importer
+    import pymupdf
+    pages = []
+    with pymupdf.open(path) as document:
+        page_count = document.page_count
+        for page in document:
+            pages.append(normalize_text(page.get_text('text', sort=True)))
+    return '\n\n'.join(p for p in pages if p), page_count
+
+
+class TextCache:
+    def __init__(self, path=TEXT_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS extracted_text ("
+            " file_hash TEXT PRIMARY KEY,"
+            " pages INTEGER NOT NULL,"
+            " text BLOB NOT NULL)"
+        )
+        self.conn.commit()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self._connect()
+
+    def get(self, digest):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT text, pages FROM extracted_text WHERE file_hash = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8'), row[1]
+
+    def put(self, digest, text, pages):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO extracted_text VALUES (?, ?, ?)",
+                              (digest, pages, zlib.compress(text.encode('utf-8'), 6)))
+            self.conn.commit()
+
+
+def extract_thesis(collection, cache, thesis_id):
+    # Single-upload hook: extracts (or reuses) one thesis's PDF text and stores it as full_text
+    doc = collection.find_one({'_id': ObjectId(thesis_id)}, {'filePath': 1})
+    if doc is None:
+        return None
+    path = resolve_pdf_path(doc.get('filePath'))
+    if path is None:
+        raise FileNotFoundError(f"PDF for thesis {thesis_id} not found ({doc.get('filePath')})")
+
+    digest = file_hash(path)
+    cached = cache.get(digest)
+    if cached is None:
+        text, pages = extract_pdf(path)
+        cache.put(digest, text, pages)
+    else:
+        text, pages = cached
+    collection.update_one({'_id': doc['_id']}, {'$set': {'full_text': text}})
+    return {'pages': pages, 'characters': len(text), 'cached': cached is not None}
+
+
+def backfill(collection, cache, force=False, workers=PDF_EXTRACT_WORKERS):
+    from pymongo import UpdateOne
+
+    query = {'filePath': {'$exists': True, '$ne': None}}
+    if not force:
+        # The upload route used to store the raw PDF bytes decoded as UTF-8
+        query['$or'] = [{'full_text': {'$exists': False}}, {'full_text': ''}, {'full_text': {'$regex': '^%PDF'}}]
+
+    by_hash = {}          # file hash -> thesis ids using that file
+    paths = {}            # file hash -> one path to extract it from
+    missing = 0
+    for doc in collection.find(query, {'filePath': 1}):
+        path = resolve_pdf_path(doc.get('filePath'))
+        if path is None:
+            missing += 1
+            continue
+        digest = file_hash(path)
+        by_hash.setdefault(digest, []).append(doc['_id'])
+        paths.setdefault(digest, path)
+
+    stats = {'theses': sum(len(v) for v in by_hash.values()), 'files': len(by_hash),
+             'extracted': 0, 'cached': 0, 'failed': 0, 'missing_files': missing}
+    updated = []
+    pending = []
+
+    def write(digest, text):
+        pending.extend(UpdateOne({'_id': _id}, {'$set': {'full_text': text}}) for _id in by_hash[digest])
+        updated.extend(str(_id) for _id in by_hash[digest])
+        if len(pending) >= WRITE_BATCH_SIZE:
+            collection.bulk_write(pending, ordered=False)
+            del pending[:]
+
+    to_extract = []
+    for digest in by_hash:
+        cached = cache.get(digest)
+        if cached is None:
+            to_extract.append(digest)
+        else:
+            stats['cached'] += 1
+            write(digest, cached[0])
+
+    started = time.time()
+    if to_extract:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(to_extract)))) as pool:
+            futures = {pool.submit(extract_pdf, paths[digest]): digest for digest in to_extract}
+            for future in as_completed(futures):
+                digest = futures[future]
+                try:
+                    text, pages = future.result()
+                except Exception as e:
+                    stats['failed'] += 1
+                    print(f"Error extracting {paths[digest]}: {e}")
+                    continue
+                cache.put(digest, text, pages)
+                stats['extracted'] += 1
+                write(digest, text)
+    if pending:
+        collection.bulk_write(pending, ordered=False)
+    stats['seconds'] = round(time.time() - started, 1)
+    return stats, updated
+
+
+def main():
+    from pymongo import MongoClient
+
+    from encoder_backends import load_model, embedding_model_name
+    from index_sync import IndexSync
+    from passage_index import PassageIndex
+    from plagiarism import PlagiarismIndex
+
+    parser = argparse.ArgumentParser(description="Extract full_text for uploaded thesis PDFs.")
+    parser.add_argument('--force', action='store_true', help="Re-extract theses that already have text")
+    parser.add_argument('--workers', type=int, default=PDF_EXTRACT_WORKERS)
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+    collection = client[os.environ.get("DB_NAME", "digi-thesis_DB")][os.environ.get("COLLECTION_NAME", "theses")]
+    stats, updated = backfill(collection, TextCache(), force=args.force, workers=args.workers)
+    print(f"PDF back-fill: {stats}")
+
+    # Full texts feed the plagiarism and passage indexes, which don't see full_text-only changes on their own
+    if not updated:
+        return
+    # Only the index sync leader writes them: a running server's leader gets the theses handed
+    # over (so its own copy isn't saved over ours), otherwise this process takes the lock
+    index_sync = IndexSync(None, None)
+    if not index_sync.acquire_leadership():
+        index_sync.request_refresh(updated)
+        print(f"Handed {len(updated)} theses to the running server's index sync leader.")
+        return
+    plagiarism_index = PlagiarismIndex(collection)
+    plagiarism_index.load()
+    if plagiarism_index.refresh_theses(updated):
+        plagiarism_index.save()
+
+    model = load_model()
+    passage_index = PassageIndex(collection, model.encode, embedding_model_name())
+    passage_index.load()
+    changed = passage_index.refresh_theses(updated)
+    if changed:
+        passage_index.save()
+    print(f"Passage index: {changed} theses re-embedded.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+# --- MinHash/LSH plagiarism index ---
+# Indexes every thesis in the collection as fixed-size word windows. Each
+# window gets a MinHash signature over its word 5-gram shingles, and the
+# signature's bands go into LSH tables (sorted numpy arrays + a small delta),
+# so candidate passages are found with binary searches instead of comparing
+# the submitted text against every thesis. Candidates are then confirmed by
+# exact shingle overlap, which yields matched spans with character offsets.
+#
+# A pasted chapter is matched as a set of windows too, which is what makes
+# partial copies (containment) findable; whole-document Jaccard would miss them.
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from thesis_text import SOURCE_TEXT_VERSION, source_text
+
+PLAGIARISM_INDEX_PATH = os.environ.get("PLAGIARISM_INDEX_PATH", "thesis_plagiarism.npz")
+SHINGLE_WORDS = 5
+WINDOW_WORDS = int(os.environ.get("PLAGIARISM_WINDOW_WORDS", 150))
+NUM_PERM = 128
+BANDS = 32                      # 32 bands x 4 rows: windows with Jaccard >= ~0.42 collide
+ROWS = NUM_PERM // BANDS
+MIN_SPAN_WORDS = 8              # shorter overlaps are usually stock phrases
+MAX_CANDIDATES = 10             # theses confirmed per query
+DELTA_MERGE_SIZE = 20000        # merge the delta into the sorted tables past this many windows
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(1)  # fixed seed: stored band hashes must stay comparable
+_PERM_A = _rng.randint(1, 1 << 32, NUM_PERM, dtype=np.uint64).reshape(-1, 1)
+_PERM_B = _rng.randint(0, 1 << 32, NUM_PERM, dtype=np.uint64).reshape(-1, 1)
+_BAND_WEIGHTS = np.array([1000003 ** i for i in range(ROWS)], dtype=np.uint64)
+_TOKEN_RE = re.compile(r"\w+")
+
+PROJECTION = {'_id': 1, 'full_text': 1, 'abstract': 1, 'title': 1, 'authorName': 1}
+
+
+def tokenize(text):
+    # Lowercased word tokens with their character offsets in the original text
+    matches = list(_TOKEN_RE.finditer(text))
+    words = [m.group().lower() for m in matches]
+    starts = np.array([m.start() for m in matches], dtype=np.int64)
+    ends = np.array([m.end() for m in matches], dtype=np.int64)
+    return words, starts, ends
+
+
+def shingle_hashes(words, k=SHINGLE_WORDS):
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    k = min(k, len(words))
+    tokens = np.array([zlib.crc32(w.encode('utf-8')) for w in words], dtype=np.uint64)
+    count = len(words) - k + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(k):
+            hashes = hashes * np.uint64(1000003) + tokens[j:j + count]
+    return hashes
+
+
+def minhash(shingles):
+    # 32-bit-reduced shingles keep a*x + b inside uint64
+    x = (shingles ^ (shingles >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+    with np.errstate(over='ignore'):
+        return ((_PERM_A * x + _PERM_B) % _MERSENNE).min(axis=1)
+
+
+def band_hashes(signature):
+    with np.errstate(over='ignore'):
+        return (signature.reshape(BANDS, ROWS) * _BAND_WEIGHTS).sum(axis=1)
+
+
+def windows(shingles, stride):
+    # (start, stop) shingle ranges of WINDOW_WORDS-word windows; short texts are one window
+    count = len(shingles)
+    if count == 0:
+        return []
+    size = max(1, WINDOW_WORDS - SHINGLE_WORDS + 1)
+    starts = list(range(0, max(count - size, 0) + 1, stride))
+    if starts[-1] + size < count:
+        starts.append(count - size)  # tail window, so the end of the text is covered too
+    return [(start, min(count, start + size)) for start in starts]
+
+
+class PlagiarismIndex:
+    def __init__(self, collection, path=PLAGIARISM_INDEX_PATH):
+        self.collection = collection
+        self.path = path
+        self.lock = threading.RLock()
+        self.thesis_ids = []        # doc index -> thesis id
+        self.doc_of = {}            # thesis id -> doc index
+        self.text_hashes = {}       # thesis id -> hash of the indexed text
+        self.index_hashes = {}      # thesis id -> search index hash (index_sync.hashes) last checked against
+        self.passage_doc = np.empty(0, dtype=np.int32)
+        self.passage_bands = np.empty((0, BANDS), dtype=np.uint64)
+        self.alive = np.empty(0, dtype=bool)
+        self._keys = []             # per band: sorted band hashes
+        self._values = []           # per band: passage ids in the same order
+        self._delta = [dict() for _ in range(BANDS)]
+        self._delta_size = 0
+        self._mtime = None
+        self._checked = 0
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+        self._requested = set()     # theses whose text changed outside the search index (new PDF text)
+        self._build_tables()
+
+    # --- Persistence ---
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as data:
+            registry = json.loads(str(data['registry']))
+            with self.lock:
+                self.passage_doc = data['passage_doc']
+                self.passage_bands = data['passage_bands']
+                self.alive = data['alive']
+                self.thesis_ids = registry['thesis_ids']
+                self.text_hashes = registry['text_hashes']
+                self.index_hashes = registry.get('index_hashes', {})
+                if registry.get('source_text') != SOURCE_TEXT_VERSION:
+                    # Built before raw PDF bytes were skipped: every thesis is re-checked once
+                    self.index_hashes = {}
+                self.doc_of = {t: i for i, t in enumerate(self.thesis_ids) if t in self.text_hashes}
+                self._build_tables()
+        self._mtime = os.path.getmtime(self.path)
+        print(f"Loaded plagiarism index ({int(self.alive.sum())} passages from {len(self.doc_of)} theses).")
+        return True
+
+    def save(self):
+        with self.lock:
+            self._compact()
+            registry = json.dumps({'thesis_ids': self.thesis_ids, 'text_hashes': self.text_hashes,
+                                   'index_hashes': self.index_hashes, 'source_text': SOURCE_TEXT_VERSION})
+            tmp_path = f"{self.path}.tmp.npz"
+            np.savez(tmp_path, passage_doc=self.passage_doc, passage_bands=self.passage_bands,
+                     alive=self.alive, registry=registry)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    def reload_if_changed(self):
+        # Workers that don't run the refresh pick up the leader's index (checked at most once a second)
+        now = time.time()
+        if now - self._checked < 1:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def _compact(self):
+        # Drop removed passages once they make up a fifth of the index
+        dead = len(self.alive) - int(self.alive.sum())
+        if dead and dead > 0.2 * len(self.alive):
+            self.passage_doc = self.passage_doc[self.alive]
+            self.passage_bands = self.passage_bands[self.alive]
+            self.alive = np.ones(len(self.passage_doc), dtype=bool)
+            self._build_tables()
+
+    def _build_tables(self):
+        live = np.nonzero(self.alive)[0].astype(np.int32)
+        self._keys, self._values = [], []
+        for band in range(BANDS):
+            keys = self.passage_bands[live, band]
+            order = np.argsort(keys, kind='stable')
+            self._keys.append(keys[order])
+            self._values.append(live[order])
+        self._delta = [dict() for _ in range(BANDS)]
+        self._delta_size = 0
+
+    # --- Indexing ---
+    def _signatures(self, text):
+        # Band hashes of the text's windows, one row per window; None for a text without words
+        words, _, _ = tokenize(text)
+        shingles = shingle_hashes(words)
+        ranges = windows(shingles, stride=max(1, WINDOW_WORDS - SHINGLE_WORDS + 1))
+        if not ranges:
+            return None
+        return np.vstack([band_hashes(minhash(shingles[a:b])) for a, b in ranges])
+
+    def _swap_in(self, removed, added):
+        # Called under the lock with one refresh chunk: removed thesis ids, added
+        # (thesis_id, digest, bands) triples. The passage arrays grow by one concatenate
+        # per chunk, so building the index doesn't copy them once per thesis.
+        docs = []
+        for thesis_id in removed:
+            doc = self.doc_of.pop(thesis_id, None)
+            self.text_hashes.pop(thesis_id, None)
+            if doc is not None:
+                docs.append(doc)
+        if docs:
+            self.alive &= ~np.isin(self.passage_doc, docs)
+
+        new_docs, new_bands = [], []
+        for thesis_id, digest, bands in added:
+            self.text_hashes[thesis_id] = digest
+            if bands is None:
+                continue
+            doc = len(self.thesis_ids)
+            self.thesis_ids.append(thesis_id)
+            self.doc_of[thesis_id] = doc
+            new_docs.append(np.full(len(bands), doc, dtype=np.int32))
+            new_bands.append(bands)
+        if not new_bands:
+            return
+        bands = np.vstack(new_bands)
+        first = len(self.passage_doc)
+        self.passage_doc = np.concatenate([self.passage_doc] + new_docs)
+        self.passage_bands = np.vstack([self.passage_bands, bands])
+        self.alive = np.concatenate([self.alive, np.ones(len(bands), dtype=bool)])
+        for offset, row in enumerate(bands):
+            for band, value in enumerate(row.tolist()):
+                self._delta[band].setdefault(value, []).append(first + offset)
+        self._delta_size += len(bands)
+
+    def refresh_theses(self, thesis_ids):
+        # Re-reads the given theses from MongoDB and re-indexes the ones whose text changed
+        if self.collection is None or not thesis_ids:
+            return 0
+        object_ids = [ObjectId(t) for t in thesis_ids if ObjectId.is_valid(t)]
+        found = {str(doc['_id']): doc for doc in self.collection.find({'_id': {'$in': object_ids}}, PROJECTION)}
+        removed, added = [], []
+        for thesis_id in thesis_ids:
+            doc = found.get(thesis_id)
+            text = source_text(doc) if doc else ''
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest() if text else None
+            if digest == self.text_hashes.get(thesis_id):
+                continue
+            removed.append(thesis_id)
+            if text:
+                added.append((thesis_id, digest, self._signatures(text)))
+        if not removed:
+            return 0
+        # Shingling runs outside the lock; only the swap-in is serialized
+        with self.lock:
+            self._swap_in(removed, added)
+            if self._delta_size > DELTA_MERGE_SIZE:
+                self._build_tables()
+        return len(removed)
+
+    def refresh_from_index(self, index_sync, thesis_ids=()):
+        # Index listener: follows the theses the search index knows about (new, edited, deleted),
+        # plus thesis_ids. A thesis is re-read when its search index hash moved since the last
+        # check; refresh_theses then skips it if the text it indexes (e.g. full_text) is unchanged.
+        with index_sync.lock:
+            current = {t: index_sync.hashes.get(t) for t in index_sync.ids}
+        with self.lock:
+            known = set(self.doc_of) | set(self.index_hashes)
+            stale = sorted({t for t, digest in current.items() if self.index_hashes.get(t) != digest}
+                           | (known - set(current)) | (set(thesis_ids) & set(current)))
+        started = time.time()
+        changed = 0
+        for start in range(0, len(stale), 500):
+            chunk = stale[start:start + 500]
+            changed += self.refresh_theses(chunk)
+            with self.lock:
+                for thesis_id in chunk:
+                    if thesis_id in current:
+                        self.index_hashes[thesis_id] = current[thesis_id]
+                    else:
+                        self.index_hashes.pop(thesis_id, None)
+        if stale:
+            self.save()
+        if changed:
+            print(f"Plagiarism index refreshed: {changed} theses in {time.time() - started:.1f}s.")
+        return changed
+
+    def after_fork(self):
+        # A refresh running in the parent at fork time would otherwise hold the locks forever
+        self.lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._rerun = False
+
+    def refresh_async(self, index_sync, thesis_ids=()):
+        # Index listener: refreshes in the background; changes arriving meanwhile trigger one more pass.
+        # thesis_ids are re-read even if the search index didn't change (e.g. their PDF text did).
+        self._requested.update(thesis_ids)
+        if not self._refresh_lock.acquire(blocking=False):
+            self._rerun = True
+            return
+
+        def run():
+            try:
+                while True:
+                    self._rerun = False
+                    requested, self._requested = self._requested, set()
+                    self.refresh_from_index(index_sync, requested)
+                    if not self._rerun:
+                        break
+            except Exception as e:
+                print(f"Error refreshing plagiarism index: {e}")
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, daemon=True, name="plagiarism-index").start()
+
+    def rebuild(self):
+        with self.lock:
+            self.thesis_ids, self.doc_of, self.text_hashes = [], {}, {}
+            self.index_hashes = {}
+            self.passage_doc = np.empty(0, dtype=np.int32)
+            self.passage_bands = np.empty((0, BANDS), dtype=np.uint64)
+            self.alive = np.empty(0, dtype=bool)
+            self._build_tables()
+        batch = []
+        for doc in self.collection.find({}, {'_id': 1}):
+            batch.append(str(doc['_id']))
+            if len(batch) == 500:
+                self.refresh_theses(batch)
+                batch = []
+        self.refresh_theses(batch)
+        with self.lock:
+            self._build_tables()
+        self.save()
+
+    # --- Querying ---
+    def _candidates(self, query_bands):
+        # Votes per thesis: how many query windows share at least one band with its passages
+        votes = {}
+        with self.lock:
+            for row in query_bands:
+                passages = set()
+                for band in range(BANDS):
+                    keys = self._keys[band]
+                    value = row[band]
+                    lo = np.searchsorted(keys, value, side='left')
+                    hi = np.searchsorted(keys, value, side='right')
+                    passages.update(self._values[band][lo:hi].tolist())
+                    passages.update(self._delta[band].get(int(value), ()))
+                docs = {int(self.passage_doc[p]) for p in passages if self.alive[p]}
+                for doc in docs:
+                    thesis_id = self.thesis_ids[doc]
+                    votes[thesis_id] = votes.get(thesis_id, 0) + 1
+        return sorted(votes, key=votes.get, reverse=True)[:MAX_CANDIDATES]
+
+    def check(self, text):
+        self.reload_if_changed()
+        words, starts, ends = tokenize(text)
+        if len(words) < MIN_SPAN_WORDS:
+            return []
+        shingles = shingle_hashes(words)
+        # Query windows overlap by half so copied text lines up with some indexed window
+        ranges = windows(shingles, stride=max(1, (WINDOW_WORDS - SHINGLE_WORDS + 1) // 2))
+        query_bands = [band_hashes(minhash(shingles[a:b])) for a, b in ranges]
+        candidates = self._candidates(query_bands)
+        if not candidates or self.collection is None:
+            return []
+
+        docs = self.collection.find({'_id': {'$in': [ObjectId(t) for t in candidates]}}, PROJECTION)
+        matches = []
+        for doc in docs:
+            source = source_text(doc)
+            passages, covered = matched_spans(text, words, starts, ends, shingles, source)
+            if passages:
+                matches.append({
+                    'thesis_id': str(doc['_id']),
+                    'title': doc.get('title', 'No Title'),
+                    'author': doc.get('authorName', 'Unknown Author'),
+                    'similarity': round(covered / float(len(words)), 4),
+                    'passages': passages
+                })
+        matches.sort(key=lambda m: m['similarity'], reverse=True)
+        return matches
+
+    def stats(self):
+        with self.lock:
+            return {'theses': len(self.doc_of), 'passages': int(self.alive.sum()), 'delta_passages': self._delta_size}
+
+
+def matched_spans(text, words, starts, ends, shingles, source):
+    # Exact overlap: runs of query shingles that also occur in the source, as character spans
+    source_words, source_starts, source_ends = tokenize(source)
+    source_shingles = shingle_hashes(source_words)
+    k = min(SHINGLE_WORDS, len(words))
+    first_seen = {}
+    for position, value in enumerate(source_shingles.tolist()):
+        first_seen.setdefault(value, position)
+
+    passages = []
+    covered = np.zeros(len(words), dtype=bool)
+    run_start = None
+    positions = [first_seen.get(value) for value in shingles.tolist()] + [None]
+    for i, position in enumerate(positions):
+        if position is not None and run_start is None:
+            run_start = i
+        elif position is None and run_start is not None:
+            last = i - 1
+            if last - run_start + k >= MIN_SPAN_WORDS:
+                covered[run_start:last + k] = True
+                source_first = positions[run_start]
+                source_last = min(positions[last] + k - 1, len(source_words) - 1)
+                passages.append({
+                    'offset': int(starts[run_start]),
+                    'length': int(ends[last + k - 1] - starts[run_start]),
+                    'text': text[starts[run_start]:ends[last + k - 1]],
+                    'source_offset': int(source_starts[source_first]),
+                    'source_length': int(source_ends[source_last] - source_starts[source_first])
+                })
+            run_start = None
+    return passages, int(covered.sum())
@@ -0,0 +1,257 @@
+# --- Single-pass readability statistics ---
+# textstat computes every score from scratch: flesch_reading_ease,
+# gunning_fog, smog_index, ... each re-split the text into sentences and
+# words and re-count syllables, so a full thesis used to be tokenized six
+# times per /readability request. Here the base statistics (sentences,
+# words, syllables, polysyllables, characters, difficult words) are counted
+# in one pass and all six scores are derived from them.
+#
+# The counting rules are textstat 0.7.8's (en_US, no rounding), so the
+# scores are the same numbers textstat returns for the same text:
+#   words       whitespace tokens after removing punctuation (apostrophes of
+#               contractions are kept)
+#   sentences   matches of \b[^.!?]+[.!?]*, not counting those of two words or
+#               fewer, at least 1 for non-empty text
+#   syllables   textstat's own per-word count (CMUdict, then Pyphen), cached
+#               per distinct word
+#
+# A document can also be fed as chunks (chapters): each chunk gets its own
+# scores and the whole-document scores come out of the same pass. Sentences
+# that run across a chunk boundary are joined for the document, exactly as
+# if the chunks had been one string. Results are cached by content hash.
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
+import textstat
+
+from thesis_text import content_hash
+from search_cache import LRUCache
+
+READABILITY_CACHE_MB = float(os.environ.get("READABILITY_CACHE_MB", 16))
+# Distinct words whose syllable count and easy-word status are remembered
+WORD_CACHE_SIZE = int(os.environ.get("READABILITY_WORD_CACHE", 200000))
+
+NOTE = 'Lower Flesch Reading Ease means harder to read. Other scores represent grade levels.'
+SCORES = ('flesch_reading_ease', 'flesch_kincaid_grade', 'gunning_fog', 'smog_index',
+          'automated_readability_index', 'dale_chall_readability_score')
+
+# textstat's tokenization (backend/utils/constants.py, transformations/_remove_punctuation.py)
+_NONCONTRACTION_APOSTROPHE = re.compile(r"'(?![tsd]|ve|ll|re)")
+_PUNCTUATION = re.compile(r"[^\w\s']")
+_WHITESPACE = re.compile(r"\s")
+_SENTENCE = re.compile(r"\b[^.!?]+[.!?]*")
+_TERMINATOR = re.compile(r"[.!?]")
+# Sentences of this many words or fewer (headings, list items) don't count as sentences
+SHORT_SENTENCE_WORDS = 2
+# Gunning Fog's "complex words"; Dale-Chall counts every word missing from the easy-word list
+COMPLEX_WORD_SYLLABLES = 3
+
+# Chapter headings a thesis is split at when per-chapter scores are asked for
+_CHAPTER_HEADING = re.compile(r"^[ \t]*(?:CHAPTER|Chapter)[ \t]+(?:\d+|[IVXLC]+)\b[^\n]*$", re.MULTILINE)
+
+
+def _clean(text):
+    return _PUNCTUATION.sub('', _NONCONTRACTION_APOSTROPHE.sub('', text))
+
+
+def _count_words(text):
+    return len(_clean(text).split())
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def word_profile(word):
+    # (syllables, on the Dale-Chall easy-word list) for a lowercased word
+    return textstat.syllable_count(word), not textstat.is_difficult_word(word, 0)
+
+
+def _sentence_spans(text):
+    # (start, end, words) of each sentence match
+    for match in _SENTENCE.finditer(text):
+        yield match.start(), match.end(), _count_words(match.group())
+
+
+class TextStats:
+    __slots__ = ('length', 'characters', 'tokens', 'words', 'syllables', 'polysyllables',
+                 'complex_words', 'unfamiliar_words', 'sentence_matches', 'short_sentences')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def count_words(self, text):
+        # Everything but sentences; additive over pieces of a text split at whitespace
+        self.length += len(text)
+        self.characters += len(text) - len(_WHITESPACE.findall(text))
+        self.tokens += len(text.split())
+        for word, count in Counter(_clean(text).lower().split()).items():
+            syllables, easy = word_profile(word)
+            self.words += count
+            self.syllables += syllables * count
+            if syllables >= 3:
+                self.polysyllables += count
+            if not easy:
+                self.unfamiliar_words += count
+                if syllables >= COMPLEX_WORD_SYLLABLES:
+                    self.complex_words += count
+
+    def add_sentence(self, words):
+        self.sentence_matches += 1
+        if words <= SHORT_SENTENCE_WORDS:
+            self.short_sentences += 1
+
+    def merge_words(self, other):
+        for name in ('length', 'characters', 'tokens', 'words', 'syllables', 'polysyllables',
+                     'complex_words', 'unfamiliar_words'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def sentences(self):
+        if not self.length:
+            return 0
+        return max(1, self.sentence_matches - self.short_sentences)
+
+    def scores(self):
+        # Same formulas, guards and operation order as textstat, so the floats match exactly
+        words, sentences = self.words, self.sentences
+        words_per_sentence = words / sentences if sentences else 0.0
+        syllables_per_word = self.syllables / words if words else 0.0
+        characters_per_word = self.characters / self.tokens if self.tokens else 0.0
+
+        if words_per_sentence == 0 or syllables_per_word == 0:
+            flesch_reading_ease = flesch_kincaid_grade = 0.0
+        else:
+            flesch_reading_ease = 206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word
+            flesch_kincaid_grade = 0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59
+        if characters_per_word == 0 or words_per_sentence == 0:
+            automated_readability_index = 0.0
+        else:
+            automated_readability_index = 4.71 * characters_per_word + 0.5 * words_per_sentence - 21.43
+        smog_index = 1.043 * (30 * (self.polysyllables / sentences)) ** 0.5 + 3.1291 if sentences else 0.0
+        if words:
+            gunning_fog = 0.4 * (words_per_sentence + 100 * self.complex_words / words)
+            unfamiliar = 100 * self.unfamiliar_words / words
+            dale_chall_readability_score = 0.1579 * unfamiliar + 0.0496 * words_per_sentence
+            if unfamiliar > 5:
+                dale_chall_readability_score += 3.6365
+        else:
+            gunning_fog = dale_chall_readability_score = 0.0
+
+        return {
+            'flesch_reading_ease': flesch_reading_ease,
+            'flesch_kincaid_grade': flesch_kincaid_grade,
+            'gunning_fog': gunning_fog,
+            'smog_index': smog_index,
+            'automated_readability_index': automated_readability_index,
+            'dale_chall_readability_score': dale_chall_readability_score
+        }
+
+    def to_dict(self):
+        return {
+            'sentences': self.sentences,
+            'words': self.words,
+            'syllables': self.syllables,
+            'polysyllables': self.polysyllables,
+            'characters': self.characters,
+            'difficult_words': self.unfamiliar_words
+        }
+
+
+def analyze_chunks(chunks, separator='\n\n'):
+    # One pass over the document separator.join(chunks); returns (document stats, [chunk stats]).
+    # Each chunk must end at whitespace or the separator must be whitespace (a word may not
+    # straddle a boundary), which holds for chapters split at line starts and for blank-line joins.
+    document = TextStats()
+    parts = []
+    open_words = None   # words so far of a document sentence still running at the end of the last chunk
+    for i, chunk in enumerate(chunks):
+        if i:
+            document.length += len(separator)
+        stats = TextStats()
+        stats.count_words(chunk)
+        spans = list(_sentence_spans(chunk))
+        for _, _, words in spans:
+            stats.add_sentence(words)
+
+        if open_words is not None:
+            # The open sentence runs on up to this chunk's first terminator and takes in the
+            # chunk's first sentence if that starts before it
+            terminator = _TERMINATOR.search(chunk)
+            end = terminator.start() if terminator else len(chunk)
+            if spans and spans[0][0] < end:
+                open_words += spans.pop(0)[2]
+            if terminator:
+                document.add_sentence(open_words)
+                open_words = None
+        if open_words is None and spans and spans[-1][1] == len(chunk) and chunk[-1] not in '.!?':
+            open_words = spans.pop()[2]
+        for _, _, words in spans:
+            document.add_sentence(words)
+        document.merge_words(stats)
+        parts.append(stats)
+    if open_words is not None:
+        document.add_sentence(open_words)
+    return document, parts
+
+
+def chapters(text):
+    # (title, offset, text) pieces of a thesis split at its chapter headings; text before
+    # the first heading is the front matter. The pieces concatenate back to text.
+    starts = [m.start() for m in _CHAPTER_HEADING.finditer(text)]
+    if not starts or starts[0] > 0:
+        starts.insert(0, 0)
+    pieces = []
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        heading = _CHAPTER_HEADING.match(text, start)
+        title = ' '.join(heading.group().split()) if heading else 'Front matter'
+        pieces.append((title, start, text[start:end]))
+    return pieces
+
+
+class ReadabilityEngine:
+    def __init__(self, cache_mb=READABILITY_CACHE_MB):
+        self.cache = LRUCache(cache_mb)
+
+    def _chunk_results(self, titles, offsets, parts):
+        return [dict(stats.scores(), title=title, offset=offset, **stats.to_dict())
+                for title, offset, stats in zip(titles, offsets, parts)]
+
+    def scores(self, text, by_chapter=False):
+        # The six scores of text (and of each chapter, with by_chapter)
+        key = (content_hash(text), bool(by_chapter))
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        if by_chapter:
+            pieces = chapters(text)
+            document, parts = analyze_chunks([piece for _, _, piece in pieces], separator='')
+            result = dict(document.scores(), note=NOTE,
+                          chapters=self._chunk_results([t for t, _, _ in pieces], [o for _, o, _ in pieces], parts))
+        else:
+            document, _ = analyze_chunks([text])
+            result = dict(document.scores(), note=NOTE)
+        self.cache.put(key, result)
+        return result
+
+    def score_chunks(self, chunks, titles=None):
+        # Scores of the document made of chunks joined by blank lines, and of each chunk
+        key = (content_hash('\n\n'.join(chunks)), 'chunks', tuple(titles or ()))
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        document, parts = analyze_chunks(chunks)
+        offsets, offset = [], 0
+        for chunk in chunks:
+            offsets.append(offset)
+            offset += len(chunk) + 2
+        titles = list(titles or [f'Chunk {i + 1}' for i in range(len(chunks))])
+        result = dict(document.scores(), note=NOTE, chapters=self._chunk_results(titles, offsets, parts))
+        self.cache.put(key, result)
+        return result
+
+    def stats(self):
+        info = self.cache.stats()
+        word_cache = word_profile.cache_info()
+        info['word_cache'] = {'entries': word_cache.currsize, 'hits': word_cache.hits, 'misses': word_cache.misses}
+        return info
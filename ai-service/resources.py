@@ -0,0 +1,110 @@
+# --- Lazily loaded heavy resources ---
+# spaCy, the sentence-transformer model and the search indexes each load on
+# first use (thread-safe: concurrent first users wait for one load) instead of
+# at import, so gunicorn can serve "/" and "/theses/<id>" right away.
+#
+# MODEL_WARM_UP picks when they load:
+#   background  load them in a background thread right after startup (default)
+#   preload     load them during import. With gunicorn --preload that happens in
+#               the master, so workers share the read-only weights copy-on-write
+#   off         load on first use only
+import gc
+import os
+import threading
+import time
+
+MODEL_WARM_UP = os.environ.get("MODEL_WARM_UP", "background").lower()
+# A failed load is retried by the next caller, but not more often than this
+RESOURCE_RETRY_SECONDS = float(os.environ.get("RESOURCE_RETRY_SECONDS", 30))
+
+_registry = []
+
+
+class ResourceUnavailable(Exception):
+    pass
+
+
+class LazyResource:
+    def __init__(self, name, factory, warm_up=True):
+        self.name = name
+        self.factory = factory
+        self.warm_up = warm_up
+        self._lock = threading.Lock()
+        self._value = None
+        self.state = 'not_loaded'    # not_loaded -> loading -> ready | failed
+        self.error = None
+        self.load_seconds = None
+        self._failed_at = 0
+        _registry.append(self)
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def get(self):
+        if self.state == 'ready':
+            return self._value
+        with self._lock:
+            if self.state == 'ready':
+                return self._value
+            if self.state == 'failed' and time.time() - self._failed_at < RESOURCE_RETRY_SECONDS:
+                raise ResourceUnavailable(f"{self.name} failed to load: {self.error}")
+            self.state = 'loading'
+            started = time.time()
+            try:
+                value = self.factory()
+            except Exception as e:
+                self.state = 'failed'
+                self.error = str(e)
+                self._failed_at = time.time()
+                print(f"Error loading {self.name}: {e}")
+                raise ResourceUnavailable(f"{self.name} failed to load: {e}") from e
+            self._value = value
+            self.load_seconds = round(time.time() - started, 2)
+            self.error = None
+            self.state = 'ready'
+            print(f"Loaded {self.name} in {self.load_seconds}s.")
+            return value
+
+    def status(self):
+        return {'state': self.state, 'load_seconds': self.load_seconds, 'error': self.error}
+
+    def after_fork(self):
+        # A load that was running in the parent at fork time has no thread here to finish it
+        if self.state != 'ready':
+            self._lock = threading.Lock()
+            self.state = 'not_loaded' if self.state == 'loading' else self.state
+
+
+def _load_quietly(resources):
+    for resource in resources:
+        try:
+            resource.get()
+        except ResourceUnavailable:
+            pass
+
+
+def warm_up():
+    # Loads every warm-up resource according to MODEL_WARM_UP
+    resources = [r for r in _registry if r.warm_up and not r.ready]
+    if MODEL_WARM_UP == 'preload':
+        _load_quietly(resources)
+    elif MODEL_WARM_UP == 'background' and resources:
+        threading.Thread(target=_load_quietly, args=(resources,), daemon=True, name="warm-up").start()
+
+
+def statuses():
+    return {resource.name: resource.status() for resource in _registry}
+
+
+def after_fork():
+    for resource in _registry:
+        resource.after_fork()
+
+
+def share_with_forked_workers():
+    # Objects that exist at fork time (model weights included) move to the permanent GC
+    # generation, so collections in the workers don't write to those pages and break
+    # copy-on-write sharing
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(before=gc.freeze)
@@ -0,0 +1,106 @@
+# --- Query embedding and search result caches ---
+# Search traffic repeats a lot (department names, "machine learning", ...).
+# Two bounded LRU caches with a TTL sit in front of /semantic-search:
+#   normalized query text      -> query embedding
+#   (query, top_k, filters)    -> formatted results
+# Result entries remember the index generation they were computed against
+# and count as misses once the index has changed, so stale hits are impossible.
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+QUERY_EMBEDDING_CACHE_MB = float(os.environ.get("QUERY_EMBEDDING_CACHE_MB", 16))
+SEARCH_RESULT_CACHE_MB = float(os.environ.get("SEARCH_RESULT_CACHE_MB", 48))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 600))
+
+# Rough per-entry bookkeeping cost (key, tuple, OrderedDict node)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def result_key(query, top_k, filters=None):
+    return (normalize_query(query), int(top_k), json.dumps(filters or {}, sort_keys=True))
+
+
+def _sizeof(key, value):
+    if isinstance(value, np.ndarray):
+        size = value.nbytes
+    else:
+        size = len(json.dumps(value, default=str))
+    return size + len(repr(key)) + ENTRY_OVERHEAD_BYTES
+
+
+class LRUCache:
+    def __init__(self, max_mb, ttl=SEARCH_CACHE_TTL):
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # key -> (value, generation, expires_at, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0                 # misses caused by an index generation change
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, generation=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, entry_generation, expires_at, size = entry
+            if entry_generation != generation or expires_at < time.monotonic():
+                if entry_generation != generation:
+                    self.stale += 1
+                else:
+                    self.expired += 1
+                self.misses += 1
+                del self.entries[key]
+                self.bytes -= size
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        size = _sizeof(key, value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+            self.entries[key] = (value, generation, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'stale': self.stale,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,178 @@
+# --- Tag suggestion engine ---
+# The tag taxonomy (tag -> keyword phrases) lives in tag_taxonomy.json and is
+# compiled into a word-level Aho-Corasick automaton: one pass over the text's
+# words finds every keyword phrase, whole words only ("ai" no longer matches
+# "maintain"). A second mode scores the text's embedding against one centroid
+# embedding per tag (the mean of its name and keyword embeddings).
+#
+# Editing the taxonomy file takes effect without a restart: the file's mtime
+# is checked at most once a second, or POST /tags/reload forces a reload.
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+TAG_TAXONOMY_PATH = os.environ.get(
+    "TAG_TAXONOMY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tag_taxonomy.json'))
+TAG_CENTROID_THRESHOLD = float(os.environ.get("TAG_CENTROID_THRESHOLD", 0.3))
+TAG_CENTROID_TOP_K = int(os.environ.get("TAG_CENTROID_TOP_K", 3))
+
+_WORD_RE = re.compile(r"\w+")
+# Keyword words with these endings aren't plurals, so their trailing "s" is never folded
+# ("economics" must not match "economic", nor "analysis" "analysi")
+SINGULAR_ENDINGS = ('ics', 'ss', 'us', 'is')
+
+
+def _words(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def surface_forms(word):
+    # Forms of a keyword word that count as that word in the text ("network" <- "networks")
+    forms = {word, word + 's', word + 'es'}
+    if len(word) > 3 and word.endswith('s') and not word.endswith(SINGULAR_ENDINGS):
+        forms.add(word[:-1])
+    return forms
+
+
+class Automaton:
+    # Aho-Corasick over words: goto[node] maps a word to the next node, fail[node] is the
+    # longest proper suffix that is also a trie path, out[node] lists the tag indexes matched there
+    def __init__(self, taxonomy):
+        self.tags = list(taxonomy)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for tag_index, keywords in enumerate(taxonomy.values()):
+            for keyword in keywords:
+                words = _words(keyword)
+                if not words:
+                    continue
+                node = 0
+                for word in words:
+                    if word not in self.goto[node]:
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append([])
+                        self.goto[node][word] = len(self.goto) - 1
+                    node = self.goto[node][word]
+                if tag_index not in self.out[node]:
+                    self.out[node].append(tag_index)
+        # Text word -> keyword word; exact spellings win over folded plural forms
+        self.canonical = {}
+        for word in {word for node in self.goto for word in node}:
+            for form in surface_forms(word):
+                self.canonical.setdefault(form, word)
+            self.canonical[word] = word
+
+        # Breadth-first failure links; outputs of the fail target are inherited
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(word, 0)
+                self.out[child].extend(t for t in self.out[self.fail[child]] if t not in self.out[child])
+
+    def counts(self, text):
+        # Keyword hits per tag index in one pass over the text's words. Most words of a thesis
+        # are in no keyword, so they only cost a set lookup and reset the automaton to the root.
+        hits = [0] * len(self.tags)
+        goto, fail, out, canonical = self.goto, self.fail, self.out, self.canonical
+        node = 0
+        for word in _words(text):
+            word = canonical.get(word)
+            if word is None:
+                node = 0
+                continue
+            while node and word not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(word, 0)
+            for tag_index in out[node]:
+                hits[tag_index] += 1
+        return hits
+
+
+class TagEngine:
+    def __init__(self, path=TAG_TAXONOMY_PATH, encode=None):
+        self.path = path
+        self.encode = encode
+        self.lock = threading.Lock()
+        self.taxonomy = {}
+        self.automaton = Automaton({})
+        self.version = 0
+        self._centroids = None      # (version, tags, matrix)
+        self._mtime = None
+        self._checked = 0
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            taxonomy = json.load(f)
+        automaton = Automaton(taxonomy)
+        with self.lock:
+            # One swap, so concurrent requests see either the old or the new taxonomy
+            self.taxonomy, self.automaton = taxonomy, automaton
+            self.version += 1
+            self._mtime = os.path.getmtime(self.path)
+        print(f"Loaded tag taxonomy ({len(taxonomy)} tags, {sum(len(k) for k in taxonomy.values())} keywords).")
+        return {'tags': len(taxonomy), 'keywords': sum(len(k) for k in taxonomy.values()), 'version': self.version}
+
+    def reload_if_changed(self):
+        now = time.time()
+        if now - self._checked < 1:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            try:
+                self.load()
+            except (OSError, ValueError) as e:
+                # Keep serving the previous taxonomy until the file is fixed
+                print(f"Error reloading tag taxonomy: {e}")
+
+    def match(self, text):
+        # Tags with at least one whole-word keyword match, in taxonomy order
+        self.reload_if_changed()
+        automaton = self.automaton
+        return [tag for tag, hits in zip(automaton.tags, automaton.counts(text)) if hits]
+
+    def _centroid_matrix(self):
+        centroids = self._centroids
+        if centroids is not None and centroids[0] == self.version:
+            return centroids[1], centroids[2]
+        version, taxonomy = self.version, self.taxonomy
+        tags = list(taxonomy)
+        phrases = [[tag] + list(keywords) for tag, keywords in taxonomy.items()]
+        flat = [phrase for group in phrases for phrase in group]
+        embeddings = np.asarray(self.encode(flat), dtype='float32') if flat else np.empty((0, 0), dtype='float32')
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        matrix, offset = [], 0
+        for group in phrases:
+            centroid = embeddings[offset:offset + len(group)].mean(axis=0)
+            matrix.append(centroid / max(np.linalg.norm(centroid), 1e-12))
+            offset += len(group)
+        matrix = np.vstack(matrix) if matrix else np.empty((0, 0), dtype='float32')
+        self._centroids = (version, tags, matrix)
+        return tags, matrix
+
+    def classify(self, text_embedding, top_k=TAG_CENTROID_TOP_K, threshold=TAG_CENTROID_THRESHOLD):
+        # (tag, cosine score) pairs for the tag centroids closest to the text's embedding
+        self.reload_if_changed()
+        tags, matrix = self._centroid_matrix()
+        if not tags:
+            return []
+        vector = np.asarray(text_embedding, dtype='float32').reshape(-1)
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+        scores = matrix @ vector
+        order = np.argsort(-scores)[:top_k]
+        return [(tags[i], round(float(scores[i]), 4)) for i in order if scores[i] >= threshold]
@@ -0,0 +1,22 @@
+# --- Thesis text helpers ---
+# Which of a thesis's texts the analysis, plagiarism and passage indexes work
+# on, and the hash that keys caches and index entries by text. Kept free of
+# third-party imports so the analysis worker processes can use it without
+# loading FAISS or the database driver.
+import hashlib
+
+# Saved indexes record this; one built with an older choice of text re-checks every thesis
+SOURCE_TEXT_VERSION = 2
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def source_text(doc):
+    # The extracted PDF text when there is one, otherwise the abstract. The upload route
+    # used to store the raw PDF bytes in full_text ("%PDF-1.7 ..."); those are no text.
+    full_text = doc.get('full_text') or ''
+    if full_text.strip() and not full_text.startswith('%PDF'):
+        return full_text
+    return doc.get('abstract') or ''
@@ -9,6 +9,7 @@ const sendEmail = require('../../utils/sendEmail');
 const multer = require('multer');
 const path = require('path');
 const fs = require('fs');
+const axios = require('axios');
 // Multer storage
 const storage = multer.diskStorage({
   destination: (req, file, cb) => cb(null, 'uploads/'),
@@ -209,6 +210,16 @@ router.post('/', auth, upload.single('thesisFile'), async (req, res) => {
 
     const thesis = await newThesis.save();
 
+    // Ask the AI service to replace full_text with the text extracted from the PDF, then to
+    // queue the whole-thesis analysis that fills aiSummary/aiKeywords/aiSentiment (runs in the background)
+    if (process.env.AI_SERVICE_URL) {
+      const thesisId = thesis._id.toString();
+      axios.post(`${process.env.AI_SERVICE_URL}/extract-text`, { thesis_id: thesisId })
+        .catch(err => console.error('Text extraction request failed:', err.message))
+        .then(() => axios.post(`${process.env.AI_SERVICE_URL}/analysis-jobs`, { thesis_id: thesisId }))
+        .catch(err => console.error('Analysis request failed:', err.message));
+    }
+
     // 🔔 Email notify admins
     const admins = await User.find({ role: 'admin' }).select('email');
     const adminEmails = admins.map(a => a.email);